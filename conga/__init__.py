@@ -8,6 +8,9 @@ from . import imhc_scoring
 from . import cd8_scoring
 from . import tcrdist
 from . import tcr_clumping
+from . import tcrdist_cpp
+from . import tcrdist_cache
+from . import approx_nbrs
 
 
 
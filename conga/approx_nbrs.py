@@ -0,0 +1,184 @@
+''' Approximate nearest neighbors for the GEX and TCR PCA spaces
+
+This is an inverted-file (IVF) index built with plain numpy: the points are clustered
+into cells with k-means, and the neighbors of each point are searched for among the
+points in the cells whose centroids are closest to it. We take cells until there
+are at least candidate_factor * num_nbrs candidates (and at least num_probe cells).
+candidate_factor is the recall knob: higher is more accurate and slower, and
+candidate_factor >= N/num_nbrs is exact. The recall is estimated on a sample of
+clones, and if it's under min_recall we fall back to the exact search.
+
+We use cells rather than a graph index (NN-descent, HNSW) because conga neighborhoods
+are big (nbr_fracs of 1-10% of the dataset), so each query needs a large chunk of
+the dataset anyway, and the distances between a cell and its candidates can be
+computed as one dense block, like the exact code in preprocess.calc_nbrs_batched.
+
+Same-agroup and same-bgroup clones are excluded from the neighbors the same way as in
+the exact code (their distances are set to 1e3).
+'''
+import numpy as np
+from scipy.spatial.distance import cdist
+
+
+def kmeans_cells(
+        X,
+        num_cells,
+        num_iterations = 10,
+        max_training_points = 100000,
+        random_seed = 0,
+):
+    ''' Returns centroids, cells where cells[i] is the index of the centroid of X[i]
+
+    The centroids are fit (Lloyd's algorithm) on a random subset of at most
+    max_training_points points, then everybody is assigned to the closest one.
+    '''
+    N = X.shape[0]
+    rng = np.random.RandomState(random_seed)
+    num_cells = max(1, min(num_cells, N))
+    train = X if N <= max_training_points else \
+            X[rng.choice(N, max_training_points, replace=False)]
+    centroids = train[rng.choice(train.shape[0], num_cells, replace=False)]\
+                .astype(np.float64)
+    for _ in range(num_iterations):
+        assignments = _closest_centroids(train, centroids)
+        counts = np.bincount(assignments, minlength=num_cells)
+        for j in range(train.shape[1]): # per-cell sums, one pass per dimension
+            sums = np.bincount(assignments, weights=train[:,j], minlength=num_cells)
+            centroids[counts>0, j] = sums[counts>0] / counts[counts>0]
+        for c in np.nonzero(counts==0)[0]: # re-seed empty cells
+            centroids[c] = train[rng.randint(train.shape[0])]
+    return centroids, _closest_centroids(X, centroids)
+
+def cell_members(cells, num_cells):
+    ''' Returns a list with the (sorted) indices of the points in each cell, from one
+    argsort rather than a scan per cell
+    '''
+    order = np.argsort(cells, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=num_cells))])
+    return [order[offsets[c]:offsets[c+1]] for c in range(num_cells)]
+
+def _closest_centroids(X, centroids, batch_size=10000):
+    return np.concatenate(
+        [np.argmin(cdist(X[start:start+batch_size], centroids), axis=1)
+         for start in range(0, X.shape[0], batch_size)])
+
+
+def find_approx_nbrs(
+        X,
+        num_nbrs,
+        agroups,
+        bgroups,
+        candidate_factor = 4.0,
+        num_probe = 1,
+        num_cells = None, # default is ~ sqrt(N)
+        target_N_for_batching = 8192,
+        num_recall_samples = 200, # estimate the recall on this many clones (0 to skip)
+        min_recall = 0.9, # redo the search exactly if the estimated recall is lower
+        random_seed = 0,
+):
+    ''' Returns nbrs, dists: arrays of shape (N, num_nbrs), sorted by increasing
+    distance, with the approximate nearest neighbors of each row of X
+
+    Each clone takes the cells with the closest centroids to itself until it has
+    candidate_factor*num_nbrs candidates; a block of rows from the same cell is
+    compared to the union of its rows' cells, as one distance block.
+
+    If the recall estimated on num_recall_samples clones comes in under min_recall
+    (which happens for diffuse embeddings, where the nbrs are spread over many
+    cells) we print a warning and fall back to the exact search. Set min_recall
+    to 0 to keep the approximate nbrs anyway.
+
+    nbrs exclude self and any clones in the same agroup or bgroup (if there are
+    enough other clones)
+    '''
+    N = X.shape[0]
+    assert 0 < num_nbrs < N
+    if num_cells is None:
+        num_cells = max(1, int(np.sqrt(N)))
+    centroids, cells = kmeans_cells(X, num_cells, random_seed=random_seed)
+    num_cells = centroids.shape[0]
+    members = cell_members(cells, num_cells)
+    cell_sizes = np.array([len(x) for x in members])
+    print(f'find_approx_nbrs: N= {N} num_nbrs= {num_nbrs} num_cells= {num_cells}',
+          f'candidate_factor= {candidate_factor}')
+
+    min_candidates = min(N, int(candidate_factor*num_nbrs) + 1)
+
+    nbrs = np.zeros((N, num_nbrs), dtype=np.int32)
+    dists = np.zeros((N, num_nbrs), dtype=np.float32)
+
+    total_candidates = 0
+    # rows per probe block; the union of the rows' cells is a bit bigger than
+    # min_candidates, and gets split again below if it's much bigger
+    probe_block_size = max(1, int(target_N_for_batching**2 / min_candidates))
+    for c in range(num_cells):
+        for start in range(0, len(members[c]), probe_block_size):
+            rows = members[c][start:start+probe_block_size]
+            # rank the cells for each row by the distance to their centroids
+            cell_order = np.argsort(cdist(X[rows], centroids), axis=1)
+            total = np.cumsum(cell_sizes[cell_order], axis=1)
+            num_probe_rows = np.maximum(
+                num_probe, (total < min_candidates).sum(axis=1)+1)
+            probed = cell_order[np.arange(num_cells) < num_probe_rows[:,np.newaxis]]
+            candidates = np.concatenate([members[x] for x in np.unique(probed)])
+            total_candidates += len(rows) * len(candidates)
+            _search_block(X, rows, candidates, num_nbrs, agroups, bgroups,
+                          target_N_for_batching, nbrs, dists)
+
+    print(f'find_approx_nbrs: computed {total_candidates/N**2:.3f} of the',
+          'all-vs-all distances')
+    if num_recall_samples:
+        recall = estimate_recall(X, nbrs, agroups, bgroups, num_recall_samples,
+                                 random_seed)
+        print(f'find_approx_nbrs: estimated recall= {recall:.4f}',
+              f'num_nbrs= {num_nbrs} candidate_factor= {candidate_factor}')
+        if recall < min_recall:
+            print('*'*80)
+            print(f'WARNING: find_approx_nbrs: estimated recall {recall:.4f} is below',
+                  f'min_recall= {min_recall}; falling back to the exact nbrs.',
+                  'Use the exact nbr_backend (or a bigger candidate_factor) for',
+                  'this data')
+            print('*'*80)
+            _search_block(X, np.arange(N), np.arange(N), num_nbrs, agroups, bgroups,
+                          target_N_for_batching, nbrs, dists)
+    return nbrs, dists
+
+def _search_block(
+        X,
+        rows,
+        candidates,
+        num_nbrs,
+        agroups,
+        bgroups,
+        target_N_for_batching,
+        nbrs, # output
+        dists, # output
+):
+    ''' Fill nbrs[rows] and dists[rows] with the closest num_nbrs candidates
+    '''
+    # limit the size of the distance blocks
+    block_size = max(1, int(target_N_for_batching**2 / len(candidates)))
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start+block_size]
+        D = cdist(X[block_rows], X[candidates])
+        D[agroups[block_rows][:,np.newaxis] == agroups[candidates]] = 1e3
+        D[bgroups[block_rows][:,np.newaxis] == bgroups[candidates]] = 1e3
+        inds = np.argpartition(D, num_nbrs-1, axis=1)[:,:num_nbrs]
+        block_dists = np.take_along_axis(D, inds, axis=1)
+        order = np.argsort(block_dists, axis=1)
+        nbrs[block_rows] = candidates[np.take_along_axis(inds, order, axis=1)]
+        dists[block_rows] = np.take_along_axis(block_dists, order, axis=1)
+
+def estimate_recall(X, nbrs, agroups, bgroups, num_samples=200, random_seed=0):
+    ''' The fraction of the exact nbrs found in nbrs, for a random sample of rows
+    '''
+    N, num_nbrs = nbrs.shape
+    rng = np.random.RandomState(random_seed)
+    rows = rng.choice(N, min(N, num_samples), replace=False)
+    D = cdist(X[rows], X)
+    D[agroups[rows][:,np.newaxis] == agroups] = 1e3
+    D[bgroups[rows][:,np.newaxis] == bgroups] = 1e3
+    # count approximate nbrs within the exact k-th distance (handles ties)
+    kth = np.partition(D, num_nbrs-1, axis=1)[:,num_nbrs-1]
+    found = np.take_along_axis(D, nbrs[rows].astype(int), axis=1) <= kth[:,np.newaxis]
+    return found.mean()
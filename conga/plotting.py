@@ -3064,7 +3064,7 @@ def make_tcrdist_trees( adata, output_prefix, group_by = None):
 
         if not precomputed:
             print('computing tcrdist distances:', clust, csize)
-            cdists = np.array([ tcrdist(x,y) for x in ctcrs for y in ctcrs]).reshape(csize,csize)
+            cdists = preprocess.calc_tcrdist_matrix_python(ctcrs, organism, tcrdist)
         else:
             assert False # tmp hack
 
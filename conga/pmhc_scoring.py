@@ -161,9 +161,18 @@ def calc_sf_max( m, P ): # ~= 1 - ( 1-P)^m
             break
     return tot
 
-def calc_pmhc_nbrs_total_pval( pmhc_mask_in, nbrs, agroups, bgroups, verbose=False ):
+def calc_pmhc_nbrs_total_pval(
+        pmhc_mask_in,
+        nbrs,
+        agroups,
+        bgroups,
+        verbose=False,
+        group_index=None, # util.TcrGroupIndex, will be created if None
+):
     ''' at each step, eliminate nbrs of max-overlap cell as well as same-group cells
     '''
+    if group_index is None:
+        group_index = util.TcrGroupIndex(agroups, bgroups)
     pmhc_mask = np.copy( pmhc_mask_in )
     num_neighbors = nbrs.shape[1]
 
@@ -196,9 +205,9 @@ def calc_pmhc_nbrs_total_pval( pmhc_mask_in, nbrs, agroups, bgroups, verbose=Fal
         # what are the odds of seeing this many nbrs?
         ii = ii_max
 
-        not_same_group = ~( ( agroups==agroups[ii] ) | ( bgroups==bgroups[ii] ) )
-        possible_pmhc_pos_nbrs = np.sum( pmhc_mask[ not_same_group ] )
-        possible_nbrs = np.sum( not_same_group )
+        same_group = group_index.excluded(ii)
+        possible_pmhc_pos_nbrs = num_pos_cells - np.sum( pmhc_mask[ same_group ] )
+        possible_nbrs = group_index.N - len(same_group)
 
         expected = float(possible_pmhc_pos_nbrs*num_neighbors)/possible_nbrs
         if max_overlap<expected:
@@ -234,8 +243,7 @@ def calc_pmhc_nbrs_total_pval( pmhc_mask_in, nbrs, agroups, bgroups, verbose=Fal
 
         # remove the cell with the most nbrs, continue looping
         pmhc_mask[ nbrs[ii,:] ] = False
-        pmhc_mask[ agroups==agroups[ii] ] = False
-        pmhc_mask[ bgroups==bgroups[ii] ] = False
+        pmhc_mask[ same_group ] = False
 
 
     sys.stdout.flush()
@@ -259,6 +267,9 @@ def compute_pmhc_versus_nbrs(
     X_pmhc_sorted = -1 * np.sort( -1 * X_pmhc, axis=1 ) # in decreasing order
     X_pmhc_argsorted = np.argsort( -1 * X_pmhc, axis=1 ) # ditto
 
+    group_index = util.TcrGroupIndex(agroups, bgroups)
+    num_allowed = group_index.num_allowed()
+
     results = []
     for ip, pmhc in enumerate(pmhc_var_names):
         top_pmhc_index = X_pmhc_argsorted[:,0]
@@ -273,12 +284,12 @@ def compute_pmhc_versus_nbrs(
 
         # find the total number of nbrs and the max nbrs per cell
         total_nbrs, max_nbrs, expected_total_nbrs = 0, 0, 0
+        num_allowed_pmhc = num_positive_clones - group_index.num_excluded_in_mask(pmhc_mask)
         for ind1 in ( x for x,y in enumerate( pmhc_mask ) if y ):
             ind1_nbrs=0#pmhc pos nbrs that is
-            diff_group_mask = (agroups!=agroups[ind1]) & (bgroups!=bgroups[ind1])
-            # if len(nbrs[ind11]) nbrs are chosen at random from among the diff_group_mask clones, how many
+            # if len(nbrs[ind11]) nbrs are chosen at random from among the diff-group clones, how many
             #  would we expect to be pmhc positive by chance?
-            expected_total_nbrs += len(nbrs[ind1]) * np.sum( pmhc_mask & diff_group_mask) / np.sum(diff_group_mask)
+            expected_total_nbrs += len(nbrs[ind1]) * num_allowed_pmhc[ind1] / num_allowed[ind1]
             for ind2 in nbrs[ind1]:
                 if pmhc_mask[ind2]:
                     assert ind2 != ind1
@@ -288,7 +299,8 @@ def compute_pmhc_versus_nbrs(
 
         expected_total_nbrs = max(1e-6, expected_total_nbrs) # no div by zero
 
-        total_pval = calc_pmhc_nbrs_total_pval( pmhc_mask, nbrs, agroups, bgroups )
+        total_pval = calc_pmhc_nbrs_total_pval( pmhc_mask, nbrs, agroups, bgroups,
+                                                group_index=group_index )
 
         if total_nbrs==0:
             if expected_total_nbrs <1.0:
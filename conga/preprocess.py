@@ -14,14 +14,21 @@ import scipy
 from scipy.cluster import hierarchy
 from scipy.spatial.distance import squareform, cdist
 from scipy.sparse import issparse, csr_matrix
+from scipy.sparse.linalg import eigsh, LinearOperator
 from anndata import AnnData
 import sys
 import os
+import itertools
+import hashlib
+import json
 from sys import exit
 from . import tcr_scoring
 from . import util
 from . import pmhc_scoring
 from . import plotting
+from . import tcrdist_cpp
+from . import tcrdist_cache
+from . import approx_nbrs
 from .tcrdist.tcr_distances import TcrDistCalculator
 from .util import tcrdist_cpp_available
 
@@ -187,13 +194,20 @@ def retrieve_tcrs_from_adata(adata, include_subject_id_if_present=False):
 def read_adata(
         gex_data, # filename
         gex_data_type, # string describing file type
-        gex_only = True
+        gex_only = True,
+        backed = False, # only for h5ad: leave the X matrix on disk
 ):
     ''' Split this out so that other code can use it. Read GEX data
+
+    if backed is True (and gex_data_type is 'h5ad') the returned adata is opened
+    read-only in backed mode, see load_backed_rows
     '''
     print('reading:', gex_data, 'of type', gex_data_type)
+    if backed and gex_data_type != 'h5ad':
+        print('WARNING read_adata: backed mode is only supported for h5ad files,',
+              'loading the full', gex_data_type, 'dataset')
     if gex_data_type == 'h5ad':
-        adata = sc.read_h5ad( gex_data )
+        adata = sc.read_h5ad( gex_data, backed = 'r' if backed else None )
 
     elif gex_data_type == '10x_mtx':
         adata = sc.read_10x_mtx( gex_data, gex_only=gex_only )
@@ -214,6 +228,119 @@ def read_adata(
         adata = adata.copy()
     return adata
 
+def calc_num_genes_per_cell_chunked(adata, chunk_size=10000):
+    ''' Returns the number of expressed features (X>0) for each cell, like the
+    'n_genes' from sc.pp.filter_cells, reading X in chunks of chunk_size rows
+
+    works for backed adata without loading all of X
+    '''
+    num_genes = np.zeros((adata.shape[0],), dtype=int)
+    for start in range(0, adata.shape[0], chunk_size):
+        X = adata.X[start:start+chunk_size]
+        num_genes[start:start+chunk_size] = np.asarray((X>0).sum(axis=1)).ravel()
+    return num_genes
+
+def load_backed_rows(adata, mask):
+    ''' Returns an in-memory copy of adata[mask,:], where adata may be backed
+
+    only the rows in mask are read from disk
+    '''
+    if adata.isbacked:
+        return adata[mask,:].to_memory()
+    else:
+        return adata[mask,:].copy()
+
+def _prefilter_min_genes_mask(adata, min_genes):
+    ''' helper for read_dataset
+    '''
+    mask = calc_num_genes_per_cell_chunked(adata) >= min_genes
+    print(f'read_dataset: prefilter_min_genes= {min_genes} filtered out',
+          f'{np.sum(~mask)} of {adata.shape[0]} cells')
+    return mask
+
+def _textfile_stamp(textfile):
+    ''' size and mtime (ns) of textfile, stored in the .npz sidecars
+    '''
+    info = os.stat(textfile)
+    return np.array([info.st_size, info.st_mtime_ns], dtype=np.int64)
+
+def _save_sidecar(textfile, **arrays):
+    np.savez(textfile+'.npz', source_stamp=_textfile_stamp(textfile), **arrays)
+
+def _load_sidecar(textfile, names):
+    ''' Returns the arrays in textfile+'.npz' or None if there's no sidecar, or it
+    was made from a different version of textfile (size or mtime don't match, so
+    eg a text file restored with cp -p doesn't pick up a newer sidecar)
+    '''
+    sidecar_file = textfile+'.npz'
+    if not exists(sidecar_file):
+        return None
+    with np.load(sidecar_file) as data:
+        if ('source_stamp' not in data.files or
+            not np.array_equal(data['source_stamp'], _textfile_stamp(textfile))):
+            print('ignoring out-of-date sidecar:', sidecar_file)
+            return None
+        print('reading:', sidecar_file)
+        return tuple(data[x] for x in names)
+
+def write_tcrdist_kernel_pcs_sidecar(kpca_file):
+    ''' Save the kpcs from kpca_file in binary form (as kpca_file+'.npz')
+    so that read_tcrdist_kernel_pcs_file doesn't have to parse the text file
+    '''
+    ids, kpcs = read_tcrdist_kernel_pcs_file(kpca_file, use_sidecar=False)
+    _save_sidecar(kpca_file, ids=ids, kpcs=kpcs)
+
+def read_tcrdist_kernel_pcs_file(kpca_file, use_sidecar=True):
+    ''' Returns ids, kpcs: a numpy array of clone_id strings and a 2D array of
+    kernel PCs, one row per line of kpca_file
+
+    lines look like "pc_comps: <clone_id> <pc0> <pc1> ..." and 'nan' columns
+    are dropped. Uses the kpca_file+'.npz' sidecar if it's up to date.
+    '''
+    if use_sidecar:
+        arrays = _load_sidecar(kpca_file, ['ids', 'kpcs'])
+        if arrays is not None:
+            return arrays
+
+    print('reading:',kpca_file)
+    df = pd.read_csv(kpca_file, sep=r'\s+', header=None, dtype={1:str})
+    if df.shape[0] == 0:
+        return np.array([], dtype=str), np.zeros((0,0))
+    assert np.all(df[0] == 'pc_comps:')
+    ids = df[1].to_numpy().astype(str)
+    kpcs = df.iloc[:,2:].to_numpy(dtype=np.float64)
+    kpcs = kpcs[:, ~np.all(np.isnan(kpcs), axis=0)]
+    assert not np.any(np.isnan(kpcs)) # same number of kpcs on each line
+    return ids, kpcs
+
+def write_barcode_mapping_sidecar(bcmap_file):
+    ''' Save the barcode-->clone_id mapping from bcmap_file in binary form
+    (as bcmap_file+'.npz'), one entry per barcode
+    '''
+    barcodes, clone_ids = read_barcode_mapping_file(bcmap_file, use_sidecar=False)
+    _save_sidecar(bcmap_file, barcodes=barcodes, clone_ids=clone_ids)
+
+def read_barcode_mapping_file(bcmap_file, use_sidecar=True):
+    ''' Returns barcodes, clone_ids: numpy string arrays with one entry per barcode
+    in bcmap_file, in file order
+
+    bcmap_file has columns clone_id and barcodes (comma-separated); clones with
+    no barcodes are skipped. Uses the bcmap_file+'.npz' sidecar if it's up to date.
+    '''
+    if use_sidecar:
+        arrays = _load_sidecar(bcmap_file, ['barcodes', 'clone_ids'])
+        if arrays is not None:
+            return arrays
+
+    print('reading:', bcmap_file)
+    df = pd.read_csv(bcmap_file, sep='\t', dtype=str, keep_default_na=False)
+    df = df[df.barcodes != '']
+    barcodes = df.barcodes.str.split(',')
+    clone_ids = np.repeat(df.clone_id.to_numpy(), barcodes.str.len().to_numpy())
+    barcodes = np.concatenate(barcodes.to_numpy()) if len(barcodes) else \
+               np.array([], dtype=object)
+    return barcodes.astype(str), clone_ids.astype(str)
+
 def read_dataset(
         gex_data,
         gex_data_type,
@@ -225,6 +352,8 @@ def read_dataset(
         gex_only=True, #only applies to 10x-formatted data
         suffix_for_non_gene_features=None, #None or a string
         save_stats=None,
+        backed=False, # low-memory mode, only for h5ad
+        prefilter_min_genes=None, # None or an int
 ):
     ''' returns adata
 
@@ -234,15 +363,19 @@ def read_dataset(
     if clones_file is None, gex_data_type must be 'h5ad' and the tcr info
       must already be in the AnnData object (ie adata) when we load it
 
+    if backed is True, the h5ad file is opened in backed mode and only the cells
+      that we keep are loaded into memory. prefilter_min_genes drops cells
+      with fewer than that many expressed features while loading (the same as
+      the min_genes filter in filter_normalize_and_hvg, so it doesn't change
+      the results, just avoids loading those cells)
+
     '''
     # Check the input
     dtypes = ['h5ad', '10x_mtx', '10x_h5', 'loom']
     if not gex_data_type in dtypes :
         raise ValueError("gex_data_type should be one of {dtypes}".format(dtypes = dtypes)) 
 
-    include_tcr_nucseq = True
-
-    adata = read_adata(gex_data, gex_data_type, gex_only=gex_only)
+    adata = read_adata(gex_data, gex_data_type, gex_only=gex_only, backed=backed)
 
     if save_stats is not None:
         save_stats['num_cells_w_gex'] = adata.shape[0]
@@ -279,11 +412,15 @@ def read_dataset(
             print('WARNING:: reading dataset without clones file',
                   'kernel PCs will not be set ie X_pca_tcr array',
                   'will be missing from adata.obsm!!!!!!!!!!!!!', sep='\n')
+        if prefilter_min_genes is not None:
+            adata = load_backed_rows(
+                adata, _prefilter_min_genes_mask(adata, prefilter_min_genes))
+        elif adata.isbacked:
+            adata = adata.to_memory()
         return adata ########################################## EARLY RETURN
 
 
-    barcodes = set( adata.obs.index )
-    print('total barcodes:',len(barcodes),adata.shape)
+    print('total barcodes:',len(adata.obs.index),adata.shape)
 
     # read the kpcs, etc
     bcmap_file = clones_file+'.barcode_mapping.tsv'
@@ -295,11 +432,7 @@ def read_dataset(
         assert exists(kpca_file)
 
     print('reading:',clones_file)
-    tmpdata = open(clones_file,'r')
-    clones_file_header = tmpdata.readline()
-    tmpdata.close()
-    #clones_file_header = popen('head -n1 '+clones_file).readlines()[0]
-    clones_df = pd.read_csv(clones_file, sep='\t')
+    clones_df = pd.read_csv(clones_file, sep='\t', dtype={'clone_id':str})
     # allow use of either 'va' or 'va_gene' as column header
     for vj in 'vj':
         for ab in 'ab':
@@ -315,21 +448,16 @@ def read_dataset(
             print('clones_file:', clones_file)
             sys.exit()
 
-    id2tcr = {}
-    tcr2id = {}
-    for l in clones_df.itertuples(index=False):
-        if include_tcr_nucseq:
-            atcr = ( l.va_gene, l.ja_gene, l.cdr3a, l.cdr3a_nucseq )
-            btcr = ( l.vb_gene, l.jb_gene, l.cdr3b, l.cdr3b_nucseq )
-        else:
-            atcr = ( l.va_gene, l.ja_gene, l.cdr3a )#, l.cdr3a_nucseq )
-            btcr = ( l.vb_gene, l.jb_gene, l.cdr3b )#, l.cdr3b_nucseq )
-        tcr = ( atcr, btcr )
-        #tcr = ( atcr, btcr, l.clone_id ) # hack to guarantee uniqueness!!!
-        id2tcr[ l.clone_id ] = tcr
-        tcr2id[ tcr ] = l.clone_id
-
-    tcr2kpcs = {}
+    # one row per clone_id (the last one, if repeated), and an integer id for each
+    # distinct tcr (clones with the same tcr share the kpcs)
+    tcr_columns = 'va_gene ja_gene cdr3a cdr3a_nucseq vb_gene jb_gene cdr3b cdr3b_nucseq'\
+                  .split()
+    clones_df = clones_df.drop_duplicates('clone_id', keep='last')\
+                         .reset_index(drop=True)
+    clone_tcr_index = clones_df.groupby(tcr_columns, sort=False, dropna=False)\
+                               .ngroup().to_numpy()
+    clone_index = pd.Index(clones_df.clone_id)
+
     if not exists(kpca_file):
         if not allow_missing_kpca_file:
             print('ERROR: missing kpca_file:', kpca_file)
@@ -340,56 +468,48 @@ def read_dataset(
             print('WARNING: X_tcr_pca will be empty')
     else:
         missing_kpca_file = False
-        print('reading:',kpca_file)
-        lencheck= None
-        for line in open(kpca_file,'r'):
-            l = line.split()
-            assert l[0] == 'pc_comps:'
-            id = l[1]
-            kpcs = [float(x) for x in l[2:] if x!='nan' ]
-            if lencheck is None:
-                lencheck = len(kpcs)
-            else:
-                assert lencheck == len(kpcs)
-            tcr2kpcs[ id2tcr[id] ] = kpcs
-
+        kpca_ids, kpcs = read_tcrdist_kernel_pcs_file(kpca_file)
+        kpca_clones = clone_index.get_indexer(kpca_ids)
+        if np.any(kpca_clones<0):
+            print('ERROR: kpca_file has clone_ids that are not in the clones_file:',
+                  kpca_ids[kpca_clones<0][:10], kpca_file)
+            sys.exit(1)
+        # the last kpca row for each tcr
+        tcr2kpcs_row = np.full(len(clone_tcr_index), -1)
+        tcr2kpcs_row[clone_tcr_index[kpca_clones]] = np.arange(len(kpca_ids))
 
     # read the barcode/clonotype mapping info
-    barcode2kpcs = {}
-    barcode2tcr = {}
-
-    for line in open(bcmap_file,'r'):
-        l = line[:-1].split('\t')
-        if l[0] == 'clone_id': continue # header line
-        if not l[1]: continue
-        barcodes = l[1].split(',')
-        clone_id = l[0]
-        if clone_id not in id2tcr: continue # maybe short cdr3?
-        tcr = id2tcr[clone_id]
-        if not missing_kpca_file:
-            kpcs = tcr2kpcs[tcr]
-        for bc in barcodes:
-            barcode2tcr[ bc ] = tcr
-            if not missing_kpca_file:
-                barcode2kpcs[ bc ] = kpcs
-            assert bc in barcodes # the barcodes list before preprocessing...
-
-    mask = [ x in barcode2tcr for x in adata.obs.index ]
+    bcmap_barcodes, bcmap_clone_ids = read_barcode_mapping_file(bcmap_file)
+    bcmap_clones = clone_index.get_indexer(bcmap_clone_ids)
+    keep = bcmap_clones>=0 # maybe short cdr3?
+    barcode2clone = pd.Series(bcmap_clones[keep], index=bcmap_barcodes[keep])
+    barcode2clone = barcode2clone[~barcode2clone.index.duplicated(keep='last')]
+
+    cell_clones = barcode2clone.reindex(adata.obs.index).to_numpy()
+    mask = ~np.isnan(cell_clones)
 
     print(f'Reducing to the {np.sum(mask)} barcodes (out of {adata.shape[0]}) with paired TCR sequence data')
     assert not adata.isview
     #adata = adata[mask,:]
-    adata = adata[mask,:].copy()
-    assert not adata.isview
     if save_stats is not None:
-        save_stats['num_cells_w_tcr'] = adata.shape[0]
+        save_stats['num_cells_w_tcr'] = int(np.sum(mask))
+    if prefilter_min_genes is not None:
+        mask &= _prefilter_min_genes_mask(adata, prefilter_min_genes)
+    adata = load_backed_rows(adata, mask)
+    assert not adata.isview
+    cell_clones = cell_clones[mask].astype(int)
 
     if not missing_kpca_file: # stash the kPCA info in adata.obsm
-        X_kpca = np.array( [ barcode2kpcs[x] for x in adata.obs.index ] )
-        adata.obsm['X_pca_tcr'] = X_kpca
+        kpca_rows = tcr2kpcs_row[clone_tcr_index[cell_clones]]
+        if np.any(kpca_rows<0):
+            print('ERROR: kpca_file is missing clone_ids from the barcode mapping:',
+                  list(clones_df.clone_id[cell_clones[kpca_rows<0]].unique()[:10]),
+                  kpca_file)
+            sys.exit(1)
+        adata.obsm['X_pca_tcr'] = kpcs[kpca_rows]
 
-    tcrs = [ barcode2tcr[x] for x in adata.obs.index ]
-    store_tcrs_in_adata( adata, tcrs )
+    for tag, colname in zip(tcr_keys, tcr_columns):
+        adata.obs[tag] = clones_df[colname].to_numpy()[cell_clones]
 
     return adata
 
@@ -473,14 +593,15 @@ def filter_normalize_and_hvg(
 
 
     #filter n_genes and percent_mito based on param
+    # one copy for both filters
+    n_genes_mask = np.array(adata.obs['n_genes'] < n_genes)
+    percent_mito_mask = np.array(adata.obs['percent_mito'] < percent_mito)
     print('filtered out {} cells with more than {} genes'\
-          .format( np.sum( adata.obs['n_genes'] >= n_genes ), n_genes ) )
-    assert not adata.isview
-    adata = adata[adata.obs['n_genes'] < n_genes, :].copy()
+          .format( np.sum( ~n_genes_mask ), n_genes ) )
     assert not adata.isview
     print('filtered out {} cells with more than {} percent mito'\
-          .format( np.sum( adata.obs['percent_mito'] >= percent_mito ), percent_mito ) )
-    adata = adata[adata.obs['percent_mito'] < percent_mito, :].copy()
+          .format( np.sum( n_genes_mask & ~percent_mito_mask ), percent_mito ) )
+    adata = adata[n_genes_mask & percent_mito_mask, :].copy()
     assert not adata.isview
 
     adata.raw = adata
@@ -712,6 +833,7 @@ def reduce_to_single_cell_per_clone(
         n_pcs=50,
         average_clone_gex=False,
         use_existing_pca_obsm_tag=None,
+        max_medoid_block=4096, # limits the distance matrices for big clones
 ):
     ''' returns adata
 
@@ -752,17 +874,14 @@ def reduce_to_single_cell_per_clone(
     if 'pmhc_var_names' in adata.uns_keys():
         pmhc_var_names = adata.uns['pmhc_var_names']
         X_pmhc = pmhc_scoring._get_X_pmhc(adata, pmhc_var_names)
-        new_X_pmhc = []
     else:
         pmhc_var_names = None
 
     if 'batch_keys' in adata.uns_keys():
-        clone_batch_counts = {}
         num_batch_key_choices = {}
         batch_keys = adata.uns['batch_keys']
         for k in batch_keys:
             assert k in adata.obs_keys()
-            clone_batch_counts[k] = []
             assert np.min(adata.obs[k]) >= 0
             max_val = np.max(adata.obs[k])
             if max_val==0: # we need at least two choices for obsm
@@ -775,69 +894,82 @@ def reduce_to_single_cell_per_clone(
 
     clone_ids = np.array( [ tcr2clone_id[x] for x in tcrs_with_duplicates ] )
 
-    X_pca = adata.obsm[pca_tag]
-    clone_sizes = []
-    gex_var = []
-    batch_counts = []
-    rep_cell_indices = [] # parallel
-
-    ## only used if average_clone_gex is True
-    old_raw_X = adata.raw.X
-    new_X_rows = []
+    # indicator matrix: clone_indicator[c,i] = 1 if cell i is in clone c
+    # (as CSR, the indices for row c are the cells in clone c, in order)
+    num_cells = adata.shape[0]
+    clone_indicator = csr_matrix(
+        (np.ones((num_cells,), dtype=np.float32), (clone_ids, np.arange(num_cells))),
+        shape=(num_clones, num_cells))
+    clone_offsets, clone_cells_sorted = clone_indicator.indptr, clone_indicator.indices
+    clone_sizes = np.diff(clone_offsets).astype(int)
 
     ## for each clone (tcr) we pick a single representative cell, stored in rep_cell_indices
     ## rep_cell_indices is parallel with and aligned to the tcrs list
-    for c in range(num_clones):
-        if c%1000==0:
-            print('choose representative cell for clone:', c, num_clones, adata.shape)
+    X_pca = adata.obsm[pca_tag]
+    rep_cell_indices = clone_cells_sorted[clone_offsets[:-1]] # ok for singletons
+    gex_var = np.zeros((num_clones,))
+    big_clones = np.nonzero(clone_sizes>1)[0]
+    print(f'choose representative cells for {len(big_clones)} clones with more than',
+          f'one cell, out of {num_clones} clones', adata.shape)
+    for ii, c in enumerate(big_clones):
+        if ii%1000==0:
+            print('choose representative cell for clone:', ii, len(big_clones), adata.shape)
             sys.stdout.flush()
-        clone_mask = clone_ids==c
-        clone_cells = np.nonzero(clone_mask)[0] #array( [ x for x,y in enumerate(clone_ids) if y==c] )
-        clone_size = clone_cells.shape[0]
-        clone_sizes.append( clone_size )
-        if batch_keys is not None:
-            # store the distribution of this clone across the different batches
-            for k in batch_keys:
-                counts = Counter(adata.obs[k][clone_mask])
-                counts = [counts[x] for x in range(num_batch_key_choices[k]) ]
-                clone_batch_counts[k].append(counts)
-
-        if clone_size==1:
-            rep_cell_index = clone_cells[0]
-            gex_var.append(0.0)
-        else:
-            X_pca_clone = X_pca[ clone_cells, : ]
-            #print('X_pca_clone:',X_pca_clone.shape)
-            assert X_pca_clone.shape[0] == clone_size
+        clone_cells = clone_cells_sorted[clone_offsets[c]:clone_offsets[c+1]]
+        clone_size = int(clone_sizes[c])
+        X_pca_clone = X_pca[ clone_cells, : ]
+        # the medoid: min sum of distances to the other cells in the clone
+        # compute in blocks of rows for big clones
+        if clone_size <= max_medoid_block:
             D_gex_clone = pairwise_distances( X_pca_clone, X_pca_clone )
-            assert D_gex_clone.shape  == ( clone_size,clone_size )
             avgdist = D_gex_clone.sum(axis=1)
-            #print('min_avgdist', np.min(avgdist)/clone_size, clone_size, np.argmin(avgdist))
             rep_ind = np.argmin( avgdist )
-            rep_cell_index = clone_cells[rep_ind]
-            gex_var.append(np.sum(D_gex_clone[rep_ind,:]**2)/clone_size)
-        rep_cell_indices.append(rep_cell_index)
-        if average_clone_gex:
-            if clone_size == 1:
-                new_X_rows.append(old_raw_X[clone_cells[0],:])
-            else:
-                new_X_rows.append(
-                    csr_matrix(old_raw_X[clone_cells,:].sum(axis=0)/clone_size))
-                adata.X[rep_cell_index,:] = adata.X[clone_cells,:].sum(axis=0)/clone_size
-        if pmhc_var_names:
-            new_X_pmhc.append( np.sum( X_pmhc[clone_cells,:], axis=0 ) / clone_size )
+            D_rep = D_gex_clone[rep_ind,:]
+        else: # compute in blocks of rows for big clones
+            block_size = max(1, int(max_medoid_block**2 / clone_size))
+            avgdist = np.concatenate(
+                [pairwise_distances(X_pca_clone[start:start+block_size],
+                                    X_pca_clone).sum(axis=1)
+                 for start in range(0, clone_size, block_size)])
+            rep_ind = np.argmin( avgdist )
+            D_rep = pairwise_distances(X_pca_clone[rep_ind:rep_ind+1], X_pca_clone)
+        rep_cell_indices[c] = clone_cells[rep_ind]
+        gex_var[c] = np.sum(D_rep**2)/clone_size
 
-    rep_cell_indices = np.array(rep_cell_indices)
+    if batch_keys is not None:
+        # store the distribution of each clone across the different batches
+        clone_batch_counts = {}
+        for k in batch_keys:
+            vals = np.array(adata.obs[k]).astype(int)
+            clone_batch_counts[k] = np.bincount(
+                clone_ids * num_batch_key_choices[k] + vals,
+                minlength=num_clones*num_batch_key_choices[k])\
+                .reshape((num_clones, num_batch_key_choices[k]))
+
+    if average_clone_gex:
+        # sum over each clone with one sparse product, then divide by clone size
+        print('averaging the gex over the cells in each clone'); sys.stdout.flush()
+        new_X = clone_indicator.astype(adata.raw.X.dtype).dot(adata.raw.X).tocsr()
+        new_X.data /= np.repeat(clone_sizes, np.diff(new_X.indptr))
+        new_X.eliminate_zeros()
+        new_X_scaled = clone_indicator.astype(adata.X.dtype).dot(adata.X)
+        if issparse(new_X_scaled):
+            new_X_scaled = new_X_scaled.tocsr()
+            new_X_scaled.data /= np.repeat(clone_sizes, np.diff(new_X_scaled.indptr))
+        else:
+            new_X_scaled /= clone_sizes[:,np.newaxis]
+
+    if pmhc_var_names:
+        new_X_pmhc = clone_indicator.astype(X_pmhc.dtype).dot(X_pmhc)
+        new_X_pmhc /= clone_sizes[:,np.newaxis]
 
     print(f'reduce from {adata.shape[0]} cells to {len(rep_cell_indices)} cells (one per clonotype)')
     adata = adata[ rep_cell_indices, : ].copy() ## seems like we need to copy here, something to do with adata 'views'
-    adata.obs['clone_sizes'] = np.array( clone_sizes )
-    adata.obs['gex_variation'] = np.sqrt(np.array( gex_var ))
+    adata.obs['clone_sizes'] = clone_sizes
+    adata.obs['gex_variation'] = np.sqrt(gex_var)
 
     if average_clone_gex:
-        print('vstacking new_X_rows...'); sys.stdout.flush()
-        new_X = scipy.sparse.vstack(new_X_rows, format="csr")
-        print('DONE vstacking new_X_rows...'); sys.stdout.flush()
+        adata.X = new_X_scaled
         assert new_X.shape == (adata.shape[0], adata.raw.X.shape[1])
 
         adata_new = AnnData( X = new_X, obs = adata.obs, var = adata.raw.var )
@@ -847,13 +979,13 @@ def reduce_to_single_cell_per_clone(
 
     if batch_keys is not None:
         for k in batch_keys:
-            counts = np.array(clone_batch_counts[k])
+            counts = clone_batch_counts[k]
             assert counts.shape == (num_clones, num_batch_key_choices[k])
             adata.obsm[k] = counts
             print(f'storing clone batch info for key {k} with {num_batch_key_choices[k]} choices')
 
     if pmhc_var_names:
-        new_X_pmhc = np.array(new_X_pmhc)
+        new_X_pmhc = np.asarray(new_X_pmhc)
         assert new_X_pmhc.shape == ( num_clones, len(pmhc_var_names))
         adata.obsm['X_pmhc'] = new_X_pmhc
 
@@ -950,6 +1082,11 @@ def setup_tcr_groups( adata ):
     return setup_tcr_groups_for_tcrs(
         retrieve_tcrs_from_adata(adata, include_subject_id_if_present=True))
 
+def setup_tcr_group_index( adata ):
+    ''' returns a util.TcrGroupIndex for the agroups and bgroups of adata
+    '''
+    return util.TcrGroupIndex(*setup_tcr_groups(adata))
+
 def _calc_nndists( D, nbrs ):
     batch_size, num_nbrs = nbrs.shape
     assert D.shape[0] == batch_size
@@ -984,11 +1121,23 @@ def calc_nbrs_batched(
         target_N_for_batching = 8192,
         use_exact_tcrdist_nbrs = False,
         tmpfile_prefix = None, # only used if use_exact_tcrdist_nbrs and CPP
+        multires = False, # slice all nbr_fracs from one sorted nbr list
+        n_jobs = 1, # run the batches in this many processes (-1 for all the cores)
+        distance_kernel = 'cdist', # or 'float32', see _make_distance_rows_function
 ):
     ''' returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
 
     nbrs exclude self and any clones in same atcr group or btcr group
+
+    with n_jobs>1 the batches are run in a process pool that shares the PCA
+    coordinates and the output arrays; the results are identical to n_jobs=1
     '''
+    if multires: ## EARLY RETURN
+        return _calc_nbrs_multires(
+            adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
+            nbr_frac_for_nndists, target_N_for_batching, use_exact_tcrdist_nbrs,
+            tmpfile_prefix, distance_kernel=distance_kernel, n_jobs=n_jobs)
+
     if also_calc_nndists:
         assert nbr_frac_for_nndists in nbr_fracs
 
@@ -1001,7 +1150,7 @@ def calc_nbrs_batched(
     batch_size = max(10, int(target_N_for_batching**2/N))
     num_batches = (N-1)//batch_size + 1
 
-    agroups, bgroups = setup_tcr_groups(adata)
+    group_index = setup_tcr_group_index(adata)
 
     all_nbrs = {}
     for nbr_frac in nbr_fracs:
@@ -1016,43 +1165,41 @@ def calc_nbrs_batched(
             print(f'allocated {all_nbrs[nbr_frac][-1].nbytes} bytes memory id=',
                   id(all_nbrs[nbr_frac][-1]))
 
-    nndists = [ [], [] ]
-
-    for bb in range(num_batches):
-        b_start = bb*batch_size
-        b_stop = min(N, (bb+1)*batch_size)
-        batch_indices = np.arange(b_start, b_stop)
+    nndists = [ None, None ]
+    if also_calc_nndists:
+        for itag, obsm_tag in enumerate([obsm_tag_gex, obsm_tag_tcr]):
+            if obsm_tag is not None:
+                nndists[itag] = np.zeros((N,))
+
+    n_jobs = (os.cpu_count() or 1) if n_jobs == -1 else max(1, n_jobs)
+    if n_jobs > 1 and num_batches > 1:
+        # batches are independent, run them in a process pool with shared memory
+        _calc_nbrs_batches_in_parallel(
+            adata, [obsm_tag_gex, obsm_tag_tcr], group_index, batch_size, nbr_fracs,
+            nbr_frac_for_nndists if also_calc_nndists else None, all_nbrs, nndists,
+            n_jobs, distance_kernel)
+    else:
+        get_distance_rows = [
+            None if obsm_tag is None else
+            _make_distance_rows_function(adata.obsm[obsm_tag], distance_kernel,
+                                         batch_size)
+            for obsm_tag in [obsm_tag_gex, obsm_tag_tcr]]
+        for bb in range(num_batches):
+            b_start = bb*batch_size
+            b_stop = min(N, (bb+1)*batch_size)
 
-        for itag, (tag, obsm_tag) in enumerate( [['gex', obsm_tag_gex],
-                                                 ['tcr', obsm_tag_tcr]] ):
-            if obsm_tag is None:
-                print('skipping nbr calc for', tag, obsm_tag)
-                continue
-            print(f'compute D {tag} batch= {bb} num_batches= {num_batches}',
-                  f'N= {N} batch_size= {batch_size}')
-            X = adata.obsm[obsm_tag]
-            D = cdist( X[b_start:b_stop, :], X )
-
-            # note that a clonotype is not included in its own neighbors:
-            # nor will it be nbrs with any clonotypes having an identical nucleotide
-            # sequence tcr chain (to be conservative about bad clonotype definitions)
-            for ii in batch_indices:
-                D[ii-b_start, (agroups==agroups[ii]) ] = 1e3
-                D[ii-b_start, (bgroups==bgroups[ii]) ] = 1e3
-
-            for nbr_frac in nbr_fracs:
-                num_neighbors = max(1, int(nbr_frac*N))
-                print(f'argpartitions: {tag} batch= {bb} nbr_frac= {nbr_frac}')
-                full_nbrs = all_nbrs[nbr_frac][itag]
-                full_nbrs[b_start:b_stop,:] = np.argpartition(
-                    D, num_neighbors-1 )[:,:num_neighbors]
-                #print(f'full_nbrs_id {nbr_frac} {id(full_nbrs)}')
-                #assert nbrs.shape == (D.shape[0], num_neighbors)
-                #all_nbrs[nbr_frac][itag].append(nbrs)
-
-                if also_calc_nndists and nbr_frac == nbr_frac_for_nndists:
-                    nndists[itag].append(
-                        _calc_nndists(D, full_nbrs[b_start:b_stop,:]))
+            for itag, (tag, obsm_tag) in enumerate( [['gex', obsm_tag_gex],
+                                                     ['tcr', obsm_tag_tcr]] ):
+                if obsm_tag is None:
+                    print('skipping nbr calc for', tag, obsm_tag)
+                    continue
+                print(f'compute D {tag} batch= {bb} num_batches= {num_batches}',
+                      f'N= {N} batch_size= {batch_size}')
+                _calc_nbrs_for_batch(
+                    get_distance_rows[itag], N, group_index, b_start, b_stop, nbr_fracs,
+                    dict((x, all_nbrs[x][itag]) for x in nbr_fracs),
+                    nbr_frac_for_nndists if also_calc_nndists else None,
+                    nndists[itag])
 
 
     # for nbr_frac in nbr_fracs:
@@ -1069,15 +1216,435 @@ def calc_nbrs_batched(
         nndists[1] = tcr_nndists
 
     if also_calc_nndists:
-        nndists_gex = np.hstack(nndists[0])
-        nndists_tcr = nndists[1] if use_exact_tcrdist_nbrs else \
-                      None if obsm_tag_tcr is None else \
-                      np.hstack(nndists[1])
-
-        return all_nbrs, nndists_gex, nndists_tcr
+        return all_nbrs, nndists[0], nndists[1]
     else:
         return all_nbrs
 
+def _make_distance_rows_function(
+        X,
+        distance_kernel,
+        max_batch_size,
+):
+    ''' returns get_distance_rows(start, stop), the Euclidean distances from rows
+    [start,stop) of X to all of X
+
+    distance_kernel is 'cdist' (scipy, float64) or 'float32', which uses a single
+    float32 matrix multiply per batch and a reused output buffer (see
+    util.Float32DistanceKernel); much faster, and accurate enough for ranking nbrs,
+    but the returned block is overwritten by the next call
+    '''
+    if distance_kernel == 'cdist':
+        return lambda start, stop: cdist(X[start:stop], X)
+    elif distance_kernel == 'float32':
+        return util.Float32DistanceKernel(X, max_batch_size).distances
+    else:
+        print('conga.preprocess:: unrecognized distance_kernel:', distance_kernel)
+        exit(1)
+
+def _calc_nbrs_for_batch(
+        get_distance_rows, # see _make_distance_rows_function
+        N,
+        group_index,
+        b_start,
+        b_stop,
+        nbr_fracs,
+        out_nbrs, # dict from nbr_frac to (N, num_neighbors) array
+        nbr_frac_for_nndists = None,
+        out_nndists = None, # (N,) array
+):
+    ''' nbrs (and nndists) for rows [b_start, b_stop), written into out_nbrs
+    and out_nndists. Used by calc_nbrs_batched, serial or in worker processes
+    '''
+    D = get_distance_rows(b_start, b_stop)
+
+    # note that a clonotype is not included in its own neighbors:
+    # nor will it be nbrs with any clonotypes having an identical nucleotide
+    # sequence tcr chain (to be conservative about bad clonotype definitions)
+    group_index.set_excluded(D, np.arange(b_start, b_stop))
+
+    for nbr_frac in nbr_fracs:
+        num_neighbors = max(1, int(nbr_frac*N))
+        full_nbrs = out_nbrs[nbr_frac]
+        full_nbrs[b_start:b_stop,:] = np.argpartition(
+            D, num_neighbors-1 )[:,:num_neighbors]
+
+        if nbr_frac == nbr_frac_for_nndists:
+            out_nndists[b_start:b_stop] = _calc_nndists(
+                D, full_nbrs[b_start:b_stop,:])
+
+# state for the calc_nbrs_batched worker processes, set by _init_nbrs_worker
+_nbrs_worker_state = {}
+
+def _init_nbrs_worker(
+        shared_specs,
+        nbr_fracs,
+        nbr_frac_for_nndists,
+        distance_kernel,
+        batch_size,
+):
+    ''' shared_specs maps from a name to (shm_name, shape, dtype)
+    '''
+    arrays, shms = {}, []
+    for name, spec in shared_specs.items():
+        shm, arrays[name] = util.attach_shared_array(*spec)
+        shms.append(shm) # keep these alive
+    _nbrs_worker_state.update(
+        arrays = arrays,
+        shms = shms,
+        group_index = util.TcrGroupIndex(arrays['agroups'], arrays['bgroups']),
+        nbr_fracs = nbr_fracs,
+        nbr_frac_for_nndists = nbr_frac_for_nndists,
+        get_distance_rows = dict(
+            (int(name[2:]), _make_distance_rows_function(
+                array, distance_kernel, batch_size))
+            for name, array in arrays.items() if name.startswith('X_')),
+    )
+
+def _run_sorted_knn_worker_batch(task):
+    b_start, b_stop = task
+    state = _nbrs_worker_state
+    arrays = state['arrays']
+    _calc_sorted_knn_for_batch(
+        state['get_distance_rows'][0], state['group_index'], b_start, b_stop,
+        arrays['knn_indices'], arrays['knn_distances'])
+    return task
+
+def _run_nbrs_worker_batch(task):
+    itag, b_start, b_stop = task
+    state = _nbrs_worker_state
+    arrays = state['arrays']
+    out_nbrs = dict((x, arrays[f'nbrs_{itag}_{ii}'])
+                    for ii, x in enumerate(state['nbr_fracs']))
+    _calc_nbrs_for_batch(
+        state['get_distance_rows'][itag], arrays[f'X_{itag}'].shape[0],
+        state['group_index'], b_start, b_stop,
+        state['nbr_fracs'], out_nbrs, state['nbr_frac_for_nndists'],
+        arrays.get(f'nndists_{itag}'))
+    return task
+
+def _calc_nbrs_batches_in_parallel(
+        adata,
+        obsm_tags, # [obsm_tag_gex, obsm_tag_tcr]
+        group_index,
+        batch_size,
+        nbr_fracs,
+        nbr_frac_for_nndists, # None to skip nndists
+        all_nbrs, # filled in
+        nndists, # [nndists_gex, nndists_tcr], filled in
+        n_jobs,
+        distance_kernel = 'cdist',
+):
+    ''' Run the batches of calc_nbrs_batched in a pool of n_jobs processes
+
+    The PCA coordinates, agroups/bgroups and the output nbrs and nndists arrays are
+    put in shared memory, so the workers fill in the results in place. Each batch
+    does exactly the same calculation as in the serial path
+    '''
+    import multiprocessing
+    N = adata.shape[0]
+    shms, specs, outputs = [], {}, []
+    def share(name, values=None, shape=None, dtype=None):
+        shape = values.shape if shape is None else shape
+        dtype = values.dtype if dtype is None else dtype
+        shm, array = util.create_shared_array(shape, dtype, values)
+        shms.append(shm)
+        specs[name] = (shm.name, shape, np.dtype(dtype).str)
+        return array
+
+    try:
+        share('agroups', group_index.agroups)
+        share('bgroups', group_index.bgroups)
+        tasks = []
+        for itag, obsm_tag in enumerate(obsm_tags):
+            if obsm_tag is None:
+                continue
+            share(f'X_{itag}', np.ascontiguousarray(adata.obsm[obsm_tag]))
+            for ii, nbr_frac in enumerate(nbr_fracs):
+                outputs.append((all_nbrs[nbr_frac][itag], share(
+                    f'nbrs_{itag}_{ii}', shape=all_nbrs[nbr_frac][itag].shape,
+                    dtype=np.int32)))
+            if nbr_frac_for_nndists is not None:
+                outputs.append((nndists[itag], share(
+                    f'nndists_{itag}', shape=(N,), dtype=np.float64)))
+            tasks.extend((itag, b_start, min(N, b_start+batch_size))
+                         for b_start in range(0, N, batch_size))
+
+        print(f'calc_nbrs_batched: running {len(tasks)} batches with',
+              f'n_jobs= {n_jobs}')
+        with multiprocessing.Pool(
+                n_jobs, initializer=_init_nbrs_worker,
+                initargs=(specs, nbr_fracs, nbr_frac_for_nndists, distance_kernel,
+                          batch_size)) as pool:
+            for itag, b_start, b_stop in pool.imap_unordered(
+                    _run_nbrs_worker_batch, tasks):
+                print(f'calc_nbrs_batched: finished batch {itag} {b_start} {b_stop}')
+
+        for result, shared in outputs:
+            result[...] = shared
+    finally:
+        outputs = None # drop the views so the shared memory can be closed
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+def _calc_nndists_from_sorted_dists( dists ):
+    ''' nndists from the (N, num_nbrs) array of sorted nbr distances
+    '''
+    num_nbrs = dists.shape[1]
+    wts = np.linspace(1.0, 1.0/num_nbrs, num_nbrs)
+    wts /= np.sum(wts)
+    return np.sum( dists * wts[np.newaxis,:], axis=1)
+
+def _calc_sorted_knn_from_distance_rows(
+        get_distance_rows,
+        N,
+        num_nbrs,
+        group_index,
+        batch_size,
+):
+    ''' get_distance_rows(start, stop) returns rows [start,stop) of the N x N
+    distance matrix, group_index is a util.TcrGroupIndex
+
+    returns knn_indices (int32), knn_distances (float32), both (N, num_nbrs) and
+    sorted by increasing distance. Same-agroup and same-bgroup clones are excluded
+    (distance set to 1e3) like in calc_nbrs
+    '''
+    knn_indices = np.zeros((N, num_nbrs), dtype=np.int32)
+    knn_distances = np.zeros((N, num_nbrs), dtype=np.float32)
+    for b_start in range(0, N, batch_size):
+        _calc_sorted_knn_for_batch(
+            get_distance_rows, group_index, b_start, min(N, b_start+batch_size),
+            knn_indices, knn_distances)
+    return knn_indices, knn_distances
+
+def _calc_sorted_knn_for_batch(
+        get_distance_rows,
+        group_index,
+        b_start,
+        b_stop,
+        knn_indices, # (N, num_nbrs) array, filled in
+        knn_distances, # ditto
+):
+    ''' sorted nbrs for rows [b_start, b_stop), see _calc_sorted_knn_from_distance_rows.
+    Used serially or in worker processes
+    '''
+    num_nbrs = knn_indices.shape[1]
+    D = get_distance_rows(b_start, b_stop)
+    group_index.set_excluded(D, np.arange(b_start, b_stop))
+    inds = np.argpartition(D, num_nbrs-1)[:,:num_nbrs]
+    dists = np.take_along_axis(D, inds, axis=1)
+    order = np.argsort(dists, axis=1, kind='stable')
+    knn_indices[b_start:b_stop] = np.take_along_axis(inds, order, axis=1)
+    knn_distances[b_start:b_stop] = np.take_along_axis(dists, order, axis=1)
+
+def _calc_sorted_knn_in_parallel(
+        X,
+        num_nbrs,
+        group_index,
+        batch_size,
+        n_jobs,
+        distance_kernel = 'cdist',
+):
+    ''' _calc_sorted_knn_from_distance_rows for the Euclidean distances between the
+    rows of X, with the batches run in a pool of n_jobs processes that share X and
+    the outputs (like _calc_nbrs_batches_in_parallel). Same results as serial
+    '''
+    import multiprocessing
+    N = X.shape[0]
+    shms, specs = [], {}
+    def share(name, values=None, shape=None, dtype=None):
+        shape = values.shape if shape is None else shape
+        dtype = values.dtype if dtype is None else dtype
+        shm, array = util.create_shared_array(shape, dtype, values)
+        shms.append(shm)
+        specs[name] = (shm.name, shape, np.dtype(dtype).str)
+        return array
+
+    try:
+        share('agroups', group_index.agroups)
+        share('bgroups', group_index.bgroups)
+        share('X_0', np.ascontiguousarray(X))
+        shared_indices = share('knn_indices', shape=(N, num_nbrs), dtype=np.int32)
+        shared_distances = share('knn_distances', shape=(N, num_nbrs), dtype=np.float32)
+        tasks = [(b_start, min(N, b_start+batch_size))
+                 for b_start in range(0, N, batch_size)]
+        print(f'calc_nbr_store: running {len(tasks)} batches with n_jobs= {n_jobs}')
+        with multiprocessing.Pool(
+                n_jobs, initializer=_init_nbrs_worker,
+                initargs=(specs, None, None, distance_kernel, batch_size)) as pool:
+            for _ in pool.imap_unordered(_run_sorted_knn_worker_batch, tasks):
+                pass
+        knn_indices, knn_distances = shared_indices.copy(), shared_distances.copy()
+    finally:
+        shared_indices, shared_distances = None, None # so the memory can be closed
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return knn_indices, knn_distances
+
+def calc_nbr_store(
+        adata,
+        max_nbr_frac,
+        obsm_tag_gex = 'X_pca_gex',
+        obsm_tag_tcr = 'X_pca_tcr', # set to None to skip tcr calc
+        target_N_for_batching = 8192,
+        use_exact_tcrdist_nbrs = False,
+        tmpfile_prefix = None, # only used if use_exact_tcrdist_nbrs and CPP
+        nbr_backend = 'exact', # or 'ivf' for approximate nbrs, see conga.approx_nbrs
+        approx_candidate_factor = 4.0, # only used if nbr_backend=='ivf'
+        approx_min_recall = 0.9, # ivf falls back to exact below this estimated recall
+        distance_kernel = 'cdist', # or 'float32', see _make_distance_rows_function
+        n_jobs = 1, # processes for the exact batches (-1 for all the cores)
+):
+    ''' The multi-resolution nbr store: the top k_max nbrs of each clone, sorted by
+    increasing distance, where k_max = max(1, int(max_nbr_frac*N))
+
+    returns nbr_store = {'gex': [knn_indices, knn_distances], 'tcr': [...]}
+    ([None, None] for skipped tags)
+
+    The nbrs for any nbr_frac <= max_nbr_frac, and the nndists, are just slices,
+    see nbrs_from_nbr_store. The distances are only computed once, in batches of
+    rows (like calc_nbrs_batched), and only the top k_max are partitioned and sorted.
+    Use save_nbr_info_to_adata to stash it in the adata.
+
+    nbrs exclude self and any clones in same atcr group or btcr group
+    '''
+    N = adata.shape[0]
+    num_nbrs = min(N-1, max(1, int(max_nbr_frac*N)))
+    batch_size = max(10, int(target_N_for_batching**2/N))
+    agroups, bgroups = setup_tcr_groups(adata)
+    group_index = util.TcrGroupIndex(agroups, bgroups)
+    n_jobs = (os.cpu_count() or 1) if n_jobs == -1 else max(1, n_jobs)
+    if n_jobs > 1 and nbr_backend == 'ivf':
+        print('conga.preprocess.calc_nbr_store:: n_jobs is ignored with',
+              "nbr_backend='ivf'")
+
+    nbr_store = {}
+    for tag, obsm_tag in [['gex', obsm_tag_gex], ['tcr', obsm_tag_tcr]]:
+        if tag == 'tcr' and use_exact_tcrdist_nbrs:
+            print('compute sorted tcrdist nbrs', N, num_nbrs)
+            if util.tcrdist_cpp_lib_available() or util.tcrdist_cpp_available():
+                knn_indices, knn_distances = _calc_tcrdist_knn_cpp(
+                    adata, agroups, bgroups, num_nbrs, tmpfile_prefix)
+                order = np.argsort(knn_distances, axis=1, kind='stable')
+                knn_indices = np.take_along_axis(knn_indices, order, axis=1)
+                knn_distances = np.take_along_axis(knn_distances, order, axis=1)
+            else:
+                tcrs = retrieve_tcrs_from_adata(adata)
+                organism = adata.uns['organism']
+                knn_indices, knn_distances = _calc_sorted_knn_from_distance_rows(
+                    lambda start, stop: calc_tcrdist_matrix_rectangular(
+                        tcrs[start:stop], tcrs, organism),
+                    N, num_nbrs, group_index, batch_size)
+            nbr_store[tag] = [knn_indices.astype(np.int32, copy=False),
+                              knn_distances.astype(np.float32, copy=False)]
+        elif obsm_tag is None:
+            print('skipping', tag, 'nbr calc:', obsm_tag)
+            nbr_store[tag] = [None, None]
+        elif nbr_backend == 'ivf':
+            print('compute approx nbrs', tag, N, num_nbrs)
+            nbr_store[tag] = list(approx_nbrs.find_approx_nbrs(
+                adata.obsm[obsm_tag], num_nbrs, agroups, bgroups,
+                candidate_factor=approx_candidate_factor,
+                min_recall=approx_min_recall,
+                target_N_for_batching=target_N_for_batching))
+        elif n_jobs > 1 and N > batch_size:
+            print('compute sorted nbrs', tag, N, num_nbrs, 'batch_size=', batch_size)
+            nbr_store[tag] = list(_calc_sorted_knn_in_parallel(
+                adata.obsm[obsm_tag], num_nbrs, group_index, batch_size, n_jobs,
+                distance_kernel))
+        else:
+            print('compute sorted nbrs', tag, N, num_nbrs, 'batch_size=', batch_size)
+            nbr_store[tag] = list(_calc_sorted_knn_from_distance_rows(
+                _make_distance_rows_function(
+                    adata.obsm[obsm_tag], distance_kernel, batch_size),
+                N, num_nbrs, group_index, batch_size))
+    return nbr_store
+
+def nbrs_from_nbr_store(
+        nbr_store,
+        nbr_fracs,
+        nbr_frac_for_nndists = None, # if not None, calculate nndists at this nbr fraction
+):
+    ''' Slice the nbrs for each nbr_frac (and the nndists) out of an nbr_store, see
+    calc_nbr_store
+
+    returns all_nbrs, nndists_gex, nndists_tcr
+
+    all_nbrs is a dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
+
+    nndists are None if nbr_frac_for_nndists is None (or the tag was skipped)
+    '''
+    all_nbrs = {}
+    for nbr_frac in nbr_fracs:
+        all_nbrs[nbr_frac] = [ None, None ]
+    nndists = [ None, None ]
+
+    for itag, tag in enumerate(['gex', 'tcr']):
+        knn_indices, knn_distances = nbr_store[tag]
+        if knn_indices is None:
+            continue
+        N, max_num_nbrs = knn_indices.shape
+        for nbr_frac in nbr_fracs:
+            num_neighbors = max(1, int(nbr_frac*N))
+            if num_neighbors > max_num_nbrs:
+                print('conga.preprocess.nbrs_from_nbr_store:: nbr_frac too big:',
+                      nbr_frac, num_neighbors, max_num_nbrs)
+                exit(1)
+            all_nbrs[nbr_frac][itag] = (
+                knn_indices if num_neighbors == max_num_nbrs else
+                np.ascontiguousarray(knn_indices[:,:num_neighbors]))
+
+        if nbr_frac_for_nndists is not None:
+            num_neighbors = max(1, int(nbr_frac_for_nndists*N))
+            assert num_neighbors <= max_num_nbrs
+            nndists[itag] = _calc_nndists_from_sorted_dists(
+                knn_distances[:,:num_neighbors])
+
+    return all_nbrs, nndists[0], nndists[1]
+
+def _calc_nbrs_multires(
+        adata,
+        nbr_fracs,
+        obsm_tag_gex,
+        obsm_tag_tcr,
+        also_calc_nndists,
+        nbr_frac_for_nndists,
+        target_N_for_batching,
+        use_exact_tcrdist_nbrs,
+        tmpfile_prefix,
+        nbr_backend = 'exact',
+        approx_candidate_factor = 4.0,
+        approx_min_recall = 0.9,
+        return_nbr_store = False,
+        distance_kernel = 'cdist',
+        nbr_store_headroom = 1.0,
+        n_jobs = 1,
+):
+    ''' calc_nbrs from a single nbr_store, see calc_nbr_store
+    '''
+    if also_calc_nndists:
+        assert nbr_frac_for_nndists in nbr_fracs
+
+    nbr_store = calc_nbr_store(
+        adata, max(nbr_fracs)*nbr_store_headroom, obsm_tag_gex, obsm_tag_tcr, target_N_for_batching,
+        use_exact_tcrdist_nbrs=use_exact_tcrdist_nbrs, tmpfile_prefix=tmpfile_prefix,
+        nbr_backend=nbr_backend, approx_candidate_factor=approx_candidate_factor,
+        approx_min_recall=approx_min_recall, distance_kernel=distance_kernel,
+        n_jobs=n_jobs)
+
+    all_nbrs, nndists_gex, nndists_tcr = nbrs_from_nbr_store(
+        nbr_store, nbr_fracs,
+        nbr_frac_for_nndists if also_calc_nndists else None)
+
+    retval = [all_nbrs]
+    if also_calc_nndists:
+        retval.extend([nndists_gex, nndists_tcr])
+    if return_nbr_store:
+        retval.append(nbr_store)
+    return retval[0] if len(retval)==1 else tuple(retval)
+
 
 def calc_nbrs(
         adata,
@@ -1089,17 +1656,54 @@ def calc_nbrs(
         target_N_for_batching = 8192,
         use_exact_tcrdist_nbrs = False,
         tmpfile_prefix = None, # only used if use_exact_tcrdist_nbrs and CPP
+        nbr_backend = 'exact', # or 'ivf' for approximate nbrs, see conga.approx_nbrs
+        approx_candidate_factor = 4.0, # only used if nbr_backend=='ivf'
+        approx_min_recall = 0.9, # ivf falls back to exact below this estimated recall
+        multires = False, # slice all nbr_fracs from one sorted nbr list
+        return_nbr_store = False, # implies multires
+        n_jobs = 1, # processes for the batched calculation, see calc_nbrs_batched and calc_nbr_store
+        distance_kernel = 'cdist', # or 'float32', see _make_distance_rows_function
+        nbr_store_headroom = 1.0, # keep this times more nbrs in the nbr_store
 ):
     ''' returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
 
+    if also_calc_nndists, returns all_nbrs, nndists_gex, nndists_tcr
+
+    if multires, the top nbrs for max(nbr_fracs) are computed and sorted once and
+    the smaller nbr_fracs and the nndists are slices (see calc_nbr_store). If
+    return_nbr_store, that nbr_store is appended to the return values, and can be
+    saved with save_nbr_info_to_adata to get other nbr_fracs later without
+    recomputing distances, or updated when clones are added (see update_nbrs; a
+    nbr_store_headroom > 1 leaves room for the nbr counts to grow with N).
+    nbr_backend 'ivf' always goes this way.
+
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
+    if nbr_backend not in ['exact', 'ivf']:
+        print('conga.preprocess.calc_nbrs:: unrecognized nbr_backend:', nbr_backend)
+        exit(1)
+
+    if multires or return_nbr_store or nbr_backend == 'ivf': ## EARLY RETURN
+        return _calc_nbrs_multires(
+            adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
+            nbr_frac_for_nndists, target_N_for_batching, use_exact_tcrdist_nbrs,
+            tmpfile_prefix, nbr_backend=nbr_backend,
+            approx_candidate_factor=approx_candidate_factor,
+            approx_min_recall=approx_min_recall,
+            return_nbr_store=return_nbr_store, distance_kernel=distance_kernel,
+            nbr_store_headroom=nbr_store_headroom, n_jobs=n_jobs)
+
     if adata.shape[0] > 1.25*target_N_for_batching: ## EARLY RETURN
         return calc_nbrs_batched(
             adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
             nbr_frac_for_nndists, target_N_for_batching,
             use_exact_tcrdist_nbrs=use_exact_tcrdist_nbrs,
-            tmpfile_prefix=tmpfile_prefix)
+            tmpfile_prefix=tmpfile_prefix, n_jobs=n_jobs,
+            distance_kernel=distance_kernel)
+
+    if n_jobs != 1:
+        print(f'conga.preprocess.calc_nbrs:: N= {adata.shape[0]} is small enough',
+              'to do in one batch, n_jobs is ignored')
 
     if also_calc_nndists:
         assert nbr_frac_for_nndists in nbr_fracs
@@ -1112,17 +1716,20 @@ def calc_nbrs(
         all_nbrs[nbr_frac] = [ None, None ]
     nndists = [ None, None ]
 
-    agroups, bgroups = setup_tcr_groups(adata)
+    group_index = setup_tcr_group_index(adata)
     for itag, (tag, obsm_tag) in enumerate([['gex', obsm_tag_gex], ['tcr', obsm_tag_tcr]]):
         if obsm_tag is None:
             print('skipping', tag, 'nbr calc:', obsm_tag)
             continue
 
         print('compute D', tag, adata.shape[0])
-        D = pairwise_distances( adata.obsm[obsm_tag], metric='euclidean' )
-        for ii,(a,b) in enumerate(zip(agroups, bgroups)):
-            D[ii, (agroups==a) ] = 1e3
-            D[ii, (bgroups==b) ] = 1e3
+        if distance_kernel == 'cdist':
+            D = pairwise_distances( adata.obsm[obsm_tag], metric='euclidean' )
+        else:
+            D = _make_distance_rows_function(
+                adata.obsm[obsm_tag], distance_kernel, adata.shape[0])(
+                    0, adata.shape[0])
+        group_index.set_excluded(D, np.arange(adata.shape[0]))
 
         for nbr_frac in nbr_fracs:
             num_neighbors = max(1, int(nbr_frac*adata.shape[0]))
@@ -1152,6 +1759,159 @@ def calc_nbrs(
         return all_nbrs
 
 
+def _merge_sorted_nbrs( indices, distances, new_indices, new_distances, num_nbrs ):
+    ''' returns the top num_nbrs of the two sets of candidate nbrs (same rows),
+    sorted by increasing distance
+    '''
+    indices = np.hstack([indices, new_indices])
+    distances = np.hstack([distances, new_distances])
+    inds = np.argpartition(distances, num_nbrs-1, axis=1)[:,:num_nbrs]
+    dists = np.take_along_axis(distances, inds, axis=1)
+    order = np.argsort(dists, axis=1, kind='stable')
+    return (np.take_along_axis(np.take_along_axis(indices, inds, axis=1), order, axis=1),
+            np.take_along_axis(dists, order, axis=1))
+
+def update_nbr_store(
+        adata,
+        nbr_store,
+        num_old_clones,
+        obsm_tag_gex = 'X_pca_gex',
+        obsm_tag_tcr = 'X_pca_tcr', # set to None to skip tcr calc
+        target_N_for_batching = 8192,
+        use_exact_tcrdist_nbrs = False,
+        num_nbrs = None, # default is the nbr_store width
+):
+    ''' Update an nbr_store computed for the first num_old_clones clones of adata
+    (see calc_nbr_store) to cover all of adata, where the new clones were appended
+    at the end and the old clones' embeddings have not changed (e.g. TCR kPCs
+    projected with make_tcrdist_kernel_pcs_file_from_model)
+
+    Only the new-vs-all distances are computed, O(N_new * N) rather than O(N^2).
+    The old clones' stored nbrs are merged with their distances to the new clones,
+    which is exact as long as num_nbrs is no bigger than the stored width
+    (otherwise print an error and exit; use calc_nbr_store with a bigger
+    max_nbr_frac, or calc_nbrs with nbr_store_headroom>1, for room to grow).
+
+    returns the new nbr_store, with num_nbrs nbrs per clone
+    '''
+    N = adata.shape[0]
+    num_new_clones = N - num_old_clones
+    assert num_new_clones >= 0
+    batch_size = max(10, int(target_N_for_batching**2/max(1, num_new_clones)))
+    agroups, bgroups = setup_tcr_groups(adata)
+    group_index = util.TcrGroupIndex(agroups, bgroups)
+    old_rows, new_rows = np.arange(num_old_clones), np.arange(num_old_clones, N)
+
+    new_nbr_store = {}
+    for tag, obsm_tag in [['gex', obsm_tag_gex], ['tcr', obsm_tag_tcr]]:
+        indices, distances = nbr_store[tag]
+        if indices is None or (obsm_tag is None and not
+                               (tag == 'tcr' and use_exact_tcrdist_nbrs)):
+            print('skipping', tag, 'nbr update:', obsm_tag)
+            new_nbr_store[tag] = [None, None]
+            continue
+        assert indices.shape[0] == num_old_clones
+        tag_num_nbrs = min(N-1, indices.shape[1] if num_nbrs is None else num_nbrs)
+        if tag_num_nbrs > indices.shape[1]:
+            print('conga.preprocess.update_nbr_store:: num_nbrs too big for the',
+                  'stored nbrs:', tag, tag_num_nbrs, indices.shape[1])
+            exit(1)
+
+        if tag == 'tcr' and use_exact_tcrdist_nbrs:
+            tcrs = retrieve_tcrs_from_adata(adata)
+            organism = adata.uns['organism']
+            get_distances = lambda rows, cols: calc_tcrdist_matrix_rectangular(
+                [tcrs[x] for x in rows], [tcrs[x] for x in cols], organism)
+        else:
+            X = adata.obsm[obsm_tag]
+            get_distances = lambda rows, cols: cdist(X[rows], X[cols])
+
+        print(f'update nbrs {tag} num_old_clones= {num_old_clones}',
+              f'num_new_clones= {num_new_clones} num_nbrs= {tag_num_nbrs}')
+        new_indices = np.zeros((N, tag_num_nbrs), dtype=np.int32)
+        new_distances = np.zeros((N, tag_num_nbrs), dtype=np.float32)
+
+        # old clones: merge in the new clones
+        for b_start in range(0, num_old_clones, batch_size):
+            b_rows = old_rows[b_start:b_start+batch_size]
+            D = np.array(get_distances(b_rows, new_rows), dtype=np.float32)
+            row_pos, cols = group_index.excluded_pairs(b_rows)
+            mask = cols >= num_old_clones
+            D[row_pos[mask], cols[mask]-num_old_clones] = 1e3
+            inds, dists = _merge_sorted_nbrs(
+                indices[b_rows], distances[b_rows],
+                np.broadcast_to(new_rows, D.shape), D, tag_num_nbrs)
+            new_indices[b_rows], new_distances[b_rows] = inds, dists
+
+        # new clones: distances to everybody
+        all_rows = np.arange(N)
+        for b_start in range(0, num_new_clones, batch_size):
+            b_rows = new_rows[b_start:b_start+batch_size]
+            D = np.array(get_distances(b_rows, all_rows), dtype=np.float32)
+            group_index.set_excluded(D, b_rows)
+            inds = np.argpartition(D, tag_num_nbrs-1)[:,:tag_num_nbrs]
+            dists = np.take_along_axis(D, inds, axis=1)
+            order = np.argsort(dists, axis=1, kind='stable')
+            new_indices[b_rows] = np.take_along_axis(inds, order, axis=1)
+            new_distances[b_rows] = np.take_along_axis(dists, order, axis=1)
+
+        new_nbr_store[tag] = [new_indices, new_distances]
+    return new_nbr_store
+
+def update_nbrs(
+        adata,
+        nbr_store,
+        num_old_clones,
+        nbr_fracs,
+        obsm_tag_gex = 'X_pca_gex',
+        obsm_tag_tcr = 'X_pca_tcr', # set to None to skip tcr calc
+        also_calc_nndists = False,
+        nbr_frac_for_nndists = None,
+        target_N_for_batching = 8192,
+        use_exact_tcrdist_nbrs = False,
+):
+    ''' Like calc_nbrs(..., return_nbr_store=True) after new clones have been
+    appended to adata, starting from the nbr_store for the first num_old_clones
+    (see update_nbr_store for the requirements)
+
+    The nbr counts int(nbr_frac*N) grow with N; if they outgrow the nbr_store width
+    we have to recompute everything (with calc_nbrs), so use nbr_store_headroom>1
+    in calc_nbrs to avoid that
+
+    returns all_nbrs, nndists_gex, nndists_tcr, nbr_store if also_calc_nndists,
+    otherwise all_nbrs, nbr_store
+    '''
+    if also_calc_nndists:
+        assert nbr_frac_for_nndists in nbr_fracs
+
+    N = adata.shape[0]
+    num_nbrs = max(1, int(max(nbr_fracs)*N))
+    widths = [nbr_store[tag][0].shape[1] for tag in ['gex', 'tcr']
+              if nbr_store[tag][0] is not None]
+    if widths and num_nbrs > min(widths):
+        # keep the same relative headroom as before
+        headroom = max(1.0, min(widths)/max(1, int(max(nbr_fracs)*num_old_clones)))
+        print('update_nbrs: nbr_store too narrow, recomputing all the nbrs:',
+              num_nbrs, widths, 'headroom=', headroom)
+        return calc_nbrs(
+            adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
+            nbr_frac_for_nndists, target_N_for_batching,
+            use_exact_tcrdist_nbrs=use_exact_tcrdist_nbrs, return_nbr_store=True,
+            nbr_store_headroom=headroom)
+
+    nbr_store = update_nbr_store(
+        adata, nbr_store, num_old_clones, obsm_tag_gex, obsm_tag_tcr,
+        target_N_for_batching, use_exact_tcrdist_nbrs=use_exact_tcrdist_nbrs)
+
+    all_nbrs, nndists_gex, nndists_tcr = nbrs_from_nbr_store(
+        nbr_store, nbr_fracs, nbr_frac_for_nndists if also_calc_nndists else None)
+
+    if also_calc_nndists:
+        return all_nbrs, nndists_gex, nndists_tcr, nbr_store
+    else:
+        return all_nbrs, nbr_store
+
+
 def calculate_tcrdist_nbrs(
         adata,
         nbr_fracs,
@@ -1168,7 +1928,7 @@ def calculate_tcrdist_nbrs(
 
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
-    if util.tcrdist_cpp_available():
+    if util.tcrdist_cpp_lib_available() or util.tcrdist_cpp_available():
         return calculate_tcrdist_nbrs_cpp(
             adata, nbr_fracs, nbr_frac_for_nndists,
             tmpfile_prefix=tmpfile_prefix)
@@ -1189,7 +1949,7 @@ def calculate_tcrdist_nbrs_python(
 
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
-    agroups, bgroups = setup_tcr_groups(adata)
+    group_index = setup_tcr_group_index(adata)
 
     tcrs = retrieve_tcrs_from_adata(adata)
 
@@ -1203,14 +1963,14 @@ def calculate_tcrdist_nbrs_python(
 
     nndists = []
 
+    block_size = 1000 # compute the distances for blocks of rows at a time
     for ii in range(num_clones):
-        if ii%1000==0:
+        if ii%block_size==0:
             print('recalculate_tcrdist_nbrs:', ii, num_clones)
             sys.stdout.flush()
-        ii_tcr = tcrs[ii]
-        dists = np.array([ tcrdist(ii_tcr, x) for x in tcrs])
-        dists[ agroups==agroups[ii] ] = 1e3
-        dists[ bgroups==bgroups[ii] ] = 1e3
+            block_dists = tcrdist.pairwise(tcrs[ii:ii+block_size], tcrs)
+        dists = block_dists[ii%block_size].copy()
+        dists[ group_index.excluded(ii) ] = 1e3
         for nbr_frac in nbr_fracs: # could do this more efficiently by going in decreasing order, saving partitions...
             num_neighbors = max(1, int(nbr_frac*num_clones))
             ii_nbrs = np.argpartition(dists, num_neighbors-1 )[:num_neighbors]
@@ -1234,27 +1994,17 @@ def calculate_tcrdist_nbrs_python(
 
     return all_nbrs, nndists
 
-def calculate_tcrdist_nbrs_cpp(
+def _run_find_neighbors_knn(
         adata,
-        nbr_fracs,
-        nbr_frac_for_nndists = None,
-        tmpfile_prefix = None,
+        agroups,
+        bgroups,
+        num_nbrs,
+        tmpfile_prefix,
 ):
-    ''' returns all_nbrs, nndists
+    ''' Run the find_neighbors executable in kNN mode
 
-    all_nbrs is a dict mapping from nbr_frac to nbrs_tcr
-
-    nndists=None if nbr_frac_for_nndists is None
-
-    nbrs exclude self and any clones in same atcr group or btcr group
+    returns knn_indices, knn_distances, tmpfiles (which the caller should remove)
     '''
-    if tmpfile_prefix is None:
-        tmpfile_prefix = Path('./tmp_nbrs{}'.format(random.randrange(1,10000)))
-
-    print('calculate_tcrdist_nbrs_cpp:', adata.shape, nbr_fracs, tmpfile_prefix)
-
-    agroups, bgroups = setup_tcr_groups(adata)
-
     agroups_filename = str(tmpfile_prefix) +'_agroups.txt'
     bgroups_filename = str(tmpfile_prefix) +'_bgroups.txt'
     np.savetxt(agroups_filename, agroups, fmt='%d')
@@ -1280,19 +2030,17 @@ def calculate_tcrdist_nbrs_cpp(
         exit(1)
 
     N = adata.shape[0]
-    max_nbr_frac = max(nbr_fracs)
-    num_nbrs = max(1, int(max_nbr_frac*N))
 
     outprefix = str(tmpfile_prefix) +'_calc_tcrdist'
 
-    cmd = '{} -f {} -n {} -d {} -o {} -a {} -b {}'\
+    cmd = '{} -f {} -n {} -d {} -o {} -a {} -b {} --binary'\
           .format(exe, tcrs_filename, num_nbrs, db_filename, outprefix,
                   agroups_filename, bgroups_filename)
 
     util.run_command(cmd, verbose=True)
 
-    knn_indices_filename = outprefix+'_knn_indices.txt'
-    knn_distances_filename = outprefix+'_knn_distances.txt'
+    knn_indices_filename = outprefix+'_knn_indices.npy'
+    knn_distances_filename = outprefix+'_knn_distances.npy'
 
     if not exists(knn_indices_filename) or not exists(knn_distances_filename):
         print('find_neighbors failed:', exists(knn_indices_filename),
@@ -1302,9 +2050,84 @@ def calculate_tcrdist_nbrs_cpp(
     # try to conserve memory here. The distances are actually ints
     # in the [0,1000] (probably mostly [0,500])
     print(f'reading array of size {N}x{num_nbrs} from {knn_indices_filename}')
-    knn_indices = np.loadtxt(knn_indices_filename, dtype=np.int32)
-    print(f'reading array of size {N}x{num_nbrs} from {knn_distances_filename}')
-    knn_distances = np.loadtxt(knn_distances_filename, dtype=np.float32)
+    # load (not mmap) since the files get removed and knn_indices is returned
+    knn_indices, knn_distances = tcrdist_cpp.read_knn_nbrs(outprefix, mmap=False)
+    knn_distances = knn_distances.astype(np.float32)
+
+    tmpfiles = [tcrs_filename, agroups_filename, bgroups_filename,
+                knn_indices_filename, knn_distances_filename]
+
+    return knn_indices, knn_distances, tmpfiles
+
+def _calc_tcrdist_knn_cpp(
+        adata,
+        agroups,
+        bgroups,
+        num_nbrs,
+        tmpfile_prefix = None,
+):
+    ''' returns knn_indices, knn_distances (float32), the top num_nbrs tcrdist nbrs
+    (not sorted), from the tcrdist cache, the C++ library, or the find_neighbors exe
+    '''
+    if tmpfile_prefix is None:
+        tmpfile_prefix = Path('./tmp_nbrs{}'.format(random.randrange(1,10000)))
+
+    N = adata.shape[0]
+    organism = adata.uns['organism']
+    tcrs = retrieve_tcrs_from_adata(adata)
+    cache = tcrdist_cache.get_cache()
+    cached = (None if cache is None else
+              cache.get_knn_nbrs(organism, tcrs, num_nbrs, agroups, bgroups))
+
+    if cached is not None:
+        print(f'reusing array of size {N}x{num_nbrs} from the tcrdist cache')
+        knn_indices, knn_distances = cached
+        knn_distances = knn_distances.astype(np.float32)
+        tmpfiles = []
+    elif util.tcrdist_cpp_lib_available():
+        # no tmpfiles needed, compute in-process
+        print(f'computing array of size {N}x{num_nbrs} in-process')
+        knn_indices, knn_distances = tcrdist_cpp.find_knn_nbrs(
+            tcrs, organism, num_nbrs, agroups, bgroups)
+        knn_distances = knn_distances.astype(np.float32)
+        tmpfiles = []
+    else:
+        knn_indices, knn_distances, tmpfiles = _run_find_neighbors_knn(
+            adata, agroups, bgroups, num_nbrs, tmpfile_prefix)
+
+    if cache is not None and cached is None:
+        cache.put_knn_nbrs(
+            organism, tcrs, knn_indices, knn_distances, agroups, bgroups)
+
+    for filename in tmpfiles:
+        os.remove(filename)
+
+    return knn_indices, knn_distances
+
+def calculate_tcrdist_nbrs_cpp(
+        adata,
+        nbr_fracs,
+        nbr_frac_for_nndists = None,
+        tmpfile_prefix = None,
+):
+    ''' returns all_nbrs, nndists
+
+    all_nbrs is a dict mapping from nbr_frac to nbrs_tcr
+
+    nndists=None if nbr_frac_for_nndists is None
+
+    nbrs exclude self and any clones in same atcr group or btcr group
+    '''
+    print('calculate_tcrdist_nbrs_cpp:', adata.shape, nbr_fracs, tmpfile_prefix)
+
+    agroups, bgroups = setup_tcr_groups(adata)
+
+    N = adata.shape[0]
+    max_nbr_frac = max(nbr_fracs)
+    num_nbrs = max(1, int(max_nbr_frac*N))
+
+    knn_indices, knn_distances = _calc_tcrdist_knn_cpp(
+        adata, agroups, bgroups, num_nbrs, tmpfile_prefix)
 
     all_nbrs = {}
     all_nbrs[max_nbr_frac] = knn_indices
@@ -1335,11 +2158,6 @@ def calculate_tcrdist_nbrs_cpp(
             ar = np.arange(b_start,b_stop)[:,np.newaxis]
             all_nbrs[nbr_frac][b_start:b_stop,:] = knn_indices[ar,inds]
 
-
-    for filename in [tcrs_filename, agroups_filename, bgroups_filename,
-                     knn_indices_filename, knn_distances_filename]:
-        os.remove(filename)
-
     if nbr_frac_for_nndists is None:
         nndists = None
     else:
@@ -1406,6 +2224,277 @@ def setup_tcr_cluster_names(adata):
     adata.uns['clusters_tcr_names'] = names
 
 
+def calc_tcrdist_matrix_rectangular(
+        tcrs1,
+        tcrs2,
+        organism,
+):
+    ''' Paired tcrdist matrix between tcrs1 and tcrs2, as a float32 array of shape
+    (len(tcrs1), len(tcrs2))
+
+    uses the tcrdist cache if it's turned on, else the C++ library if it's compiled,
+    else python (the executables only do square matrices)
+    '''
+    cache = tcrdist_cache.get_cache()
+    if cache is not None:
+        return cache.paired_tcrdist_matrix(organism, tcrs1, tcrs2)
+    elif util.tcrdist_cpp_lib_available():
+        return tcrdist_cpp.calc_tcrdist_matrix(tcrs1, organism, tcrs2)\
+                          .astype(np.float32)
+    else:
+        return TcrDistCalculator(organism).pairwise(tcrs1, tcrs2).astype(np.float32)
+
+
+def _tcrdist_kernel(D, kernel, gaussian_kernel_sdev, force_Dmax):
+    ''' Convert distances to kernel values, see make_tcrdist_kernel_pcs_file_from_clones_file
+    '''
+    if kernel is None:
+        return np.maximum(0.0, 1 - ( D / force_Dmax ))
+    elif kernel == 'gaussian':
+        return np.exp(-0.5 * (D/gaussian_kernel_sdev)**2 )
+    else:
+        print('conga.preprocess._tcrdist_kernel:: unrecognized kernel:', kernel)
+        sys.exit(1)
+
+
+def choose_tcrdist_landmarks(
+        tcrs,
+        organism,
+        num_landmarks,
+        landmark_selection = 'kmeans++', # or 'random'
+        num_rounds = 10,
+        random_seed = 0,
+):
+    ''' Choose num_landmarks landmark clonotypes for landmark (Nystrom) kernel PCA
+
+    returns landmarks, D_landmarks where landmarks is an array of indices into tcrs
+    and D_landmarks is the float32 tcrdist matrix of shape (len(tcrs), num_landmarks)
+
+    'kmeans++' picks landmarks with probability proportional to the squared tcrdist
+    to the closest landmark so far. To limit the number of passes over the tcrs, the
+    landmarks are picked in num_rounds batches (like "k-means||") rather than one at
+    a time.
+    '''
+    N = len(tcrs)
+    num_landmarks = min(num_landmarks, N)
+    rng = np.random.RandomState(random_seed)
+
+    if landmark_selection == 'random':
+        landmarks = np.sort(rng.choice(N, num_landmarks, replace=False))
+        D_landmarks = calc_tcrdist_matrix_rectangular(
+            tcrs, [tcrs[x] for x in landmarks], organism)
+        return landmarks, D_landmarks
+    elif landmark_selection != 'kmeans++':
+        print('conga.preprocess.choose_tcrdist_landmarks:: unrecognized',
+              'landmark_selection:', landmark_selection)
+        sys.exit(1)
+
+    D_landmarks = np.zeros((N, num_landmarks), dtype=np.float32)
+    landmarks = [rng.randint(N)]
+    D_landmarks[:,0] = calc_tcrdist_matrix_rectangular(
+        tcrs, [tcrs[landmarks[0]]], organism)[:,0]
+    min_dists = D_landmarks[:,0].astype(float)
+    num_rounds = max(1, min(num_rounds, num_landmarks-1))
+    for r in range(num_rounds):
+        num_left = num_landmarks - len(landmarks)
+        batch_size = (num_left-1)//(num_rounds-r) + 1
+        wts = min_dists**2
+        batch_size = min(batch_size, np.count_nonzero(wts))
+        if batch_size == 0: # everybody is a landmark (or identical to one)
+            break
+        batch = rng.choice(N, batch_size, replace=False, p=wts/np.sum(wts))
+        start = len(landmarks)
+        print(f'choose_tcrdist_landmarks: round {r} adding {batch_size} landmarks',
+              f'to {start}')
+        D_landmarks[:,start:start+batch_size] = calc_tcrdist_matrix_rectangular(
+            tcrs, [tcrs[x] for x in batch], organism)
+        min_dists = np.minimum(
+            min_dists, D_landmarks[:,start:start+batch_size].min(axis=1))
+        landmarks.extend(batch)
+
+    landmarks = np.array(landmarks)
+    return landmarks, D_landmarks[:,:len(landmarks)]
+
+
+def calc_landmark_kernel_pcs(
+        D_landmarks,
+        landmarks,
+        n_components,
+        kernel = None,
+        gaussian_kernel_sdev = 100.0,
+        force_Dmax = None,
+        block_size = 10000,
+        verbose = False,
+        return_model = False,
+):
+    ''' Landmark (Nystrom) approximation to the kernel PCA in
+    make_tcrdist_kernel_pcs_file_from_clones_file
+
+    D_landmarks is the (N, m) tcrdist matrix to the landmarks (see
+    choose_tcrdist_landmarks). The tcrs are mapped to Nystrom features
+    K_NL * W^(-1/2), where W is the landmark-landmark kernel matrix, and we do a
+    regular (centered) PCA on those features, which is the kernel PCA of the
+    approximate gram matrix K_NL W^-1 K_LN. Memory and time are O(N*m), done in blocks
+    of rows.
+
+    returns the (N, n_components) array of kernel PCs, or if return_model is True,
+    xy, A, offset where xy = K_NL.dot(A) - offset (see save_tcrdist_kpca_model)
+    '''
+    N, m = D_landmarks.shape
+    if force_Dmax is None:
+        force_Dmax = D_landmarks.max()
+
+    W = _tcrdist_kernel(D_landmarks[landmarks,:].astype(float), kernel,
+                        gaussian_kernel_sdev, force_Dmax)
+    W = 0.5 * (W + W.T)
+    evals, evecs = np.linalg.eigh(W)
+    mask = evals > 1e-8 * evals.max() # W can be singular, eg duplicate landmarks
+    proj = evecs[:,mask] / np.sqrt(evals[mask])[np.newaxis,:]
+    print(f'calc_landmark_kernel_pcs: N= {N} num_landmarks= {m}',
+          f'rank= {np.sum(mask)}')
+
+    def features(start): # Nystrom features for a block of rows
+        K = _tcrdist_kernel(D_landmarks[start:start+block_size].astype(float),
+                            kernel, gaussian_kernel_sdev, force_Dmax)
+        return K.dot(proj)
+
+    # centered covariance of the features
+    r = proj.shape[1]
+    sums, cov = np.zeros((r,)), np.zeros((r,r))
+    for start in range(0, N, block_size):
+        F = features(start)
+        sums += F.sum(axis=0)
+        cov += F.T.dot(F)
+    mean = sums/N
+    cov -= N * np.outer(mean, mean)
+
+    evals, evecs = np.linalg.eigh(cov)
+    order = np.argsort(evals)[::-1][:n_components]
+    evecs = evecs[:,order]
+
+    if verbose: #show the eigenvalues
+        for ii, val in enumerate(evals[order]):
+            print( 'eigenvalue: {:3d} {:.3f}'.format( ii, val))
+
+    xy = np.zeros((N, len(order)))
+    for start in range(0, N, block_size):
+        xy[start:start+block_size] = (features(start) - mean).dot(evecs)
+    if return_model:
+        return xy, proj.dot(evecs), mean.dot(evecs)
+    return xy
+
+
+def _text_matrix_row_reader(filename, num_rows, chunk_size=256):
+    ''' Returns get_rows(start, stop) for reading a whitespace-separated text matrix
+    (like the distfiles written by np.savetxt) as float32, in order, block by block,
+    so the whole matrix is never in memory. The calls have to go in row order.
+    The text is parsed chunk_size lines at a time, to keep the temporaries small
+    '''
+    data = open(filename, 'r')
+    next_row = [0]
+
+    def get_rows(start, stop):
+        assert start == next_row[0] # sequential access only
+        rows = None
+        for chunk_start in range(start, stop, chunk_size):
+            lines = list(itertools.islice(data, min(chunk_size, stop-chunk_start)))
+            chunk = np.loadtxt(lines, dtype=np.float32, ndmin=2)
+            if rows is None:
+                rows = np.empty((stop-start, chunk.shape[1]), dtype=np.float32)
+            rows[chunk_start-start:chunk_start-start+chunk.shape[0]] = chunk
+        next_row[0] = stop
+        if stop == num_rows:
+            data.close()
+        return rows
+    return get_rows
+
+def calc_lean_kernel_pcs(
+        get_distance_rows,
+        N,
+        n_components,
+        kernel = None,
+        gaussian_kernel_sdev = 100.0,
+        force_Dmax = None,
+        block_size = 2000,
+        random_seed = 0,
+        verbose = False,
+):
+    ''' Memory-lean exact kernel PCA for make_tcrdist_kernel_pcs_file_from_clones_file
+
+    get_distance_rows(start, stop) returns rows [start,stop) of the N x N tcrdist
+    matrix. The gram matrix is filled in place in a single float32 N x N buffer,
+    block by block (the full distance matrix is never held in memory), then
+    double-centered in place, and only the top n_components eigenpairs are computed,
+    with Lanczos iterations (scipy eigsh). Peak memory is about one N x N float32
+    matrix (4*N^2 bytes) plus a block of rows.
+
+    Eigenvector signs are fixed so the largest-magnitude entry is positive, and the
+    Lanczos starting vector is seeded, so the results are reproducible.
+
+    returns xy, row_means, grand_mean, force_Dmax where xy is the (N, n_components)
+    array of kernel PCs, row_means and grand_mean are the means of the uncentered gram
+    matrix and force_Dmax is the Dmax that was used (for save_tcrdist_kpca_model)
+    '''
+    G = np.empty((N,N), dtype=np.float32)
+
+    # first pass: fill in the distances
+    Dmax = 0.
+    for start in range(0, N, block_size):
+        stop = min(N, start+block_size)
+        G[start:stop] = get_distance_rows(start, stop)
+        Dmax = max(Dmax, float(G[start:stop].max()))
+    if force_Dmax is None:
+        force_Dmax = Dmax
+    print(f'calc_lean_kernel_pcs: N= {N} kernel= {kernel} Dmax= {Dmax}',
+          f'force_Dmax= {force_Dmax} gram_bytes= {G.nbytes}')
+
+    # second pass: convert to kernel values in place, and get the row means
+    row_means = np.zeros((N,))
+    for start in range(0, N, block_size):
+        block = G[start:start+block_size]
+        if kernel is None:
+            block /= -force_Dmax
+            block += 1.0
+            np.maximum(block, 0.0, out=block)
+        elif kernel == 'gaussian':
+            block /= gaussian_kernel_sdev
+            np.square(block, out=block)
+            block *= -0.5
+            np.exp(block, out=block)
+        else:
+            print('conga.preprocess.calc_lean_kernel_pcs:: unrecognized kernel:', kernel)
+            sys.exit(1)
+        row_means[start:start+block_size] = block.mean(axis=1, dtype=np.float64)
+    grand_mean = row_means.mean()
+
+    # third pass: double-center in place (the gram matrix is symmetric)
+    col_terms = (grand_mean - row_means).astype(np.float32)
+    for start in range(0, N, block_size):
+        block = G[start:start+block_size]
+        block -= row_means[start:start+block_size,np.newaxis].astype(np.float32)
+        block += col_terms[np.newaxis,:]
+
+    def matvec(x):
+        return G.dot(np.ravel(x).astype(np.float32)).astype(np.float64)
+
+    op = LinearOperator((N,N), matvec=matvec, dtype=np.float64)
+    v0 = np.random.RandomState(random_seed).uniform(-1, 1, N)
+    evals, evecs = eigsh(op, k=n_components, which='LA', v0=v0)
+    del G
+
+    order = np.argsort(evals)[::-1]
+    evals, evecs = np.maximum(evals[order], 0.0), evecs[:,order]
+    signs = np.sign(evecs[np.argmax(np.abs(evecs), axis=0), np.arange(n_components)])
+    evecs *= signs[np.newaxis,:]
+
+    if verbose: #show the eigenvalues
+        for ii in range(n_components):
+            print( 'eigenvalue: {:3d} {:.3f}'.format( ii, evals[ii]))
+
+    xy = evecs * np.sqrt(evals)[np.newaxis,:]
+    return xy, row_means, grand_mean, force_Dmax
+
+
 def make_tcrdist_kernel_pcs_file_from_clones_file(
         clones_file,
         organism,
@@ -1420,7 +2509,25 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
         force_tcrdist_cpp = False,
         tcrs = None,
         return_pcs = False, # default is to write to a file
+        num_landmarks = None, # if not None, do landmark (Nystrom) kernel PCA
+        landmark_selection = 'kmeans++', # or 'random', see choose_tcrdist_landmarks
+        model_file = None, # if not None, save the kPCA model here (.npz)
+        lean = False, # float32 in-place gram and partial eigensolver, see calc_lean_kernel_pcs
 ):
+    ''' Compute the tcrdist kernel PCs and write them to outfile (or return them)
+
+    The default is exact kernel PCA on the full N x N tcrdist matrix, which needs
+    O(N^2) memory. With num_landmarks=m (and no input_distfile) we only compute the
+    N x m distances to m landmark clonotypes and approximate the kernel PCA from those
+    (see calc_landmark_kernel_pcs). In that case the default force_Dmax is the max
+    distance to the landmarks.
+
+    With lean=True the exact kernel PCA is done with calc_lean_kernel_pcs, which needs
+    about 4*N^2 bytes at peak rather than several N x N float64 arrays.
+
+    If model_file is given, the kPCA model is saved there so new clonotypes can be
+    projected later with project_tcrs_onto_tcrdist_kpca_model.
+    '''
     if (not return_pcs) and outfile is None:
         # this is the name expected by read_dataset above
         #  (with n_components_in==50)
@@ -1436,48 +2543,118 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
         ids = [l.clone_id for l in df.itertuples()]
 
 
-    if input_distfile is None: ## tcr distances
-        print(f'compute tcrdist distance matrix for {len(tcrs)} clonotypes')
-
-        if tcrdist_cpp_available():
-            print('Using C++ TCRdist calculator')
-            D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile)
+    if num_landmarks is not None and input_distfile is None and num_landmarks<len(tcrs):
+        if output_distfile is not None:
+            print('conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file::',
+                  'output_distfile is not available with num_landmarks')
+            sys.exit(1)
+        print(f'compute tcrdist distances from {len(tcrs)} clonotypes to',
+              f'{num_landmarks} landmarks')
+        landmarks, D_landmarks = choose_tcrdist_landmarks(
+            tcrs, organism, num_landmarks, landmark_selection)
+        n_components = min(n_components_in, len(landmarks))
+        if force_Dmax is None:
+            force_Dmax = D_landmarks.max()
+        xy, A, offset = calc_landmark_kernel_pcs(
+            D_landmarks, landmarks, n_components, kernel=kernel,
+            gaussian_kernel_sdev=gaussian_kernel_sdev, force_Dmax=force_Dmax,
+            verbose=verbose, return_model=True)
+        if model_file is not None:
+            save_tcrdist_kpca_model(
+                model_file, organism, [tcrs[x] for x in landmarks], A, offset,
+                np.zeros((A.shape[1],)), kernel, gaussian_kernel_sdev, force_Dmax)
+    elif lean:
+        N = len(tcrs)
+        n_components = min(n_components_in, N-1)
+        if input_distfile is not None:
+            print(f'reload tcrdist distance matrix for {N} clonotypes in blocks')
+            get_distance_rows = _text_matrix_row_reader(input_distfile, N)
+        elif (tcrdist_cache.get_cache() is None and
+              not util.tcrdist_cpp_lib_available() and tcrdist_cpp_available()):
+            # the executable writes the uint16 matrix to disk, we read it in blocks
+            D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile, as_float=False)
+            get_distance_rows = lambda start, stop: D[start:stop]
         else:
-            print('Using Python TCRdist calculator. Consider compiling',
-                  'C++ calculator for faster perfomance.')
-            tcrdist_calculator = TcrDistCalculator(organism)
-            D = np.array([tcrdist_calculator(x,y) for x in tcrs for y in tcrs])\
-                  .reshape((len(tcrs), len(tcrs)))
+            print(f'compute tcrdist distance matrix for {N} clonotypes in blocks')
+            get_distance_rows = lambda start, stop: calc_tcrdist_matrix_rectangular(
+                tcrs[start:stop], tcrs, organism)
+
+        if output_distfile is not None: # write the distances as we go
+            distfile = open(output_distfile, 'w')
+            get_rows = get_distance_rows
+            def get_distance_rows(start, stop):
+                rows = get_rows(start, stop)
+                np.savetxt( distfile, rows.astype(float), fmt='%.1f')
+                return rows
+
+        xy, row_means, grand_mean, force_Dmax = calc_lean_kernel_pcs(
+            get_distance_rows, N, n_components, kernel=kernel,
+            gaussian_kernel_sdev=gaussian_kernel_sdev, force_Dmax=force_Dmax,
+            verbose=verbose)
+        if output_distfile is not None:
+            distfile.close()
+
+        if model_file is not None: # see the model code in the exact kPCA below
+            lambdas = np.sum(xy**2, axis=0)
+            E = xy / np.where(lambdas>0, lambdas, 1.0)[np.newaxis,:]
+            esum = E.sum(axis=0)
+            save_tcrdist_kpca_model(
+                model_file, organism, tcrs, E, row_means.dot(E) - grand_mean*esum,
+                esum, kernel, gaussian_kernel_sdev, force_Dmax)
     else:
-        print(f'reload tcrdist distance matrix for {len(tcrs)} clonotypes')
-        D = np.loadtxt(input_distfile)
+        if input_distfile is None: ## tcr distances
+            print(f'compute tcrdist distance matrix for {len(tcrs)} clonotypes')
 
-    if output_distfile is not None:
-        np.savetxt( output_distfile, D.astype(float), fmt='%.1f')
+            if tcrdist_cpp_available() or util.tcrdist_cpp_lib_available():
+                print('Using C++ TCRdist calculator')
+                D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile)
+            else:
+                print('Using Python TCRdist calculator. Consider compiling',
+                      'C++ calculator for faster perfomance.')
+                D = calc_tcrdist_matrix_python(tcrs, organism)
+        else:
+            print(f'reload tcrdist distance matrix for {len(tcrs)} clonotypes')
+            D = np.loadtxt(input_distfile)
 
-    n_components = min( n_components_in, D.shape[0] )
+        if output_distfile is not None:
+            np.savetxt( output_distfile, D.astype(float), fmt='%.1f')
 
-    print(f'running KernelPCA with {kernel} kernel distance matrix',
-          f'shape= {D.shape} D.max()= {D.max()} force_Dmax= {force_Dmax}')
+        n_components = min( n_components_in, D.shape[0] )
 
-    pca = KernelPCA(kernel='precomputed', n_components=n_components)
+        print(f'running KernelPCA with {kernel} kernel distance matrix',
+              f'shape= {D.shape} D.max()= {D.max()} force_Dmax= {force_Dmax}')
 
-    if kernel is None:
-        if force_Dmax is None:
-            force_Dmax = D.max()
-        gram = np.maximum(0.0, 1 - ( D / force_Dmax ))
-    elif kernel == 'gaussian':
-        gram = np.exp(-0.5 * (D/gaussian_kernel_sdev)**2 )
-    else:
-        print('conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file:',
-              'unrecognized kernel:', kernel)
-        sys.exit(1)
+        pca = KernelPCA(kernel='precomputed', n_components=n_components)
 
-    xy = pca.fit_transform(gram)
+        if kernel is None:
+            if force_Dmax is None:
+                force_Dmax = D.max()
+            gram = np.maximum(0.0, 1 - ( D / force_Dmax ))
+        elif kernel == 'gaussian':
+            gram = np.exp(-0.5 * (D/gaussian_kernel_sdev)**2 )
+        else:
+            print('conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file:',
+                  'unrecognized kernel:', kernel)
+            sys.exit(1)
 
-    if verbose: #show the eigenvalues
-        for ii in range(n_components):
-            print( 'eigenvalue: {:3d} {:.3f}'.format( ii, pca.lambdas_[ii]))
+        xy = pca.fit_transform(gram)
+
+        if verbose: #show the eigenvalues
+            for ii in range(n_components):
+                print( 'eigenvalue: {:3d} {:.3f}'.format( ii, pca.lambdas_[ii]))
+
+        if model_file is not None:
+            # xy = alphas * sqrt(lambdas) with unit-norm alphas, so the projection
+            # matrix alphas / sqrt(lambdas) is xy / lambdas
+            lambdas = np.sum(xy**2, axis=0)
+            E = xy / np.where(lambdas>0, lambdas, 1.0)[np.newaxis,:]
+            # centering the new rows like sklearn's KernelCenterer:
+            #  Kc = K - K.mean(axis=1) - gram.mean(axis=0) + gram.mean()
+            esum = E.sum(axis=0)
+            offset = gram.mean(axis=0).dot(E) - gram.mean() * esum
+            save_tcrdist_kpca_model(
+                model_file, organism, tcrs, E, offset, esum, kernel,
+                gaussian_kernel_sdev, force_Dmax)
 
     if return_pcs:
         return xy ######################### NOTE EARLY RETURN
@@ -1485,17 +2662,123 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
 
         # this is the kpca_file that conga.preprocess.read_dataset is expecting:
         #kpca_file = clones_file[:-4]+'_AB.dist_50_kpcs'
-        print( 'writing TCRdist kernel PCs to outfile:', outfile)
-        out = open(outfile,'w')
-
-        for ii in range(D.shape[0]):
-            out.write('pc_comps: {} {}\n'\
-                      .format(ids[ii], ' '.join('{:.6f}'.format(xy[ii,j])
-                                                for j in range(n_components))))
-        out.close()
+        write_tcrdist_kernel_pcs_file(outfile, ids, xy)
         return
 
 
+def write_tcrdist_kernel_pcs_file(outfile, ids, xy, write_sidecar=True):
+    ''' Write the kernel PCs in the format read_dataset expects
+
+    also writes the binary outfile+'.npz' version, see read_tcrdist_kernel_pcs_file
+    '''
+    print( 'writing TCRdist kernel PCs to outfile:', outfile)
+    out = open(outfile,'w')
+
+    for ii in range(xy.shape[0]):
+        out.write('pc_comps: {} {}\n'\
+                  .format(ids[ii], ' '.join('{:.6f}'.format(xy[ii,j])
+                                            for j in range(xy.shape[1]))))
+    out.close()
+    if write_sidecar:
+        write_tcrdist_kernel_pcs_sidecar(outfile)
+
+
+def save_tcrdist_kpca_model(
+        model_file,
+        organism,
+        ref_tcrs,
+        A,
+        offset,
+        row_mean_coef,
+        kernel,
+        gaussian_kernel_sdev,
+        force_Dmax,
+):
+    ''' Save a tcrdist kernel PCA model to model_file (.npz)
+
+    The kernel PCs of new tcrs are xy = K.dot(A) - offset - K.mean(axis=1)*row_mean_coef
+    where K is the kernel matrix between the new tcrs and ref_tcrs (see
+    project_tcrs_onto_tcrdist_kpca_model). For exact kPCA the ref_tcrs are all the
+    clonotypes and the last term does the centering; for landmark kPCA they are the
+    landmarks and row_mean_coef is zero.
+    '''
+    ref_tcrs = np.array([[str(x) for x in tcr[0][:3]+tcr[1][:3]] for tcr in ref_tcrs])
+    print('saving tcrdist kPCA model:', model_file, 'num_ref_tcrs=', len(ref_tcrs))
+    np.savez(
+        model_file, organism=organism, ref_tcrs=ref_tcrs.reshape((-1,6)), A=A,
+        offset=offset, row_mean_coef=row_mean_coef,
+        kernel='' if kernel is None else kernel,
+        gaussian_kernel_sdev=gaussian_kernel_sdev,
+        force_Dmax=np.nan if force_Dmax is None else force_Dmax,
+    )
+
+
+def read_tcrdist_kpca_model(model_file):
+    ''' Returns a dict with the model saved by save_tcrdist_kpca_model
+    '''
+    if not exists(model_file):
+        print('conga.preprocess.read_tcrdist_kpca_model:: missing file:', model_file)
+        exit(1)
+    data = np.load(model_file)
+    model = {k:data[k] for k in 'A offset row_mean_coef'.split()}
+    model['organism'] = str(data['organism'])
+    model['ref_tcrs'] = [((x[0], x[1], x[2]), (x[3], x[4], x[5]))
+                         for x in data['ref_tcrs']]
+    model['kernel'] = str(data['kernel']) or None
+    model['gaussian_kernel_sdev'] = float(data['gaussian_kernel_sdev'])
+    model['force_Dmax'] = float(data['force_Dmax'])
+    return model
+
+
+def project_tcrs_onto_tcrdist_kpca_model(
+        tcrs,
+        model,
+        block_size = 10000,
+):
+    ''' Compute the kernel PCs of tcrs under a saved kPCA model (a model dict from
+    read_tcrdist_kpca_model, or the model_file), using only the tcrdists to the
+    model's reference tcrs, so O(len(tcrs) * num_ref_tcrs)
+
+    The reference clonotypes themselves get the same kernel PCs as in the original
+    run, so existing embeddings don't move when new samples are added.
+    '''
+    if not isinstance(model, dict):
+        model = read_tcrdist_kpca_model(model)
+    num_components = model['A'].shape[1]
+    xy = np.zeros((len(tcrs), num_components))
+    for start in range(0, len(tcrs), block_size):
+        D = calc_tcrdist_matrix_rectangular(
+            tcrs[start:start+block_size], model['ref_tcrs'], model['organism'])
+        K = _tcrdist_kernel(D.astype(float), model['kernel'],
+                            model['gaussian_kernel_sdev'], model['force_Dmax'])
+        xy[start:start+block_size] = (
+            K.dot(model['A']) - model['offset'][np.newaxis,:] -
+            K.mean(axis=1)[:,np.newaxis] * model['row_mean_coef'][np.newaxis,:])
+    return xy
+
+
+def make_tcrdist_kernel_pcs_file_from_model(
+        clones_file,
+        model_file,
+        outfile = None,
+        n_components_in = 50, # only used for the default outfile name
+):
+    ''' Like make_tcrdist_kernel_pcs_file_from_clones_file, but project the clonotypes
+    onto a saved kPCA model (see project_tcrs_onto_tcrdist_kpca_model) rather than
+    running kPCA again
+    '''
+    if outfile is None:
+        outfile = '{}_AB.dist_{}_kpcs'.format(clones_file[:-4], n_components_in)
+
+    df = pd.read_csv(clones_file, sep='\t')
+    tcrs = [((l.va_gene, l.ja_gene, l.cdr3a),
+             (l.vb_gene, l.jb_gene, l.cdr3b)) for l in df.itertuples()]
+    ids = [l.clone_id for l in df.itertuples()]
+
+    xy = project_tcrs_onto_tcrdist_kpca_model(tcrs, model_file)
+    write_tcrdist_kernel_pcs_file(outfile, ids, xy)
+
+
 def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
         old_clones_file,
         new_clones_file,
@@ -1514,95 +2797,76 @@ def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
     assert type(all_barcodes) is pd.Series
 
 
-    if output_distfile is None and (force_tcrdist_cpp or (util.tcrdist_cpp_available() and N>5000)):
+    cpp_available = util.tcrdist_cpp_lib_available() or util.tcrdist_cpp_available()
+    if output_distfile is None and (force_tcrdist_cpp or (cpp_available and N>5000)):
         tcrdist_threshold = int(tcrdist_threshold+0.001) # cpp tcrdist threshold is integer
 
-        if os.name == 'posix':
-            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin), 'find_neighbors')
+        tcrs = [((l.va_gene, l.ja_gene, l.cdr3a), (l.vb_gene, l.jb_gene, l.cdr3b))
+                for l in df.itertuples()]
+        cache = tcrdist_cache.get_cache()
+        cached = (None if cache is None else
+                  cache.get_threshold_nbrs(organism, tcrs, tcrdist_threshold))
+
+        if cached is not None:
+            offsets, indices, distances = cached
+        elif util.tcrdist_cpp_lib_available():
+            offsets, indices, distances = tcrdist_cpp.find_threshold_nbrs(
+                tcrs, organism, tcrdist_threshold)
         else:
-            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
+            if os.name == 'posix':
+                exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin), 'find_neighbors')
+            else:
+                exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
 
-        db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db) , 'tcrdist_info_{}.txt'.format(organism) )
+            db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db) , 'tcrdist_info_{}.txt'.format(organism) )
 
-        outprefix = old_clones_file + '_calc_tcrdist'
+            outprefix = old_clones_file + '_calc_tcrdist'
 
-        cmd = '{} -f {} -t {} -d {} -o {}'.format(exe, old_clones_file, tcrdist_threshold, db_filename, outprefix)
+            cmd = '{} -f {} -t {} -d {} -o {} --binary'.format(exe, old_clones_file, tcrdist_threshold, db_filename, outprefix)
 
-        util.run_command(cmd, verbose=True)
+            util.run_command(cmd, verbose=True)
 
-        nbr_indices_filename = '{}_nbr{}_indices.txt'.format(outprefix, tcrdist_threshold)
-        nbr_distances_filename = '{}_nbr{}_distances.txt'.format(outprefix, tcrdist_threshold)
+            nbr_indices_filename = '{}_nbr{}_indices.npy'.format(outprefix, tcrdist_threshold)
+            nbr_distances_filename = '{}_nbr{}_distances.npy'.format(outprefix, tcrdist_threshold)
 
-        if not exists(nbr_indices_filename) or not exists(nbr_distances_filename):
-            print('find_neighbors failed:', exists(nbr_indices_filename), exists(nbr_distances_filename))
-            exit(1)
+            if not exists(nbr_indices_filename) or not exists(nbr_distances_filename):
+                print('find_neighbors failed:', exists(nbr_indices_filename), exists(nbr_distances_filename))
+                exit(1)
 
-        all_nbrs = []
-        all_distances = []
-        all_smallest_nbr = []
-        for line1, line2 in zip(open(nbr_indices_filename,'r'), open(nbr_distances_filename,'r')):
-            l1 = line1.split()
-            l2 = line2.split()
-            assert len(l1) == len(l2)
-            ii = len(all_nbrs)
-            all_nbrs.append([ii]+[int(x) for x in l1])
-            all_distances.append([0.]+[float(x) for x in l2])
-            all_smallest_nbr.append(min(all_nbrs[-1]))
-        assert len(all_nbrs) == N
+            offsets, indices, distances = tcrdist_cpp.read_threshold_nbrs(
+                outprefix, tcrdist_threshold)
 
-        # now do single linkage clustering
-        all_smallest_nbr = np.array(all_smallest_nbr)
-        while True:
-            updated = False
-            for ii in range(N):
-                nbr = all_smallest_nbr[ii]
-                new_nbr = min(nbr, np.min(all_smallest_nbr[all_nbrs[ii]]))
-                if nbr != new_nbr:
-                    print('update:', nbr, new_nbr)
-                    all_smallest_nbr[ii] = new_nbr
-                    updated = True
-            if not updated:
-                break
-        # define clusters, choose cluster centers
-        clusters = np.array([-1]*N)
-        cluster_centers = []
-        clusters_set = []
-        for ii, nbr in enumerate(all_smallest_nbr):
-            if ii==nbr:
-                cmask = all_smallest_nbr==nbr
-                csize = np.sum(cmask)
-                cluster_number = len(clusters_set)
-                clusters_set.append(cluster_number)
-                clusters[cmask] = cluster_number
-                # choose center
-                min_avgdist = 1e6
-                center = None
-                for jj in np.nonzero(cmask)[0]:
-                    assert all_smallest_nbr[jj] == nbr
-                    avgdist = (np.sum(all_distances[jj]) + (tcrdist_threshold+1.)*(csize-len(all_distances[jj])))/csize
-                    if avgdist<min_avgdist:
-                        min_avgdist = avgdist
-                        center = jj
-                assert center is not None
-                cluster_centers.append(center) # will be parallel with clusters_set
-        assert not np.any(clusters==-1)
-
-        #confirm single linkage
-        for ii in range(N):
-            for nbr in all_nbrs[ii]:
-                assert clusters[ii] == clusters[nbr] # just added 2020-10-07
+        if cache is not None and cached is None:
+            cache.put_threshold_nbrs(
+                organism, tcrs, tcrdist_threshold, offsets, indices, distances)
 
+        assert len(offsets) == N+1
+
+        # now do single linkage clustering
+        num_nbrs = np.diff(offsets)
+        rows = np.repeat(np.arange(N), num_nbrs)
+        clusters = util.connected_components(N, rows, indices)
+        clusters_set = list(range(clusters.max()+1))
+
+        # choose cluster centers: min avg distance to the other members, with
+        #  tcrdist_threshold+1 for the ones that aren't nbrs
+        csizes = np.bincount(clusters)[clusters]
+        sum_dists = np.bincount(rows, weights=distances, minlength=N)
+        avgdists = (sum_dists + (tcrdist_threshold+1.)*(csizes-num_nbrs-1))/csizes
+        order = np.lexsort((np.arange(N), avgdists, clusters))
+        first_in_cluster = np.r_[True, clusters[order][1:] != clusters[order][:-1]]
+        cluster_centers = list(order[first_in_cluster])
+        assert len(cluster_centers) == len(clusters_set)
 
     else: # use python tcrdist, compute full distance matrix
         # in conga we usually also have cdr3_nucseq but we don't need it for tcrdist
         tcrs = [ ( ( l.va_gene, l.ja_gene, l.cdr3a ), ( l.vb_gene, l.jb_gene, l.cdr3b ) ) for l in df.itertuples() ]
         print(f'compute tcrdist distance matrix for {len(tcrs)} clonotypes')
         sys.stdout.flush()
-        if force_tcrdist_cpp or (util.tcrdist_cpp_available() and N>5000):
+        if force_tcrdist_cpp or (cpp_available and N>5000):
             D = calc_tcrdist_matrix_cpp(tcrs, organism)
         else:
-            tcrdist_calculator = TcrDistCalculator(organism)
-            D = np.array( [ tcrdist_calculator(x,y) for x in tcrs for y in tcrs ] ).reshape( (len(tcrs), len(tcrs)) )
+            D = calc_tcrdist_matrix_python(tcrs, organism)
 
         DT = squareform(D, force='tovector')
 
@@ -1632,29 +2896,20 @@ def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
 
     print('num_clusters:', len(clusters_set))
 
-    new_clones_dfl = []
-    new_bcmap_dfl = []
-
-    for c, center in zip(clusters_set, cluster_centers):
-        # choose a representative clone based on distance
-        cmask = clusters==c
-        members = np.nonzero(cmask)[0]
-        cdf = df[cmask]
-        center_df = pd.Series( df.iloc[center] )
-        clone_size = sum(x.clone_size for _,x in cdf.iterrows())
-        center_df.clone_size = clone_size
-        new_clones_dfl.append( center_df)
-        cbarcodes = []
-        for _,row in cdf.iterrows():
-            cbarcodes.extend( all_barcodes[row.clone_id].split(',') )
-        assert len(cbarcodes) == clone_size
-        new_bcmap_dfl.append( dict(clone_id=center_df.clone_id, barcodes=','.join(cbarcodes)))
-
-    new_clones_df = pd.DataFrame(new_clones_dfl)
-    new_bcmap_df = pd.DataFrame(new_bcmap_dfl)['clone_id barcodes'.split()] # ensure order?
+    # the clones in each cluster are merged into the center clone
+    cluster_index = np.searchsorted(clusters_set, clusters)
+    new_clones_df = df.iloc[cluster_centers].copy()
+    new_clones_df['clone_size'] = df.clone_size.groupby(cluster_index).sum().to_numpy()
+    cbarcodes = pd.Series(all_barcodes.loc[df.clone_id].to_numpy())\
+                  .groupby(cluster_index).agg(','.join).to_numpy()
+    assert np.all(np.char.count(cbarcodes.astype(str), ',')+1 ==
+                  new_clones_df.clone_size.to_numpy())
+    new_bcmap_df = pd.DataFrame(dict(clone_id=new_clones_df.clone_id.to_numpy(),
+                                     barcodes=cbarcodes))
 
     new_clones_df.to_csv(new_clones_file, sep='\t', index=False)
     new_bcmap_df.to_csv(new_clones_file+'.barcode_mapping.tsv', sep='\t', index=False)
+    write_barcode_mapping_sidecar(new_clones_file+'.barcode_mapping.tsv')
 
     if output_distfile is not None:
         new_D = D[cluster_centers,:][:,cluster_centers]
@@ -1670,39 +2925,48 @@ def calc_tcrdist_nbrs_umap_clusters_cpp(
         clustering_resolution = None,
         n_components_umap = 2,
 ):
-    tcrs_filename = outfile_prefix+'_tcrs.tsv'
-    adata.obs['va cdr3a vb cdr3b'.split()].to_csv(tcrs_filename, sep='\t', index=False)
-
-    if os.name == 'posix':
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
+    if util.tcrdist_cpp_lib_available():
+        knn_indices, knn_distances = tcrdist_cpp.find_knn_nbrs(
+            retrieve_tcrs_from_adata(adata), adata.uns['organism'], num_nbrs)
+        knn_indices = knn_indices.astype(int)
+        knn_distances = knn_distances.astype(float)
+        tmpfiles = []
     else:
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
+        tcrs_filename = outfile_prefix+'_tcrs.tsv'
+        adata.obs['va cdr3a vb cdr3b'.split()].to_csv(tcrs_filename, sep='\t', index=False)
 
-    if not exists(exe):
-        print('need to compile c++ exe:', exe)
-        exit(1)
+        if os.name == 'posix':
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
+        else:
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
 
-    db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), 'tcrdist_info_{}.txt'.format(adata.uns['organism']) )
+        if not exists(exe):
+            print('need to compile c++ exe:', exe)
+            exit(1)
 
-    if not exists(db_filename):
-        print('need to create database file:', db_filename)
-        exit(1)
+        db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), 'tcrdist_info_{}.txt'.format(adata.uns['organism']) )
 
-    outprefix = outfile_prefix+'_calc_tcrdist'
+        if not exists(db_filename):
+            print('need to create database file:', db_filename)
+            exit(1)
 
-    cmd = '{} -f {} -n {} -d {} -o {}'.format(exe, tcrs_filename, num_nbrs, db_filename, outprefix)
+        outprefix = outfile_prefix+'_calc_tcrdist'
 
-    util.run_command(cmd, verbose=True)
+        cmd = '{} -f {} -n {} -d {} -o {} --binary'.format(exe, tcrs_filename, num_nbrs, db_filename, outprefix)
 
-    knn_indices_filename = outprefix+'_knn_indices.txt'
-    knn_distances_filename = outprefix+'_knn_distances.txt'
+        util.run_command(cmd, verbose=True)
 
-    if not exists(knn_indices_filename) or not exists(knn_distances_filename):
-        print('find_neighbors failed:', exists(knn_indices_filename), exists(knn_distances_filename))
-        exit(1)
+        knn_indices_filename = outprefix+'_knn_indices.npy'
+        knn_distances_filename = outprefix+'_knn_distances.npy'
+
+        if not exists(knn_indices_filename) or not exists(knn_distances_filename):
+            print('find_neighbors failed:', exists(knn_indices_filename), exists(knn_distances_filename))
+            exit(1)
 
-    knn_indices = np.loadtxt(knn_indices_filename, dtype=int)
-    knn_distances = np.loadtxt(knn_distances_filename, dtype=float)
+        knn_indices, knn_distances = tcrdist_cpp.read_knn_nbrs(outprefix)
+        knn_indices = knn_indices.astype(int)
+        knn_distances = knn_distances.astype(float)
+        tmpfiles = [knn_indices_filename, knn_distances_filename, tcrs_filename]
 
     # distances = sc.neighbors.get_sparse_matrix_from_indices_distances_numpy(
     #     knn_indices, knn_distances, adata.shape[0], num_nbrs)
@@ -1756,16 +3020,48 @@ def calc_tcrdist_nbrs_umap_clusters_cpp(
     del adata.obsm['X_umap'] # delete the extra umap copy
 
     # cleanup the tmpfiles
-    for filename in [knn_indices_filename,
-                     knn_distances_filename,
-                     tcrs_filename]:
+    for filename in tmpfiles:
         os.remove(filename)
 
+def calc_tcrdist_matrix_python(
+        tcrs,
+        organism,
+        tcrdist_calculator = None,
+):
+    ''' Paired tcrdist matrix from the python TcrDistCalculator, or from the tcrdist
+    cache if it's turned on (see conga.tcrdist_cache)
+    '''
+    cache = tcrdist_cache.get_cache()
+    if cache is not None:
+        return cache.paired_tcrdist_matrix(organism, tcrs)
+
+    if tcrdist_calculator is None:
+        tcrdist_calculator = TcrDistCalculator(organism)
+    return tcrdist_calculator.pairwise(tcrs)
+
 def calc_tcrdist_matrix_cpp(
         tcrs,
         organism,
         tmpfile_prefix = None,
+        unique_chains = True, # compute via the unique alpha/beta chains (same result)
+        as_float = True,
 ):
+    ''' Paired tcrdist matrix from the C++ code (library or find_neighbors
+    executable), or from the tcrdist cache if it's turned on (see conga.tcrdist_cache)
+
+    With as_float=False we return the uint16 matrix (memory-mapped from the
+    executable's output file on posix systems)
+    '''
+    cache = tcrdist_cache.get_cache()
+    if cache is not None:
+        D = cache.paired_tcrdist_matrix(organism, tcrs)
+        return D if as_float else D.astype(np.uint16)
+
+    if util.tcrdist_cpp_lib_available(): # no tmpfiles needed, compute in-process
+        D = tcrdist_cpp.calc_tcrdist_matrix(
+            tcrs, organism, unique_chains=unique_chains)
+        return D.astype(float) if as_float else D
+
     if tmpfile_prefix is None:
         tmpfile_prefix = Path('./tmp_tcrdists{}'.format(random.randrange(1,10000)))
 
@@ -1790,17 +3086,22 @@ def calc_tcrdist_matrix_cpp(
         print('need to create database file:', db_filename)
         exit(1)
 
-    cmd = '{} -f {} --only_tcrdists -d {} -o {}'.format(exe, tcrs_filename, db_filename, tmpfile_prefix)
+    cmd = '{} -f {} --only_tcrdists -d {} -o {} --binary'.format(exe, tcrs_filename, db_filename, tmpfile_prefix)
+    if unique_chains:
+        cmd += ' --unique_chains'
 
     util.run_command(cmd, verbose=True)
 
-    tcrdist_matrix_filename = str(tmpfile_prefix) +'_tcrdists.txt'
+    tcrdist_matrix_filename = str(tmpfile_prefix) +'_tcrdists.npy'
 
     if not exists(tcrdist_matrix_filename):
         print('find_neighbors failed, missing', tcrdist_matrix_filename)
         exit(1)
 
-    D = np.loadtxt(tcrdist_matrix_filename).astype(float)
+    # OK to remove the file below if it's memory-mapped (posix only)
+    D = tcrdist_cpp.read_tcrdist_matrix(tmpfile_prefix, mmap=(os.name == 'posix'))
+    if as_float:
+        D = D.astype(float)
 
     for filename in [tcrs_filename, tcrdist_matrix_filename]:
         os.remove(filename)
@@ -2025,13 +3326,12 @@ def make_tcrdist_kernel_pcs_file_from_clones_file_V2(
 
     print(f'compute tcrdist distance matrix for {len(tcrs)} clonotypes')
 
-    if tcrdist_cpp_available():
+    if tcrdist_cpp_available() or util.tcrdist_cpp_lib_available():
         print('Using C++ TCRdist calculator')
         D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile)
     else:
         print('Using Python TCRdist calculator. Consider compiling C++ calculator for faster perfomance.')
-        tcrdist_calculator = TcrDistCalculator(organism)
-        D = np.array( [ tcrdist_calculator(x,y) for x in tcrs for y in tcrs ] ).reshape( (len(tcrs), len(tcrs)) )
+        D = calc_tcrdist_matrix_python(tcrs, organism)
 
     n_components = min( n_components_in, D.shape[0] )
 
@@ -2128,44 +3428,225 @@ def subset_to_CD4_or_CD8_clusters(
 
 
 
+# adata.uns key for the nbr arrays saved in a sidecar directory, see
+#  save_nbr_info_to_adata
+NBRS_SIDECAR_UNS_KEY = 'conga_nbrs_sidecar'
+NBRS_INFO_UNS_KEY = 'conga_nbrs_info'
+
+def _saved_nbrs_info(adata, nbr_settings):
+    ''' What the saved nbrs depend on: the clones (a hash of the obs_names) and the
+    nbr settings (a json-able dict, eg the nbr_backend and distance_kernel)
+    '''
+    obs_names_sha1 = hashlib.sha1('\n'.join(adata.obs_names).encode()).hexdigest()
+    return {'obs_names_sha1': obs_names_sha1,
+            'settings': json.dumps(nbr_settings or {}, sort_keys=True)}
+
+def saved_nbrs_info_matches(adata, nbr_settings=None):
+    ''' True if the nbrs saved in adata by save_nbr_info_to_adata were computed for
+    the same clones (same obs_names, in the same order) with the same nbr_settings
+    '''
+    if NBRS_INFO_UNS_KEY not in adata.uns_keys():
+        return False
+    info = adata.uns[NBRS_INFO_UNS_KEY]
+    return all(k in info and str(info[k]) == v
+               for k, v in _saved_nbrs_info(adata, nbr_settings).items())
+
+def _drop_saved_nbrs(adata):
+    ''' forget the nbrs saved by save_nbr_info_to_adata (the sidecar files are left)
+    '''
+    for k in adata.obsm_keys():
+        if k.startswith('nbrs_') or k.startswith('nbr_store_'):
+            del adata.obsm[k]
+    for k in [NBRS_SIDECAR_UNS_KEY, NBRS_INFO_UNS_KEY]:
+        if k in adata.uns_keys():
+            del adata.uns[k]
+
 def save_nbr_info_to_adata(
         adata,
-        all_nbrs
+        all_nbrs,
+        nbr_store = None, # optional, from calc_nbr_store or calc_nbrs
+        sidecar_dir = None, # if not None, save the arrays here instead of in obsm
+        nbr_settings = None, # json-able dict of the settings used, see saved_nbrs_info_matches
 ):
     ''' Stash the nbrs info in the adata.obsm array
-    '''
 
+    If nbr_store is provided, the sorted nbr indices and distances are saved too
+    (as nbr_store_{tag}_indices and nbr_store_{tag}_distances), so any
+    nbr_frac up to the largest one can be recovered later with
+    retrieve_nbrs_from_nbr_store_in_adata, without recomputing distances
+
+    If sidecar_dir is provided, each array is written to sidecar_dir/{key}.npy
+    (int32 nbrs, float32 distances) and only the key names and directory are
+    stored, in adata.uns[NBRS_SIDECAR_UNS_KEY]. Then h5ad files stay small, and
+    retrieve_nbr_info_from_adata memory-maps the arrays, so only the rows that are
+    used get read from disk. The absolute path of each file is stored, so the
+    directory has to stay put (or be passed to the retrieve functions).
+
+    A hash of the obs_names and the nbr_settings are stored too, so callers can check
+    that saved nbrs still fit (saved_nbrs_info_matches). Previously saved nbrs are
+    kept only if they were saved for the same clones and nbr_settings.
+    '''
+    info = _saved_nbrs_info(adata, nbr_settings)
+    if NBRS_INFO_UNS_KEY in adata.uns_keys() or NBRS_SIDECAR_UNS_KEY in adata.uns_keys() \
+       or any(k.startswith('nbrs_') or k.startswith('nbr_store_')
+              for k in adata.obsm_keys()):
+        if not saved_nbrs_info_matches(adata, nbr_settings):
+            print('save_nbr_info_to_adata: dropping previously saved nbrs, computed',
+                  'for different clones or nbr_settings')
+            _drop_saved_nbrs(adata)
+    adata.uns[NBRS_INFO_UNS_KEY] = info
+
+    arrays = {}
     for nbr_frac in all_nbrs:
         nbrs_gex, nbrs_tcr = all_nbrs[nbr_frac]
         for tag, nbrs in [['gex', nbrs_gex], ['tcr', nbrs_tcr]]:
-            obsm_key = f'nbrs_{tag}_{nbr_frac:.6f}'
-            adata.obsm[obsm_key] = nbrs
-            print('saved:', obsm_key, type(adata.obsm[obsm_key]),
-                  adata.obsm[obsm_key].shape, adata.obsm[obsm_key].dtype)
+            arrays[f'nbrs_{tag}_{nbr_frac:.6f}'] = nbrs
+
+    if nbr_store is not None:
+        for tag in ['gex', 'tcr']:
+            knn_indices, knn_distances = nbr_store[tag]
+            if knn_indices is None:
+                continue
+            arrays[f'nbr_store_{tag}_indices'] = knn_indices
+            arrays[f'nbr_store_{tag}_distances'] = knn_distances
+
+    if sidecar_dir is None:
+        for key, array in arrays.items():
+            adata.obsm[key] = array
+            print('saved:', key, type(adata.obsm[key]),
+                  adata.obsm[key].shape, adata.obsm[key].dtype)
+        return
+
+    sidecar_dir = Path(sidecar_dir).resolve() # absolute, so it works from any directory
+    sidecar_dir.mkdir(parents=True, exist_ok=True)
+    keys, files = [], []
+    if NBRS_SIDECAR_UNS_KEY in adata.uns_keys(): # keep the ones we aren't replacing
+        for key, filename in _saved_nbrs_sidecar_files(adata).items():
+            if key not in arrays: # may be in a different directory
+                keys.append(key)
+                files.append(str(filename))
+    for key, array in arrays.items():
+        dtype = np.float32 if key.endswith('_distances') else np.int32
+        filename = sidecar_dir / f'{key}.npy'
+        np.save(filename, np.asarray(array, dtype=dtype))
+        if key in adata.obsm_keys():
+            del adata.obsm[key]
+        keys.append(key)
+        files.append(str(filename))
+        print('saved:', key, 'to', filename, array.shape)
+    adata.uns[NBRS_SIDECAR_UNS_KEY] = {'dir': str(sidecar_dir), 'keys': keys,
+                                       'files': files}
+
+def _saved_nbrs_sidecar_files(adata, sidecar_dir=None):
+    ''' Returns dict from key to sidecar filename, see save_nbr_info_to_adata
+
+    sidecar_dir overrides the stored locations
+    '''
+    info = adata.uns[NBRS_SIDECAR_UNS_KEY]
+    keys = [str(x) for x in info['keys']]
+    if sidecar_dir is not None:
+        return {key: Path(sidecar_dir) / f'{key}.npy' for key in keys}
+    elif 'files' in info: # one path per key
+        return {key: Path(str(x)) for key, x in zip(keys, info['files'])}
+    else: # older format, all in one directory
+        return {key: Path(str(info['dir'])) / f'{key}.npy' for key in keys}
+
+def _retrieve_saved_nbr_arrays(
+        adata,
+        mmap = True,
+        sidecar_dir = None, # override the directory stored in adata.uns
+        missing_ok = False, # skip missing sidecar files rather than exit
+):
+    ''' Returns dict from key to array for all the arrays saved by
+    save_nbr_info_to_adata, either in obsm or in a sidecar directory (memory-mapped
+    read-only if mmap)
+    '''
+    arrays = {}
+    for k in adata.obsm_keys():
+        if k.startswith('nbrs_') or k.startswith('nbr_store_'):
+            arrays[k] = adata.obsm[k]
+
+    if NBRS_SIDECAR_UNS_KEY in adata.uns_keys():
+        for key, filename in _saved_nbrs_sidecar_files(adata, sidecar_dir).items():
+            if not exists(filename):
+                print('conga.preprocess.retrieve_nbr_info_from_adata:: missing',
+                      'sidecar nbrs file:', filename)
+                if missing_ok:
+                    continue
+                exit(1)
+            arrays[key] = np.load(filename, mmap_mode='r' if mmap else None)
+    return arrays
+
+def retrieve_nbr_store_from_adata(
+        adata,
+        mmap = True,
+        sidecar_dir = None,
+):
+    ''' Returns the nbr_store saved by save_nbr_info_to_adata, or None if there
+    isn't one
+    '''
+    arrays = _retrieve_saved_nbr_arrays(adata, mmap, sidecar_dir)
+    nbr_store = {}
+    for tag in ['gex', 'tcr']:
+        key = f'nbr_store_{tag}_indices'
+        if key in arrays:
+            nbr_store[tag] = [arrays[key], arrays[f'nbr_store_{tag}_distances']]
+        else:
+            nbr_store[tag] = [None, None]
+
+    if nbr_store['gex'][0] is None and nbr_store['tcr'][0] is None:
+        return None
+    return nbr_store
+
+def retrieve_nbrs_from_nbr_store_in_adata(
+        adata,
+        nbr_fracs,
+        nbr_frac_for_nndists = None,
+        sidecar_dir = None,
+):
+    ''' Like retrieve_nbr_info_from_adata, but for any nbr_fracs up to the largest
+    one used when the nbr_store was saved
+
+    returns all_nbrs, nndists_gex, nndists_tcr (see nbrs_from_nbr_store)
+    '''
+    nbr_store = retrieve_nbr_store_from_adata(adata, sidecar_dir=sidecar_dir)
+    if nbr_store is None:
+        print('conga.preprocess.retrieve_nbrs_from_nbr_store_in_adata::',
+              'no nbr_store in adata, see save_nbr_info_to_adata')
+        exit(1)
+    return nbrs_from_nbr_store(nbr_store, nbr_fracs, nbr_frac_for_nndists)
 
 def retrieve_nbr_info_from_adata(
         adata,
+        mmap = True, # memory-map the arrays saved in a sidecar directory
+        sidecar_dir = None, # override the sidecar directory stored in adata.uns
+        missing_ok = False, # leave out nbr_fracs with missing sidecar files
 ):
     ''' Returns the all_nbrs dictionary, which maps from nbr_fracs
     to lists of [nbrs_gex, nbrs_tcr]
 
     all_nbrs = { 0.01: [nbrs_gex, nbrs_tcr], ... }
 
+    If the nbrs were saved with save_nbr_info_to_adata(..., sidecar_dir=...) the
+    arrays are read-only memory-maps, unless mmap=False
     '''
 
     all_nbrs = {}
-    for k in adata.obsm_keys():
+    for k, nbrs in _retrieve_saved_nbr_arrays(
+            adata, mmap, sidecar_dir, missing_ok).items():
         if k[:5] == 'nbrs_' and k.count('_')==2:
-            tagl = k.split('_')
             _, tag, nbr_frac = k.split('_')
             expected_tags = ['gex','tcr']
             assert tag in expected_tags
             nbr_frac = float(nbr_frac)
             if nbr_frac not in all_nbrs:
                 all_nbrs[nbr_frac] = [None, None]
-            all_nbrs[nbr_frac][ expected_tags.index(tag) ] = adata.obsm[k]
+            all_nbrs[nbr_frac][ expected_tags.index(tag) ] = nbrs
 
-    for nbr_frac in all_nbrs:
+    for nbr_frac in list(all_nbrs):
+        if missing_ok and any(x is None for x in all_nbrs[nbr_frac]):
+            del all_nbrs[nbr_frac]
+            continue
         assert all_nbrs[nbr_frac][0] is not None
         assert all_nbrs[nbr_frac][1] is not None
 
@@ -20,65 +20,43 @@ import os
 from sys import exit
 from . import util
 from . import preprocess
+from . import tcrdist_cpp
+from . import tcrdist_cache
 from .tcrdist import tcr_sampler
 import random
 
 
-def estimate_background_tcrdist_distributions(
+def _run_calc_distributions(
         organism,
         tcrs,
         max_dist,
-        num_random_samples = 50000,
-        pseudocount = 0.25,
-        tmpfile_prefix = None,
-        background_alpha_chains = None, # default is to get these by shuffling tcrs_for_background_generation
-        background_beta_chains = None, #  -- ditto --
-        tcrs_for_background_generation = None, # default is to use 'tcrs'
+        tmpfile_prefix,
+        background_alpha_chains,
+        background_beta_chains,
+        background_alpha_weights = None,
+        background_beta_weights = None,
 ):
-    if not util.tcrdist_cpp_available():
-        print('conga.tcr_clumping.estimate_background_tcrdist_distributions:: need to compile the C++ tcrdist executables')
-        exit(1)
-
-    if tmpfile_prefix is None:
-        tmpfile_prefix = Path('./tmp_nbrs{}'.format(random.randrange(1,10000)))
-    else:
-        tmpfile_prefix = Path(tmpfile_prefix)
-
-
-    if tcrs_for_background_generation is None:
-        # only used when background_alpha_chains and/or background_beta_chains is None
-        #tcrs_for_background_generation = tcrs
-        # since 10x doesn't always provide allele information, we need to try out alternate
-        # alleles to get the best parses...
-        tcrs_for_background_generation = tcr_sampler.find_alternate_alleles_for_tcrs(
-            organism, tcrs, verbose=False)
-
-    max_dist = int(0.1+max_dist) ## need an integer
-
-    if background_alpha_chains is None or background_beta_chains is None:
-        # parse the V(D)J junction regions of the tcrs to define split-points for shuffling
-        junctions_df = tcr_sampler.parse_tcr_junctions(organism, tcrs_for_background_generation)
-
-        # resample shuffled single-chain tcrs
-        if background_alpha_chains is None:
-            background_alpha_chains = tcr_sampler.resample_shuffled_tcr_chains(
-                organism, num_random_samples, 'A', junctions_df)
-        if background_beta_chains is None:
-            background_beta_chains  = tcr_sampler.resample_shuffled_tcr_chains(
-                organism, num_random_samples, 'B', junctions_df)
+    ''' Run the calc_distributions executable, return the counts array
 
+    the optional weights are the multiplicities of the background chains (they go in
+    the 'count' column of the chains files)
+    '''
     # save all tcrs to files
     achains_file = str(tmpfile_prefix) + '_bg_achains.tsv'
     bchains_file = str(tmpfile_prefix) + '_bg_bchains.tsv'
     tcrs_file = str(tmpfile_prefix) + '_tcrs.tsv'
 
-    pd.DataFrame({'va'   :[x[0] for x in background_alpha_chains],
-                  'cdr3a':[x[2] for x in background_alpha_chains]}).to_csv(
-                      achains_file, sep='\t', index=False)
+    adf = pd.DataFrame({'va'   :[x[0] for x in background_alpha_chains],
+                        'cdr3a':[x[2] for x in background_alpha_chains]})
+    if background_alpha_weights is not None:
+        adf['count'] = background_alpha_weights
+    adf.to_csv(achains_file, sep='\t', index=False)
 
-    pd.DataFrame({'vb'   :[x[0] for x in background_beta_chains ],
-                  'cdr3b':[x[2] for x in background_beta_chains ]}).to_csv(
-                      bchains_file, sep='\t', index=False)
+    bdf = pd.DataFrame({'vb'   :[x[0] for x in background_beta_chains ],
+                        'cdr3b':[x[2] for x in background_beta_chains ]})
+    if background_beta_weights is not None:
+        bdf['count'] = background_beta_weights
+    bdf.to_csv(bchains_file, sep='\t', index=False)
 
     pd.DataFrame({'va':[x[0][0] for x in tcrs], 'cdr3a':[x[0][2] for x in tcrs],
                   'vb':[x[1][0] for x in tcrs], 'cdr3b':[x[1][2] for x in tcrs]})\
@@ -93,12 +71,12 @@ def estimate_background_tcrdist_distributions(
         exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) ,
                              'calc_distributions.exe')
 
-    outfile = str(tmpfile_prefix) + '_dists.tsv'
+    outfile = str(tmpfile_prefix) + '_dists.npy'
 
     db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db) ,
                                  'tcrdist_info_{}.txt'.format( organism))
 
-    cmd = '{} -f {} -m {} -d {} -a {} -b {} -o {}'\
+    cmd = '{} -f {} -m {} -d {} -a {} -b {} -o {} --binary'\
           .format(exe, tcrs_file, max_dist, db_filename,
                   achains_file, bchains_file, outfile)
 
@@ -108,19 +86,244 @@ def estimate_background_tcrdist_distributions(
         print('tcr_clumping:: calc_distributions failed: missing', outfile)
         exit(1)
 
-    counts = np.loadtxt(outfile, dtype=int)
-    counts = np.cumsum(counts, axis=1)
-    assert counts.shape == (len(tcrs), max_dist+1)
-    n_bg_pairs = len(background_alpha_chains) * len(background_beta_chains)
-    tcrdist_freqs = np.maximum(pseudocount, counts.astype(float))/n_bg_pairs
+    counts = np.load(outfile)
 
     for filename in [achains_file, bchains_file, tcrs_file, outfile]:
         os.remove(filename)
+    return counts
+
+def compress_background_chains(chains):
+    ''' Returns unique_chains, weights: the chains with distinct (v_gene, cdr3), in
+    order of first occurrence, and the number of times each one occurs in chains
+
+    The background counts only depend on the v_gene and cdr3, and the shuffled
+    background chains have lots of repeats, so this saves tcrdist calculations
+    '''
+    df = pd.DataFrame({'v':[x[0] for x in chains], 'cdr3':[x[2] for x in chains]})
+    codes = df.groupby(['v','cdr3'], sort=False).ngroup().values
+    weights = np.bincount(codes, minlength=codes.max()+1 if len(codes) else 0)
+    first_index = np.unique(codes, return_index=True)[1]
+    return [chains[ii] for ii in first_index], weights
+
+# background counts are always computed out to at least this tcrdist (the max_dist in
+#  find_significant_tcrdist_matches), so that tcr clumping and database matching
+#  can share them: the cost hardly depends on max_dist
+BACKGROUND_MAX_DIST = 200
+
+# in-memory cache, background_model_key --> model. Only the most recent models are
+#  kept, since each one holds its background chains and a (num_tcrs, max_dist+1)
+#  counts array (~160MB at 100k tcrs); see also clear_background_models
+MAX_BACKGROUND_MODELS = 1
+_background_models = OrderedDict()
+
+def clear_background_models():
+    ''' Free the background models (and counts) kept in memory by get_background_model
+    '''
+    _background_models.clear()
+
+
+class TcrdistBackgroundModel():
+    ''' Background paired tcrdist distributions: shuffled alpha and beta chains
+    (made by tcr_sampler.resample_shuffled_tcr_chains), and for each list of tcrs the
+    counts of (background_alpha, background_beta) pairs at each paired tcrdist
+
+    The paired counts are the convolution of the single-chain distance histograms,
+    so the counts up to a smaller max_dist are just the first columns. We compute
+    them once per list of tcrs, out to max(max_dist, BACKGROUND_MAX_DIST), and
+    slice. The tcrdists are only computed versus the unique background chains (see
+    compress_background_chains). Use get_background_model to get one, so the models are shared (and
+    stored in the tcrdist_cache, if it's turned on).
+    '''
+    def __init__(self, organism, model_key, background_alpha_chains,
+                 background_beta_chains):
+        self.organism = organism
+        self.model_key = model_key
+        self.background_alpha_chains = background_alpha_chains
+        self.background_beta_chains = background_beta_chains
+        self.n_bg_pairs = len(background_alpha_chains) * len(background_beta_chains)
+        self._unique_alpha_chains, self._alpha_weights = compress_background_chains(
+            background_alpha_chains)
+        self._unique_beta_chains, self._beta_weights = compress_background_chains(
+            background_beta_chains)
+        self._counts = {} # counts_key --> counts, just for the most recent tcrs
+
+    def calc_counts(self, tcrs, max_dist, tmpfile_prefix=None):
+        ''' Returns counts, an array of shape (len(tcrs), max_dist+1), where
+        counts[ii,d] is the number of background pairs at paired tcrdist d from tcrs[ii]
+        '''
+        max_dist = int(0.1+max_dist) ## need an integer
+        counts_key = tcrdist_cache.background_counts_key(
+            self.model_key, self.organism, tcrs)
+        counts = self._counts.get(counts_key)
+        cache = tcrdist_cache.get_cache()
+        if (counts is None or counts.shape[1] <= max_dist) and cache is not None:
+            counts = cache.get_background_counts(
+                counts_key, max(max_dist, BACKGROUND_MAX_DIST))
+        if counts is None or counts.shape[1] <= max_dist:
+            calc_max_dist = max(max_dist, BACKGROUND_MAX_DIST)
+            if util.tcrdist_cpp_lib_available(): # compute in-process
+                counts = tcrdist_cpp.calc_background_distributions(
+                    tcrs, self.organism, calc_max_dist, self._unique_alpha_chains,
+                    self._unique_beta_chains,
+                    background_alpha_weights=self._alpha_weights,
+                    background_beta_weights=self._beta_weights)
+            else:
+                if tmpfile_prefix is None:
+                    tmpfile_prefix = Path('./tmp_nbrs{}'.format(random.randrange(1,10000)))
+                counts = _run_calc_distributions(
+                    self.organism, tcrs, calc_max_dist, tmpfile_prefix,
+                    self._unique_alpha_chains, self._unique_beta_chains,
+                    self._alpha_weights, self._beta_weights)
+            if cache is not None:
+                cache.put_background_counts(counts_key, counts)
+        self._counts = {counts_key: counts}
+        assert counts.shape[0] == len(tcrs)
+        return counts[:,:max_dist+1]
+
+    def calc_freqs(self, tcrs, max_dist, pseudocount=0.25, tmpfile_prefix=None):
+        ''' Returns tcrdist_freqs, an array of shape (len(tcrs), max_dist+1), where
+        tcrdist_freqs[ii,d] is the fraction of background pairs within paired
+        tcrdist d of tcrs[ii] (with a pseudocount)
+        '''
+        counts = np.cumsum(self.calc_counts(tcrs, max_dist, tmpfile_prefix), axis=1)
+        return np.maximum(pseudocount, counts.astype(float))/self.n_bg_pairs
+
+
+def get_background_model(
+        organism,
+        tcrs_for_background_generation,
+        num_random_samples = 50000,
+        background_alpha_chains = None, # default is to get these by shuffling
+        background_beta_chains = None, #  -- ditto --
+        random_seed = None, # for the shuffling; default is to use the random module
+):
+    ''' Returns a TcrdistBackgroundModel, from the in-memory cache, or the
+    tcrdist_cache, or made by shuffling the chains of tcrs_for_background_generation
+
+    tcrs_for_background_generation should have V and J alleles that fit the
+    cdr3_nucseqs (see tcr_sampler.find_alternate_alleles_for_tcrs)
+    '''
+    model_key = tcrdist_cache.background_model_key(
+        organism, tcrs_for_background_generation, num_random_samples,
+        background_alpha_chains, background_beta_chains, random_seed)
+    if model_key in _background_models:
+        _background_models.move_to_end(model_key)
+        return _background_models[model_key]
+
+    cache = tcrdist_cache.get_cache()
+    cached = None if cache is None else cache.get_background_chains(model_key)
+    if cached is not None:
+        background_alpha_chains, background_beta_chains = cached
+    elif background_alpha_chains is None or background_beta_chains is None:
+        # parse the V(D)J junction regions of the tcrs to define split-points for shuffling
+        junctions_df = tcr_sampler.parse_tcr_junctions(
+            organism, tcrs_for_background_generation)
+
+        # resample shuffled single-chain tcrs
+        aseed, bseed = (None, None) if random_seed is None else (random_seed, random_seed+1)
+        if background_alpha_chains is None:
+            background_alpha_chains = tcr_sampler.resample_shuffled_tcr_chains(
+                organism, num_random_samples, 'A', junctions_df, random_seed=aseed)
+        if background_beta_chains is None:
+            background_beta_chains  = tcr_sampler.resample_shuffled_tcr_chains(
+                organism, num_random_samples, 'B', junctions_df, random_seed=bseed)
+    if cache is not None and cached is None:
+        cache.put_background_chains(
+            model_key, background_alpha_chains, background_beta_chains)
+
+    model = TcrdistBackgroundModel(
+        organism, model_key, background_alpha_chains, background_beta_chains)
+    _background_models[model_key] = model
+    while len(_background_models) > MAX_BACKGROUND_MODELS:
+        _background_models.popitem(last=False) # least recently used
+    return model
 
+
+def estimate_background_tcrdist_distributions(
+        organism,
+        tcrs,
+        max_dist,
+        num_random_samples = 50000,
+        pseudocount = 0.25,
+        tmpfile_prefix = None,
+        background_alpha_chains = None, # default is to get these by shuffling tcrs_for_background_generation
+        background_beta_chains = None, #  -- ditto --
+        tcrs_for_background_generation = None, # default is to use 'tcrs'
+        random_seed = None, # for making the background chains, see get_background_model
+):
+    ''' Returns tcrdist_freqs, an array of shape (len(tcrs), max_dist+1), see
+    TcrdistBackgroundModel.calc_freqs
+
+    the background model is shared with any other calls with the same
+    background tcrs and sampling parameters (see get_background_model)
+    '''
+    if not (util.tcrdist_cpp_lib_available() or util.tcrdist_cpp_available()):
+        print('conga.tcr_clumping.estimate_background_tcrdist_distributions:: need to compile the C++ tcrdist executables')
+        exit(1)
+
+    if tmpfile_prefix is not None:
+        tmpfile_prefix = Path(tmpfile_prefix)
+
+    if tcrs_for_background_generation is None:
+        # only used when background_alpha_chains and/or background_beta_chains is None
+        #tcrs_for_background_generation = tcrs
+        # since 10x doesn't always provide allele information, we need to try out alternate
+        # alleles to get the best parses...
+        tcrs_for_background_generation = tcr_sampler.find_alternate_alleles_for_tcrs(
+            organism, tcrs, verbose=False)
+
+    model = get_background_model(
+        organism, tcrs_for_background_generation, num_random_samples,
+        background_alpha_chains, background_beta_chains, random_seed)
+
+    tcrdist_freqs = model.calc_freqs(tcrs, max_dist, pseudocount, tmpfile_prefix)
+    assert tcrdist_freqs.shape == (len(tcrs), int(0.1+max_dist)+1)
     return tcrdist_freqs
 
 # not to be confused with assess_tcr_clumping which takes in an adata
 # and is basically a wrapper around this guy
+def count_threshold_nbrs_within_radii(offsets, distances, radii, mask=None):
+    ''' Returns counts, an array of shape (num_clones, len(radii)) where
+    counts[i,r] is the number of nbrs of clone i within distance radii[r]
+
+    offsets, distances are CSR-style threshold nbrs (see
+    tcrdist_cpp.find_threshold_nbrs). If mask is not None, only the nbrs where
+    mask is True are counted.
+
+    one pass over the nbrs: each nbr is binned by the smallest radius that
+    contains it, then the counts are accumulated over the sorted radii
+    '''
+    num_clones = len(offsets)-1
+    radii_order = np.argsort(radii)
+    sorted_radii = np.asarray(radii)[radii_order]
+    num_radii = len(radii)
+    rows = np.repeat(np.arange(num_clones), np.diff(offsets))
+    bins = np.searchsorted(sorted_radii, distances, side='left')
+    keep = bins < num_radii
+    if mask is not None:
+        keep &= mask
+    counts = np.bincount(rows[keep]*num_radii + bins[keep],
+                         minlength=num_clones*num_radii)\
+               .reshape((num_clones, num_radii)).cumsum(axis=1)
+    result = np.zeros_like(counts)
+    result[:, radii_order] = counts
+    return result
+
+def calc_poisson_clumping_pvalues(num_nbrs, max_nbrs, bg_freqs, radii):
+    ''' Returns mu, pvalues: arrays of shape (num_clones, len(radii)) with the
+    expected numbers of nbrs and the raw poisson pvalues of seeing at least
+    num_nbrs nbrs
+
+    num_nbrs is from count_threshold_nbrs_within_radii, max_nbrs is the number
+    of possible nbrs for each clone, and bg_freqs is from
+    estimate_background_tcrdist_distributions. pvalues are 1 where num_nbrs is 0
+    '''
+    mu = np.asarray(max_nbrs)[:,np.newaxis] * bg_freqs[:, radii]
+    pvalues = np.ones(mu.shape)
+    mask = num_nbrs >= 1
+    pvalues[mask] = poisson.sf(num_nbrs[mask]-1, mu[mask])
+    return mu, pvalues
+
 def find_tcr_clumping(
         tcrs,
         organism,
@@ -143,7 +346,7 @@ def find_tcr_clumping(
     - clump_type: string, either 'global' or 'intra_gex_cluster' (latter only if also_find_clumps_within_gex_clusters=T)
 
     '''
-    if not util.tcrdist_cpp_available():
+    if not (util.tcrdist_cpp_lib_available() or util.tcrdist_cpp_available()):
         print('conga.tcr_clumping.find_tcr_clumping::',
               'need to compile the C++ tcrdist executables')
         exit(1)
@@ -161,156 +364,157 @@ def find_tcr_clumping(
         organism, tcrs, max(radii),
         num_random_samples=num_random_samples, tmpfile_prefix=outprefix)
 
-    tcrs_file = outprefix +'_tcrs.tsv'
-    pd.DataFrame({
-        'va'   : [x[0][0] for x in tcrs],
-        'cdr3a': [x[0][2] for x in tcrs],
-        'vb'   : [x[1][0] for x in tcrs],
-        'cdr3b': [x[1][2] for x in tcrs],
-    }).to_csv(tcrs_file, sep='\t', index=False)
-    tmpfiles.append(tcrs_file)
-
     # find neighbors in fg tcrs up to max(radii) ############################
+    agroups, bgroups = preprocess.setup_tcr_groups_for_tcrs(tcrs)
 
-    if os.name == 'posix':
-        exe = Path.joinpath(
-            Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
+    tcrdist_threshold = max(radii)
+
+    cache = tcrdist_cache.get_cache()
+    cached = (None if cache is None else cache.get_threshold_nbrs(
+        organism, tcrs, tcrdist_threshold, agroups, bgroups))
+
+    if cached is not None:
+        offsets, indices, distances = cached
+    elif util.tcrdist_cpp_lib_available(): # compute in-process
+        offsets, indices, distances = tcrdist_cpp.find_threshold_nbrs(
+            tcrs, organism, tcrdist_threshold, agroups, bgroups)
     else:
-        exe = Path.joinpath(
-            Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
+        tcrs_file = outprefix +'_tcrs.tsv'
+        pd.DataFrame({
+            'va'   : [x[0][0] for x in tcrs],
+            'cdr3a': [x[0][2] for x in tcrs],
+            'vb'   : [x[1][0] for x in tcrs],
+            'cdr3b': [x[1][2] for x in tcrs],
+        }).to_csv(tcrs_file, sep='\t', index=False)
+        tmpfiles.append(tcrs_file)
+
+        if os.name == 'posix':
+            exe = Path.joinpath(
+                Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
+        else:
+            exe = Path.joinpath(
+                Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
 
-    agroups, bgroups = preprocess.setup_tcr_groups_for_tcrs(tcrs)
-    agroups_filename = outprefix+'_agroups.txt'
-    bgroups_filename = outprefix+'_bgroups.txt'
-    np.savetxt(agroups_filename, agroups, fmt='%d')
-    np.savetxt(bgroups_filename, bgroups, fmt='%d')
-    tmpfiles.extend([agroups_filename, bgroups_filename])
+        agroups_filename = outprefix+'_agroups.txt'
+        bgroups_filename = outprefix+'_bgroups.txt'
+        np.savetxt(agroups_filename, agroups, fmt='%d')
+        np.savetxt(bgroups_filename, bgroups, fmt='%d')
+        tmpfiles.extend([agroups_filename, bgroups_filename])
 
-    db_filename = Path.joinpath(
-        Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
+        db_filename = Path.joinpath(
+            Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
 
-    tcrdist_threshold = max(radii)
+        cmd = '{} -f {} -t {} -d {} -o {} -a {} -b {} --binary'\
+              .format(exe, tcrs_file, tcrdist_threshold, db_filename, outprefix,
+                      agroups_filename, bgroups_filename)
 
-    cmd = '{} -f {} -t {} -d {} -o {} -a {} -b {}'\
-          .format(exe, tcrs_file, tcrdist_threshold, db_filename, outprefix,
-                  agroups_filename, bgroups_filename)
+        util.run_command(cmd, verbose=True)
 
-    util.run_command(cmd, verbose=True)
+        nbr_indices_filename = f'{outprefix}_nbr{tcrdist_threshold}_indices.npy'
+        nbr_distances_filename = f'{outprefix}_nbr{tcrdist_threshold}_distances.npy'
+        tmpfiles.extend([nbr_indices_filename, nbr_distances_filename])
 
-    nbr_indices_filename = f'{outprefix}_nbr{tcrdist_threshold}_indices.txt'
-    nbr_distances_filename = f'{outprefix}_nbr{tcrdist_threshold}_distances.txt'
-    tmpfiles.extend([nbr_indices_filename, nbr_distances_filename])
+        if not exists(nbr_indices_filename) or not exists(nbr_distances_filename):
+            print('find_neighbors failed:', exists(nbr_indices_filename),
+                  exists(nbr_distances_filename))
+            exit(1)
 
-    if not exists(nbr_indices_filename) or not exists(nbr_distances_filename):
-        print('find_neighbors failed:', exists(nbr_indices_filename),
-              exists(nbr_distances_filename))
-        exit(1)
+        offsets_filename = f'{outprefix}_nbr{tcrdist_threshold}_offsets.npy'
+        tmpfiles.append(offsets_filename)
+        offsets, indices, distances = tcrdist_cpp.read_threshold_nbrs(
+            outprefix, tcrdist_threshold, mmap=(os.name == 'posix'))
+
+    if cache is not None and cached is None:
+        cache.put_threshold_nbrs(organism, tcrs, tcrdist_threshold, offsets, indices,
+                                 distances, agroups, bgroups)
 
-    all_nbrs = []
-    all_distances = []
-    for line1, line2 in zip(open(nbr_indices_filename,'r'),
-                            open(nbr_distances_filename,'r')):
-        l1 = line1.split()
-        l2 = line2.split()
-        assert len(l1) == len(l2)
-        #ii = len(all_nbrs)
-        all_nbrs.append([int(x) for x in l1])
-        all_distances.append([int(x) for x in l2])
-    assert len(all_nbrs) == num_clones
+    assert len(offsets) == num_clones+1
 
     # we were printing this out in verbose mode...
     #clone_sizes = adata.obs['clone_sizes']
 
     # use poisson to find nbrhoods with more tcrs than expected;
     #  have to handle agroups/bgroups
-    dfl = []
+    n_bg_pairs = num_random_samples * num_random_samples
 
-    is_clumped = np.full((num_clones,), False)
+    # number of possible nbrs for each clone: not in its agroup or bgroup
+    group_index = util.TcrGroupIndex(agroups, bgroups)
+    num_allowed = group_index.num_allowed()
+
+    # all the counts and pvalues at once, shape (num_clones, len(radii))
+    all_num_nbrs = count_threshold_nbrs_within_radii(offsets, distances, radii)
+    all_mu, all_raw_pvalues = calc_poisson_clumping_pvalues(
+        all_num_nbrs, num_allowed, bg_freqs, radii)
+    # adjust for number of tests, simple multiple test correction
+    all_pvals = all_raw_pvalues * (len(radii) * num_clones)
+    hits = [(all_num_nbrs>=1) & (all_pvals <= pvalue_threshold)]
+    clump_types = ['global']
+
+    if clusters_gex is not None:
+        # look for clumping within the GEX cluster containing each clone
+        clusters_gex = np.asarray(clusters_gex)
+        cluster_labels = np.unique(clusters_gex, return_inverse=True)[1].ravel()
+        cluster_sizes = np.bincount(cluster_labels)[cluster_labels]
+        # same as num_allowed, but also in the same GEX cluster
+        num_allowed_in_cluster = (
+            cluster_sizes - group_index.num_excluded_with_same_label(cluster_labels))
+        rows = np.repeat(np.arange(num_clones), np.diff(offsets))
+        same_cluster = (cluster_labels[rows] == cluster_labels[indices])
+        intra_num_nbrs = count_threshold_nbrs_within_radii(
+            offsets, distances, radii, mask=same_cluster)
+        intra_mu, intra_raw_pvalues = calc_poisson_clumping_pvalues(
+            intra_num_nbrs, num_allowed_in_cluster, bg_freqs, radii)
+        intra_pvals = intra_raw_pvalues * (len(radii) * num_clones)
+        hits.append((intra_num_nbrs>=1) & (intra_pvals <= pvalue_threshold))
+        clump_types.append('intra_gex_cluster')
+        all_num_nbrs = [all_num_nbrs, intra_num_nbrs]
+        all_mu = [all_mu, intra_mu]
+        all_pvals = [all_pvals, intra_pvals]
+    else:
+        all_num_nbrs, all_mu, all_pvals = [all_num_nbrs], [all_mu], [all_pvals]
 
-    n_bg_pairs = num_random_samples * num_random_samples
+    # the hits, ordered by clone, then radius, then global before intra
+    hit_inds = [np.nonzero(x) for x in hits]
+    hit_types = np.concatenate([np.full(len(x[0]), t) for t, x in enumerate(hit_inds)])
+    hit_clones = np.concatenate([x[0] for x in hit_inds])
+    hit_radii = np.concatenate([x[1] for x in hit_inds])
+    hit_order = np.lexsort((hit_types, hit_radii, hit_clones))
 
-    all_raw_pvalues = np.full((num_clones, len(radii)), 1.0)
-
-    for ii in range(num_clones):
-        ii_freqs = bg_freqs[ii]
-        ii_dists = all_distances[ii]
-        for irad, radius in enumerate(radii):
-            num_nbrs = np.sum(x<=radius for x in ii_dists)
-            if num_nbrs<1:
-                continue # NOTE: OK since wont have intra-cluster nbrs either
-            max_nbrs = np.sum((agroups!=agroups[ii]) & (bgroups!=bgroups[ii]))
-            # adjust for number of tests
-            mu = max_nbrs * ii_freqs[radius]
-            pval = poisson.sf(num_nbrs-1, mu)
-            all_raw_pvalues[ii, irad] = pval
-            pval *= len(radii) * num_clones # simple multiple test correction
-            if pval <= pvalue_threshold:
-                is_clumped[ii] = True
-                # count might just be pseudocount
-                raw_count = ii_freqs[radius]*n_bg_pairs
-                if verbose:
-                    atcr_str = ' '.join(tcrs[ii][0][:3])
-                    btcr_str = ' '.join(tcrs[ii][1][:3])
-                    print(f'tcr_nbrs_global: {num_nbrs:2d} {mu:9.6f}',
-                          f'radius: {radius:2d} pval: {pval:9.1e}',
-                          f'{raw_count:9.1f} tcr: {atcr_str} {btcr_str}')
-
-                dfl.append( OrderedDict(
-                    clump_type='global',
-                    clone_index=ii,
-                    nbr_radius=radius,
-                    pvalue_adj=pval,
-                    num_nbrs=num_nbrs,
-                    expected_num_nbrs=mu,
-                    raw_count=raw_count,
-                    va   =tcrs[ii][0][0],
-                    ja   =tcrs[ii][0][1],
-                    cdr3a=tcrs[ii][0][2],
-                    vb   =tcrs[ii][1][0],
-                    jb   =tcrs[ii][1][1],
-                    cdr3b=tcrs[ii][1][2],
-                ))
-            if clusters_gex is not None:
-                # look for clumping within the GEX cluster containing ii
-                ii_nbrs = all_nbrs[ii]
-                ii_cluster = clusters_gex[ii]
-                ii_cluster_mask = (clusters_gex==ii_cluster)
-                num_nbrs = np.sum((x<=radius and
-                                   clusters_gex[y]==ii_cluster)
-                                  for x,y in zip(ii_dists, ii_nbrs))
-                if num_nbrs<1:
-                    continue ## NOTE-- continue
-                max_nbrs = np.sum((agroups!=agroups[ii]) &
-                                  (bgroups!=bgroups[ii]) &
-                                  ii_cluster_mask)
-                mu = max_nbrs * ii_freqs[radius]
-                pval = (len(radii) * num_clones *
-                        poisson.sf(num_nbrs-1, mu ))
-                if pval <= pvalue_threshold:
-                    is_clumped[ii] = True
-                    # if count was 0, will be pseudocount
-                    raw_count = ii_freqs[radius]*n_bg_pairs
-                    if verbose:
-                        atcr_str = ' '.join(tcrs[ii][0][:3])
-                        btcr_str = ' '.join(tcrs[ii][1][:3])
-                        print(f'tcr_nbrs_intra: {num_nbrs:2d} {mu:9.6f}',
-                              f'radius: {radius:2d} pval: {pval:9.1e}',
-                              f'{raw_count:9.1f} tcr: {atcr_str} {btcr_str}')
-                    dfl.append( OrderedDict(
-                        clump_type='intra_gex_cluster',
-                        clone_index=ii,
-                        nbr_radius=radius,
-                        pvalue_adj=pval,
-                        num_nbrs=num_nbrs,
-                        expected_num_nbrs=mu,
-                        raw_count=raw_count,
-                        va   =tcrs[ii][0][0],
-                        ja   =tcrs[ii][0][1],
-                        cdr3a=tcrs[ii][0][2],
-                        vb   =tcrs[ii][1][0],
-                        jb   =tcrs[ii][1][1],
-                        cdr3b=tcrs[ii][1][2],
-                    ))
+    is_clumped = np.full((num_clones,), False)
+    is_clumped[hit_clones] = True
+
+    dfl = []
+    for t, ii, irad in zip(hit_types[hit_order], hit_clones[hit_order],
+                           hit_radii[hit_order]):
+        radius = radii[irad]
+        num_nbrs = all_num_nbrs[t][ii, irad]
+        mu = all_mu[t][ii, irad]
+        pval = all_pvals[t][ii, irad]
+        # count might just be pseudocount
+        raw_count = bg_freqs[ii, radius]*n_bg_pairs
+        if verbose:
+            atcr_str = ' '.join(tcrs[ii][0][:3])
+            btcr_str = ' '.join(tcrs[ii][1][:3])
+            tag = 'global' if t==0 else 'intra'
+            print(f'tcr_nbrs_{tag}: {num_nbrs:2d} {mu:9.6f}',
+                  f'radius: {radius:2d} pval: {pval:9.1e}',
+                  f'{raw_count:9.1f} tcr: {atcr_str} {btcr_str}')
+
+        dfl.append( OrderedDict(
+            clump_type=clump_types[t],
+            clone_index=ii,
+            nbr_radius=radius,
+            pvalue_adj=pval,
+            num_nbrs=num_nbrs,
+            expected_num_nbrs=mu,
+            raw_count=raw_count,
+            va   =tcrs[ii][0][0],
+            ja   =tcrs[ii][0][1],
+            cdr3a=tcrs[ii][0][2],
+            vb   =tcrs[ii][1][0],
+            jb   =tcrs[ii][1][1],
+            cdr3b=tcrs[ii][1][2],
+        ))
 
     results_df = pd.DataFrame(dfl)
     if results_df.shape[0] == 0:
@@ -325,60 +529,24 @@ def find_tcr_clumping(
                   else np.nan for x in results_df.itertuples()]
     results_df['clonotype_fdr_value'] = fdr_column
 
-    # identify groups of related hits?
-    all_clumped_nbrs = {}
+    # identify groups of related hits: single-linkage clusters of the clumped
+    #  clones, linked if within a significant nbr_radius of each other
+    edge_rows, edge_cols = [], []
     for l in results_df.itertuples():
         ii = l.clone_index
-        radius = l.nbr_radius
-        clumped_nbrs = set(x for x,y in zip(all_nbrs[ii], all_distances[ii])
-                           if y<= radius and is_clumped[x])
-        clumped_nbrs.add(ii)
-        if ii in all_clumped_nbrs:
-            all_clumped_nbrs[ii] = all_clumped_nbrs[ii] | clumped_nbrs
-        else:
-            all_clumped_nbrs[ii] = clumped_nbrs
-
-
-    clumped_inds = sorted(all_clumped_nbrs.keys())
-    assert len(clumped_inds) == np.sum(is_clumped)
-
-    # make nbrs symmetric
-    for ii in clumped_inds:
-        for nbr in all_clumped_nbrs[ii]:
-            assert nbr in all_clumped_nbrs
-            all_clumped_nbrs[nbr].add(ii)
-
-    all_smallest_nbr = {}
-    for ii in clumped_inds:
-        all_smallest_nbr[ii] = min(all_clumped_nbrs[ii])
-
-    while True:
-        updated = False
-        for ii in clumped_inds:
-            nbr = all_smallest_nbr[ii]
-            new_nbr = min(nbr, np.min([all_smallest_nbr[x]
-                                       for x in all_clumped_nbrs[ii]]))
-            if nbr != new_nbr:
-                all_smallest_nbr[ii] = new_nbr
-                updated = True
-        if not updated:
-            break
-
-    # define clusters, choose cluster centers
-    clusters = np.array([0]*num_clones) # 0 if not clumped
-
-    cluster_number=0
-    for ii in clumped_inds:
-        nbr = all_smallest_nbr[ii]
-        if ii==nbr:
-            cluster_number += 1
-            members = [ x for x,y in all_smallest_nbr.items() if y==nbr]
-            clusters[members] = cluster_number
-
-    for ii, nbrs in all_clumped_nbrs.items():
-        for nbr in nbrs:
-            # confirm single-linkage clusters
-            assert clusters[ii] == clusters[nbr]
+        ii_nbrs = indices[offsets[ii]:offsets[ii+1]]
+        ii_dists = distances[offsets[ii]:offsets[ii+1]]
+        clumped_nbrs = ii_nbrs[(ii_dists<=l.nbr_radius) & is_clumped[ii_nbrs]]
+        edge_rows.append(np.full((len(clumped_nbrs),), ii))
+        edge_cols.append(clumped_nbrs)
+    components = util.connected_components(
+        num_clones, np.concatenate(edge_rows), np.concatenate(edge_cols))
+
+    # number the clusters 1,2,... in order of their smallest member
+    clusters = np.zeros((num_clones,), dtype=int) # 0 if not clumped
+    clumped_components = components[is_clumped]
+    _, cluster_numbers = np.unique(clumped_components, return_inverse=True)
+    clusters[is_clumped] = cluster_numbers.ravel()+1
 
     assert not np.any(clusters[is_clumped]==0)
     assert np.all(clusters[~is_clumped]==0)
@@ -504,7 +672,7 @@ def find_significant_tcrdist_matches(
             organism, background_tcrs, verbose=False)
 
 
-    max_dist = 200
+    max_dist = BACKGROUND_MAX_DIST
 
     bg_freqs = estimate_background_tcrdist_distributions(
         organism, query_tcrs, max_dist,
@@ -525,33 +693,47 @@ def find_significant_tcrdist_matches(
           f'max_dist_for_matching: {max_dist_for_matching}')
 
     # now run C++ matching code
-    query_tcrs_file = tmpfile_prefix+'temp_query_tcrs.tsv'
-    db_tcrs_file = tmpfile_prefix+'temp_db_tcrs.tsv'
-    query_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(query_tcrs_file, sep='\t',
-                                                      index=False)
-    db_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(db_tcrs_file, sep='\t',
-                                                   index=False)
-
-    if os.name == 'posix':
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_paired_matches')
+    if util.tcrdist_cpp_lib_available(): # compute in-process
+        offsets, indices, distances = tcrdist_cpp.find_paired_matches(
+            query_tcrs, db_tcrs, organism, max_dist_for_matching)
+        index1 = np.repeat(np.arange(len(query_tcrs)), np.diff(offsets))
+        df = pd.DataFrame(dict(
+            tcrdist=distances.astype(int),
+            index1=index1,
+            index2=indices,
+            cdr3b1=[query_tcrs[i][1][2] for i in index1],
+            cdr3b2=[db_tcrs[j][1][2] for j in indices],
+        ))
+        tmpfiles = []
     else:
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_paired_matches.exe')
+        query_tcrs_file = tmpfile_prefix+'temp_query_tcrs.tsv'
+        db_tcrs_file = tmpfile_prefix+'temp_db_tcrs.tsv'
+        query_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(query_tcrs_file, sep='\t',
+                                                          index=False)
+        db_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(db_tcrs_file, sep='\t',
+                                                       index=False)
+
+        if os.name == 'posix':
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_paired_matches')
+        else:
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_paired_matches.exe')
 
-    if not exists(exe):
-        print('ERROR: find_paired_matches:: tcrdist_cpp executable {exe} is missing')
-        print('ERROR: see instructions in github repository README for compiling')
-        return
+        if not exists(exe):
+            print('ERROR: find_paired_matches:: tcrdist_cpp executable {exe} is missing')
+            print('ERROR: see instructions in github repository README for compiling')
+            return
 
-    db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
+        db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
 
-    outfilename = tmpfile_prefix+'temp_tcr_matching.tsv'
+        outfilename = tmpfile_prefix+'temp_tcr_matching.tsv'
 
-    cmd = '{} -i {} -j {} -t {} -d {} -o {}'\
-          .format(exe, query_tcrs_file, db_tcrs_file, max_dist_for_matching, db_filename, outfilename)
+        cmd = '{} -i {} -j {} -t {} -d {} -o {}'\
+              .format(exe, query_tcrs_file, db_tcrs_file, max_dist_for_matching, db_filename, outfilename)
 
-    util.run_command(cmd, verbose=True)
+        util.run_command(cmd, verbose=True)
 
-    df = pd.read_csv(outfilename, sep='\t')
+        df = pd.read_csv(outfilename, sep='\t')
+        tmpfiles = [outfilename, query_tcrs_file, db_tcrs_file]
 
     num_matches = df.shape[0]
     raw_pvalues = [bg_freqs[x.index1][x.tcrdist] for x in df.itertuples()]
@@ -595,9 +777,8 @@ def find_significant_tcrdist_matches(
         dfl.append(D)
 
     if not nocleanup:
-        os.remove(outfilename)
-        os.remove(query_tcrs_file)
-        os.remove(db_tcrs_file)
+        for filename in tmpfiles:
+            os.remove(filename)
 
     results_df = pd.DataFrame(dfl)
     if dfl:
@@ -397,12 +397,7 @@ def make_default_logo_svg_cmds(
 
     ## compute distances, used in logo construction for picking the center tcr for aligning against
     #print 'computing distances:',len(dist_tcrs)
-    all_dists = np.zeros( ( len(dist_tcrs), len(dist_tcrs)) )
-    for i,t1 in enumerate( dist_tcrs ):
-        for j in range(i+1,len(dist_tcrs)):
-            dist = tcrdist_calculator.single_chain_distance(t1, dist_tcrs[j])
-            all_dists[i][j] = dist
-            all_dists[j][i] = dist
+    all_dists = tcrdist_calculator.single_chain_pairwise(dist_tcrs)
 
     # now make the logo
     members = list(range(len(tcrs)))
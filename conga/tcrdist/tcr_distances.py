@@ -2,6 +2,7 @@ from .basic import *
 from .all_genes import all_genes, gap_character
 from .amino_acids import amino_acids
 from .tcr_distances_blosum import blosum, bsd4
+import numpy as np
 
 ## see the TcrDistCalculator at the end for simple tcrdist calculations
 
@@ -160,6 +161,77 @@ def weighted_cdr3_distance( seq1, seq2 ):
     ##
     return  WEIGHT_CDR3_REGION * best_dist + lendiff * GAP_PENALTY_CDR3_REGION
 
+def _cdr3_distance_lookup_table():
+    ''' DISTANCE_MATRIX as a 21x21 array indexed by position in amino_acids; the
+    extra last row/column is for padding
+    '''
+    num_aas = len(amino_acids)
+    table = np.zeros((num_aas+1, num_aas+1))
+    for i,a in enumerate(amino_acids):
+        for j,b in enumerate(amino_acids):
+            table[i,j] = DISTANCE_MATRIX[(a,b)]
+    return table
+
+def _encode_cdr3s( cdr3s ):
+    ''' returns lens, fwd, rev where fwd[i,k] and rev[i,k] are the indices (into
+    amino_acids) of cdr3s[i][k] and cdr3s[i][-1-k], padded with len(amino_acids)
+    '''
+    aa2index = {aa:i for i,aa in enumerate(amino_acids)}
+    lens = np.array([len(x) for x in cdr3s], dtype=int)
+    maxlen = max(lens) if len(cdr3s) else 0
+    fwd = np.full((len(cdr3s), maxlen), len(amino_acids), dtype=int)
+    rev = np.full((len(cdr3s), maxlen), len(amino_acids), dtype=int)
+    for i, cdr3 in enumerate(cdr3s):
+        inds = [aa2index[aa] for aa in cdr3]
+        fwd[i,:len(cdr3)] = inds
+        rev[i,:len(cdr3)] = inds[::-1]
+    return lens, fwd, rev
+
+def weighted_cdr3_distance_matrix( cdr3s1, cdr3s2, max_block_size=4000000 ):
+    ''' returns the matrix D[i,j] = weighted_cdr3_distance(cdr3s1[i], cdr3s2[j])
+
+    vectorized with numpy: the cdr3s are encoded as padded integer arrays, aligned
+    from the start (N-terminal side of the gap) and from the end (C-terminal side),
+    and the fixed-gappos rule is applied with masks. Works on blocks of rows with
+    at most max_block_size entries at a time.
+    '''
+    if ALIGN_CDR3S: # no fixed gappos, fall back to the slow way
+        return np.array([[weighted_cdr3_distance(x,y) for y in cdr3s2]
+                         for x in cdr3s1]).reshape((len(cdr3s1), len(cdr3s2)))
+
+    ntrim = 3 if TRIM_CDR3S else 0
+    ctrim = 2 if TRIM_CDR3S else 0
+    table = _cdr3_distance_lookup_table()
+    lens1, fwd1, rev1 = _encode_cdr3s(cdr3s1)
+    lens2, fwd2, rev2 = _encode_cdr3s(cdr3s2)
+    maxlen = min(fwd1.shape[1], fwd2.shape[1])
+
+    D = np.zeros((len(cdr3s1), len(cdr3s2)))
+    block_size = max(1, max_block_size//max(1, len(cdr3s2)))
+    for start in range(0, len(cdr3s1), block_size):
+        stop = min(len(cdr3s1), start+block_size)
+        lenshort = np.minimum(lens1[start:stop,None], lens2[None,:])
+        lendiff = np.abs(lens1[start:stop,None] - lens2[None,:])
+        assert np.all(lenshort > 1)
+        if TRIM_CDR3S:
+            assert np.all(lenshort >= 3+2)
+        gappos = np.minimum( 6, 3 + (lenshort-5)//2 )
+        remainder = lenshort - gappos
+
+        dist = np.zeros(lenshort.shape)
+        for k in range(ntrim, min(6, maxlen)): # gappos <= 6
+            mask = k < gappos
+            dist[mask] += table[fwd1[start:stop,k,None], fwd2[None,:,k]][mask]
+        for k in range(ctrim, maxlen):
+            mask = k < remainder
+            if not np.any(mask):
+                break
+            dist[mask] += table[rev1[start:stop,k,None], rev2[None,:,k]][mask]
+
+        ## Note that WEIGHT_CDR3_REGION is not applied to the gap penalty
+        D[start:stop,:] = WEIGHT_CDR3_REGION * dist + lendiff * GAP_PENALTY_CDR3_REGION
+    return D
+
 def compute_all_v_region_distances( organism ):
     rep_dists = {}
     for chain in 'AB': # don't compute inter-chain distances
@@ -251,5 +323,49 @@ class TcrDistCalculator:
         return self.rep_dists[chain1[0]][chain2[0]] + weighted_cdr3_distance(chain1[2], chain2[2])
 
 
+    def single_chain_pairwise(self, chains1, chains2=None):
+        ''' returns the matrix D[i,j] = single_chain_distance(chains1[i], chains2[j])
+        (default: chains2=chains1), vectorized with numpy
+        '''
+        if chains2 is None:
+            chains2 = chains1
+        vs1 = sorted(set(x[0] for x in chains1))
+        vs2 = sorted(set(x[0] for x in chains2))
+        V = np.array([[self.rep_dists[v1][v2] for v2 in vs2] for v1 in vs1])\
+              .reshape((len(vs1), len(vs2)))
+        v2ind1 = {v:i for i,v in enumerate(vs1)}
+        v2ind2 = {v:i for i,v in enumerate(vs2)}
+        vinds1 = np.array([v2ind1[x[0]] for x in chains1], dtype=int)
+        vinds2 = np.array([v2ind2[x[0]] for x in chains2], dtype=int)
+        return V[vinds1][:,vinds2] + weighted_cdr3_distance_matrix(
+            [x[2] for x in chains1], [x[2] for x in chains2])
+
+
+    def pairwise(self, tcrs1, tcrs2=None):
+        ''' returns the matrix D[i,j] = self(tcrs1[i], tcrs2[j]) (default: tcrs2=tcrs1)
+
+        Since the paired distance is the alpha distance plus the beta distance, we
+        only compute single-chain distances between the unique alpha and beta chains
+        (by V gene and CDR3), with single_chain_pairwise, and then each paired distance
+        is two table lookups.
+        '''
+        if tcrs2 is None:
+            tcrs2 = tcrs1
+
+        D = np.zeros((len(tcrs1), len(tcrs2)))
+        for ic in range(2):
+            # map each tcr to the index of its chain in the list of unique chains
+            chain_index1, chain_index2 = {}, {}
+            inds1 = [chain_index1.setdefault((x[ic][0], x[ic][2]), len(chain_index1))
+                     for x in tcrs1]
+            inds2 = [chain_index2.setdefault((x[ic][0], x[ic][2]), len(chain_index2))
+                     for x in tcrs2]
+            chain_D = self.single_chain_pairwise(
+                [(v,None,cdr3) for v,cdr3 in chain_index1],
+                [(v,None,cdr3) for v,cdr3 in chain_index2])
+            D += chain_D[np.array(inds1, dtype=int)][:,np.array(inds2, dtype=int)]
+        return D
+
+
 
 
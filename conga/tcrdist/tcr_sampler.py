@@ -1,6 +1,7 @@
 import sys
 import random
 from collections import OrderedDict, Counter
+import numpy as np
 import pandas as pd
 from .basic import *
 from . import translation
@@ -448,103 +449,164 @@ def vj_compatible(v_gene, j_gene, organism):
     else:
         return True
 
+def _junction_breakpoint_masks(nucseq_srcs, max_len):
+    ''' Returns masks, a boolean array of shape (2, num_junctions, 2*max_len) with the
+    acceptable breakpoints before (masks[0]) and after (masks[1]) the D segment
+
+    column bp (for 0 < bp < max_len) is breakpoint bp, counted from the start, and
+    column max_len+k is breakpoint -k (counted from the back): the breakpoint is the
+    index we can use as in  nucseq = nucseq1[:breakpoint] + nucseq2[breakpoint:]
+    '''
+    num = len(nucseq_srcs)
+    lens = np.array([len(x) for x in nucseq_srcs])
+    src = np.full((num, max_len), ' ', dtype='U1')
+    for ii, nucseq_src in enumerate(nucseq_srcs):
+        src[ii,:len(nucseq_src)] = list(nucseq_src)
+
+    masks = np.zeros((2, num, 2*max_len), dtype=bool)
+    rows = np.arange(num)
+    post_d = np.zeros(num, dtype=bool)
+    for ii in range(1, max_len):
+        ## ii refers to the breakpoint between position ii-1 and position ii
+        ## ie, right before position ii
+        a, b = src[:,ii-1], src[:,ii]
+        post_d |= (a=='D')
+        # dont allow breakpoints in the middle of V D or J
+        ok = (ii < lens) & ((a!=b) | (a=='N'))
+        region = post_d[ok].astype(int)
+        masks[region, rows[ok], ii] = True
+        masks[region, rows[ok], max_len + lens[ok] - ii] = True
+    return masks
+
+def _codon_table(alphabet):
+    ''' Returns the amino acids (as uint8 ascii) for all codons over alphabet, indexed
+    by the codon's alphabet indices c0*K*K + c1*K + c2. Same as translation.get_translation
+    '''
+    aas = []
+    for a in alphabet:
+        for b in alphabet:
+            for c in alphabet:
+                codon = (a+b+c).lower()
+                aas.append('#' if '#' in codon else genetic_code.get(codon, 'X'))
+    return np.array([ord(x) for x in aas], dtype=np.uint8)
+
 def resample_shuffled_tcr_chains(
         organism,
         num_samples,
         chain, # 'A' or 'B'
         junctions_df, # dataframe made by the above function
+        random_seed = None, # default is to take a seed from the random module
+        block_size = 10000, # number of candidate pairs to try at once
 ):
     ''' returns list of (v_gene, j_gene, cdr3, cdr3_nucseq) for inputting into tcrdist calcs (e.g.)
+
+    repeat:
+    choose 2 random tcrs; are their breakpoints compatible?
+    if so, choose random compatible breakpoint, make frankentcr
+
+    The candidate pairs are drawn and translated in numpy blocks. The result only
+    depends on random_seed (and the inputs), so backgrounds can be regenerated, or
+    made in parallel with different seeds.
     '''
     assert chain in ['A', 'B']
-    # need list of (v_gene, j_gene, cdr3_nucseq, breakpoints_pre_d, breakpoints_post_d)
-    # breakpoints sets could contain negative numbers: that means read from the back
-    #
-    junctions = []
-    for l in junctions_df.itertuples():
-        # where are the acceptable breakpoints?
-        # dont allow breakpoints in the middle of V D or J
-        # the breakpoint is the index we can use as in  nucseq = nucseq1[:breakpoint] + nucseq2[breakpoint:]
-        breakpoints_pre_d = set()
-        breakpoints_post_d = set()
-        nucseq_src = l.cdr3a_nucseq_src if chain == 'A' else l.cdr3b_nucseq_src
-        #
-        post_d = False
-        for ii in range(1,len(nucseq_src)):
-            ## ii refers to the breakpoint between position ii-1 and position ii
-            ## ie, right before position ii
-            a,b = nucseq_src[ii-1], nucseq_src[ii]
-            if a=='D':
-                post_d = True
-            if a==b and a!='N':
-                #bad
-                pass
-            else:
-                # -1 would be ii==len(nucseq_src)-1
-                for bp in [ii, ii-len(nucseq_src)]:
-                    if post_d:
-                        breakpoints_post_d.add(bp)
-                    else:
-                        breakpoints_pre_d.add(bp)
-        if chain=='A':
-            junctions.append( (l.va, l.ja, l.cdr3a_nucseq,
-                               breakpoints_pre_d, breakpoints_post_d))
-        else:
-            junctions.append( (l.vb, l.jb, l.cdr3b_nucseq,
-                               breakpoints_pre_d, breakpoints_post_d))
-
-    # repeat:
-    # choose 2 random tcrs; are their breakpoints compatible?
-    # if so, choose random compatible breakpoint, make frankentcr
+    if random_seed is None:
+        random_seed = random.randrange(2**32) # so random.seed still makes it reproducible
+    rng = np.random.RandomState(random_seed)
 
+    if chain == 'A':
+        v_genes, j_genes = list(junctions_df.va), list(junctions_df.ja)
+        nucseqs, nucseq_srcs = list(junctions_df.cdr3a_nucseq), list(junctions_df.cdr3a_nucseq_src)
+    else:
+        v_genes, j_genes = list(junctions_df.vb), list(junctions_df.jb)
+        nucseqs, nucseq_srcs = list(junctions_df.cdr3b_nucseq), list(junctions_df.cdr3b_nucseq_src)
+    num_junctions = len(nucseqs)
+    lens = np.array([len(x) for x in nucseqs])
+    max_len = 3*((max(lens)+2)//3) # whole number of codons
 
-    new_tcrs = []
+    # breakpoints sets could contain negative numbers: that means read from the back
+    masks = _junction_breakpoint_masks(nucseq_srcs, max_len)
+    num_regions = 1 if chain == 'A' else 2 # before/after the D segment
+
+    # nucleotide sequences as indices into alphabet (index 0 is padding)
+    alphabet = ['\0'] + sorted(set(''.join(nucseqs)))
+    alphabet_index = {x:ii for ii,x in enumerate(alphabet)}
+    alphabet_ascii = np.array([ord(x) for x in alphabet], dtype=np.uint8)
+    K = len(alphabet)
+    codes = np.zeros((num_junctions, max_len+1), dtype=np.uint8) # last column is padding
+    for ii, nucseq in enumerate(nucseqs):
+        codes[ii,:len(nucseq)] = [alphabet_index[x] for x in nucseq]
+    codon_table = _codon_table(alphabet)
+    codon_table[0] = 0 # padding
+
+    nucseq_ids = pd.factorize(pd.Series(nucseqs))[0]
+    v_ids, v_list = pd.factorize(pd.Series(v_genes))
+    j_ids, j_list = pd.factorize(pd.Series(j_genes))
+    v_genes, j_genes = np.array(v_genes, dtype=object), np.array(j_genes, dtype=object)
+    vj_ok = np.array([[vj_compatible(v, j, organism) for j in j_list] for v in v_list])
+
+    positions = np.arange(max_len)
+    new_v_genes, new_j_genes, new_cdr3s, new_nucseqs = [], [], [], []
     attempts = 0
     successes = 0
-    while len(new_tcrs) < num_samples:
-        #print(len(new_tcrs))
-
-        t1 = random.choice(junctions)
-        t2 = random.choice(junctions)
-        nucseq1 = t1[2]
-        nucseq2 = t2[2]
-        if nucseq1 == nucseq2:
-            continue
-
-        if not vj_compatible(t1[0], t2[1], organism):
-            continue
-
-        inds = [3] if chain=='A' else [3,4]
-        random.shuffle(inds)
-
-        success = False
-        for ind in inds:
-            shared = t1[ind] & t2[ind]
-            if shared:
-                bp = random.choice(list(shared))
-                nucseq = nucseq1[: bp] + nucseq2[bp :]
-                assert len(nucseq)%3==0
-                if bp<0: # DEBUGGING
-                    assert len(nucseq) == len(nucseq1)
-                else:
-                    assert len(nucseq) == len(nucseq2)
-                # but is there a stop codon??
-                cdr3 = translation.get_translation(nucseq)
-                assert len(cdr3) == len(nucseq)//3
-                if '*' not in cdr3:
-                    success = True
-                    t_new = ( t1[0], t2[1], cdr3, nucseq)
-                    # print('t1', translation.get_translation(t1[2]), t1)
-                    # print('t2', translation.get_translation(t2[2]), t2)
-                    # print('tn', translation.get_translation(t_new[3]), t_new)
-                    # print(bp, nucseq)
-                    new_tcrs.append(t_new)
-                    break
-        #print('success:', success)
-        attempts += 1
-        successes += success
-        if success and len(new_tcrs) >= num_samples:
-            break
+    while successes < num_samples:
+        t1 = rng.randint(num_junctions, size=block_size)
+        t2 = rng.randint(num_junctions, size=block_size)
+        # pairs with the same nucseq or incompatible V and J don't count as attempts
+        valid = (nucseq_ids[t1] != nucseq_ids[t2]) & vj_ok[v_ids[t1], j_ids[t2]]
+        t1, t2 = t1[valid], t2[valid]
+        num = len(t1)
+        first_region = (np.zeros(num, dtype=int) if num_regions == 1 else
+                        rng.randint(2, size=num)) # the order to try the regions in
+        success = np.zeros(num, dtype=bool)
+        new_nucseq_codes = np.zeros((num, max_len), dtype=np.uint8)
+        new_cdr3_ascii = np.zeros((num, max_len//3), dtype=np.uint8)
+        for r in range(num_regions):
+            region = (first_region + r) % num_regions
+            shared = masks[region, t1] & masks[region, t2]
+            num_shared = shared.sum(axis=1)
+            choice = (rng.random_sample(num) * num_shared).astype(int)
+            # only build the rows that still need a tcr and have a shared breakpoint
+            rows = np.nonzero((num_shared > 0) & ~success)[0]
+            r1, r2 = t1[rows], t2[rows]
+
+            # uniform random choice among the shared breakpoints
+            col = np.argmax(np.cumsum(shared[rows], axis=1, dtype=np.int16) >
+                            choice[rows,None], axis=1)
+            bp = np.where(col < max_len, col, max_len - col)
+
+            # nucseq = nucseq1[: bp] + nucseq2[bp :]
+            len1, len2 = lens[r1], lens[r2]
+            cut1 = np.where(bp < 0, len1+bp, bp)
+            cut2 = np.where(bp < 0, len2+bp, bp)
+            from2 = positions[None,:] >= cut1[:,None]
+            src2 = np.minimum(positions[None,:] - cut1[:,None] + cut2[:,None], max_len)
+            nucseq_codes = codes[r1,:max_len]
+            nucseq_codes[from2] = codes[r2[:,None], src2][from2]
+            assert np.all((cut1 + len2 - cut2) % 3 == 0)
+
+            # but is there a stop codon?? (padding translates to 0)
+            cdr3_ascii = codon_table[nucseq_codes[:,0::3].astype(np.int64)*K*K +
+                                     nucseq_codes[:,1::3]*K + nucseq_codes[:,2::3]]
+            ok = ~np.any(cdr3_ascii == ord('*'), axis=1)
+            rows, ok_rows = rows[ok], np.nonzero(ok)[0]
+            new_nucseq_codes[rows] = nucseq_codes[ok_rows]
+            new_cdr3_ascii[rows] = cdr3_ascii[ok_rows]
+            success[rows] = True
+
+        # keep the attempts up to the last success we need
+        inds = np.nonzero(success)[0][:num_samples-successes]
+        if len(inds) == num_samples-successes:
+            num = inds[-1]+1
+        attempts += num
+        successes += len(inds)
+        # null-padded rows --> strings
+        new_nucseqs.extend(alphabet_ascii[new_nucseq_codes[inds]].view(f'S{max_len}')
+                           .ravel().astype(str).tolist())
+        new_cdr3s.extend(new_cdr3_ascii[inds].view(f'S{max_len//3}').ravel()
+                         .astype(str).tolist())
+        new_v_genes.extend(v_genes[t1[inds]].tolist())
+        new_j_genes.extend(j_genes[t2[inds]].tolist())
+    new_tcrs = list(zip(new_v_genes, new_j_genes, new_cdr3s, new_nucseqs))
     print(f'success_rate: {100.0*successes/attempts:.2f}')
     return new_tcrs
 
@@ -0,0 +1,464 @@
+''' Persistent on-disk cache for tcrdist calculations
+
+The same clonotypes tend to get their tcrdists computed over and over (kernel PCA in
+setup_10x_for_conga.py and merge_samples.py, the exact tcrdist nbrs and tcr clumping
+in run_conga.py, the tcrdist trees...). This cache keeps the results on disk so later
+runs can reuse them. Everything is content-addressed: keys are sha1 hashes of the
+organism and the chain sequences (V gene + CDR3), so it doesn't matter which file or
+run the tcrs came from.
+
+Turn it on with set_cache_dir(), or by setting the CONGA_TCRDIST_CACHE_DIR environment
+variable (and optionally CONGA_TCRDIST_CACHE_MAX_GB). get_cache() returns None if it's
+off.
+
+There are two kinds of entries:
+
+* single-chain distance blocks: the unique alpha (or beta) chains are sorted and split
+  into content-defined chunks, where a chunk ends after any chain whose hash is 0 mod
+  CHUNK_SIZE. So adding new chains (eg, a cohort that grows) only changes the chunks
+  they land in, and the blocks between unchanged chunks are reused. A block is the
+  distance matrix between two chunks. Paired distance matrices are assembled from the
+  blocks (see TcrdistCache.paired_tcrdist_matrix).
+
+* neighbor lists (knn or threshold nbrs) keyed by the tcrs (in order) and the
+  agroups/bgroups. A knn entry serves any num_nbrs <= the stored one (so a re-analysis
+  with smaller nbr_fracs is free) and a threshold entry any threshold <= the stored
+  one.
+
+* background tcrdist models (see tcr_clumping.TcrdistBackgroundModel): the shuffled
+  background chains, keyed by background_model_key, and the background paired
+  distance counts for a list of tcrs, which serve any max_dist <= the stored one.
+
+Entries are .npy files in the cache directory; manifest.json records their sizes and
+last access times. When the total size goes over the cap, the least recently used
+entries are removed.
+
+'''
+import hashlib
+import json
+import os
+import time
+from os.path import exists
+from pathlib import Path
+import numpy as np
+from . import util
+from . import tcrdist_cpp
+from .tcrdist.tcr_distances import TcrDistCalculator
+
+DEFAULT_MAX_GB = 10.0
+CHUNK_SIZE = 512 # expected number of chains per chunk
+MANIFEST = 'manifest.json'
+
+_default_cache = None
+_calculators = {} # organism --> python TcrDistCalculator, if we don't have the C++ lib
+
+
+def set_cache_dir(cache_dir, max_gb=DEFAULT_MAX_GB):
+    ''' Turn on the default cache (cache_dir=None turns it off)
+    '''
+    global _default_cache
+    _default_cache = None if cache_dir is None else TcrdistCache(cache_dir, max_gb)
+    return _default_cache
+
+def get_cache():
+    ''' Returns the default cache, or None if it's not turned on
+    '''
+    global _default_cache
+    if _default_cache is None and os.environ.get('CONGA_TCRDIST_CACHE_DIR'):
+        _default_cache = TcrdistCache(
+            os.environ['CONGA_TCRDIST_CACHE_DIR'],
+            float(os.environ.get('CONGA_TCRDIST_CACHE_MAX_GB', DEFAULT_MAX_GB)))
+    return _default_cache
+
+
+def _sha1(strs):
+    h = hashlib.sha1()
+    for s in strs:
+        h.update(str(s).encode())
+        h.update(b'\n')
+    return h.hexdigest()
+
+def _chunk_ranges(chains):
+    ''' chains is a sorted list of unique (v, cdr3); returns a list of (start, stop)
+    '''
+    ranges, start = [], 0
+    for ii, (v, cdr3) in enumerate(chains):
+        if int(hashlib.sha1(f'{v},{cdr3}'.encode()).hexdigest()[:8], 16)%CHUNK_SIZE==0:
+            ranges.append((start, ii+1))
+            start = ii+1
+    if start < len(chains):
+        ranges.append((start, len(chains)))
+    return ranges
+
+def _compute_single_chain_distances(organism, chain, rows, cols):
+    ''' rows and cols are lists of (v, cdr3); returns a float32 matrix
+    '''
+    chains1 = [(v, None, cdr3) for v, cdr3 in rows]
+    chains2 = [(v, None, cdr3) for v, cdr3 in cols]
+    if util.tcrdist_cpp_lib_available():
+        return tcrdist_cpp.calc_single_chain_tcrdist_matrix(
+            chains1, organism, chain, chains2)
+    if organism not in _calculators:
+        _calculators[organism] = TcrDistCalculator(organism)
+    return _calculators[organism].single_chain_pairwise(chains1, chains2)\
+                                 .astype(np.float32)
+
+def _tcrs_key(kind, organism, tcrs, agroups, bgroups):
+    strs = [kind, organism]
+    strs.extend(f'{x[0][0]},{x[0][2]},{x[1][0]},{x[1][2]}' for x in tcrs)
+    for groups in [agroups, bgroups]:
+        strs.append('None' if groups is None else
+                    ','.join(str(x) for x in np.asarray(groups).tolist()))
+    return _sha1(strs)
+
+
+def background_model_key(
+        organism,
+        tcrs_for_background_generation,
+        num_random_samples,
+        background_alpha_chains = None,
+        background_beta_chains = None,
+        random_seed = None,
+):
+    ''' Key for the background chains made by shuffling tcrs_for_background_generation
+    (or given explicitly)
+    '''
+    strs = ['background', organism, num_random_samples]
+    strs.extend(','.join(str(x) for x in atcr+btcr)
+                for atcr, btcr in tcrs_for_background_generation)
+    for chains in [background_alpha_chains, background_beta_chains]:
+        strs.append('None' if chains is None else
+                    ';'.join(','.join(str(x) for x in chain) for chain in chains))
+    if random_seed is not None: # unseeded keys are unchanged
+        strs.append(f'random_seed={random_seed}')
+    return _sha1(strs)
+
+def background_counts_key(model_key, organism, tcrs):
+    ''' Key for the background counts of tcrs versus the model with model_key. The
+    counts only depend on the V genes and CDR3s
+    '''
+    return _tcrs_key('background_counts_'+model_key, organism, tcrs, None, None)
+
+
+class TcrdistCache():
+    def __init__(self, cache_dir, max_gb=DEFAULT_MAX_GB):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = int(max_gb * 2**30)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries = self._read_manifest()
+        self._removed = set()
+        self._dirty = False
+
+    def _read_manifest(self):
+        filename = self.cache_dir / MANIFEST
+        if not exists(filename):
+            return {}
+        try:
+            with open(filename, 'r') as data:
+                return json.load(data)
+        except ValueError:
+            print('conga.tcrdist_cache:: ignoring unreadable manifest:', filename)
+            return {}
+
+    def _filename(self, key, name):
+        return self.cache_dir / f'{key}_{name}.npy'
+
+    def get(self, key):
+        ''' Returns a dict {name: array} or None if key is not in the cache
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        try:
+            arrays = {name: np.load(self._filename(key, name))
+                      for name in entry['names']}
+        except (OSError, ValueError): # eg, evicted by another process
+            del self._entries[key]
+            self._removed.add(key)
+            self._dirty = True
+            return None
+        entry['last_access'] = time.time()
+        self._dirty = True
+        return arrays
+
+    def put(self, key, arrays, **info):
+        ''' Store the dict {name: array} under key, along with some json-able info
+        '''
+        nbytes = 0
+        for name, A in arrays.items():
+            filename = self._filename(key, name)
+            tmpfile = f'{filename}.{os.getpid()}.tmp'
+            with open(tmpfile, 'wb') as out:
+                np.save(out, A)
+            os.replace(tmpfile, filename) # so readers never see a partial file
+            nbytes += os.path.getsize(filename)
+        self._entries[key] = dict(info, names=sorted(arrays), nbytes=nbytes,
+                                  last_access=time.time())
+        self._removed.discard(key)
+        self._dirty = True
+        # enforce the size cap as we go, not just at the next save()
+        if sum(x['nbytes'] for x in self._entries.values()) > self.max_bytes:
+            self.save()
+
+    def save(self):
+        ''' Write the manifest, removing least-recently-used entries if we are over the
+        size cap. Merges with the manifest on disk in case another process has been
+        using the cache too.
+        '''
+        if not self._dirty:
+            return
+        entries = self._read_manifest()
+        for key, entry in self._entries.items():
+            if key not in entries or entries[key]['last_access']<entry['last_access']:
+                entries[key] = entry
+        for key in self._removed:
+            entries.pop(key, None)
+
+        total = sum(x['nbytes'] for x in entries.values())
+        for key in sorted(entries, key=lambda x:entries[x]['last_access']):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]['nbytes']
+            for name in entries[key]['names']:
+                try:
+                    os.remove(self._filename(key, name))
+                except FileNotFoundError:
+                    pass
+            del entries[key]
+
+        filename = self.cache_dir / MANIFEST
+        tmpfile = f'{filename}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as out:
+            json.dump(entries, out)
+        os.replace(tmpfile, filename)
+        self._entries = entries
+        self._removed = set()
+        self._dirty = False
+
+    ## single-chain distances ##########################################################
+
+    def _block(self, organism, chain, key1, key2):
+        ''' Returns the cached distances between chunks key1 and key2, or None
+        '''
+        if key1 <= key2:
+            arrays = self.get(_sha1(['block', organism, chain, key1, key2]))
+            return None if arrays is None else arrays['D']
+        else: # stored the other way around
+            arrays = self.get(_sha1(['block', organism, chain, key2, key1]))
+            return None if arrays is None else arrays['D'].T
+
+    def _put_block(self, organism, chain, key1, key2, D):
+        if key1 <= key2:
+            self.put(_sha1(['block', organism, chain, key1, key2]), {'D':D})
+        else:
+            self.put(_sha1(['block', organism, chain, key2, key1]), {'D':D.T})
+
+    def single_chain_tcrdist_matrix(self, organism, chain, rows, cols=None):
+        ''' rows and cols (default: cols=rows) are sorted lists of unique (v, cdr3)
+        and chain is 'A' or 'B'
+
+        returns the float32 distance matrix of shape (len(rows), len(cols)),
+        computing only the blocks that aren't already in the cache. The new blocks are
+        only stored if the whole matrix fits under the cache's size cap (otherwise
+        we would just be writing blocks to disk to evict them again)
+        '''
+        if cols is None:
+            cols = rows
+        D = np.zeros((len(rows), len(cols)), dtype=np.float32)
+        store_blocks = D.nbytes <= self.max_bytes
+        if not store_blocks:
+            print(f'conga.tcrdist_cache:: {chain} chain distance matrix is bigger than',
+                  'the cache size cap, not caching new blocks')
+
+        def chunk_keys(chains, ranges):
+            return [_sha1(f'{v},{cdr3}' for v, cdr3 in chains[start:stop])
+                    for start, stop in ranges]
+        row_ranges, col_ranges = _chunk_ranges(rows), _chunk_ranges(cols)
+        row_keys = chunk_keys(rows, row_ranges)
+        col_keys = row_keys if cols is rows else chunk_keys(cols, col_ranges)
+
+        num_computed = 0
+        for (r0, r1), rkey in zip(row_ranges, row_keys):
+            missing = []
+            for (c0, c1), ckey in zip(col_ranges, col_keys):
+                block = self._block(organism, chain, rkey, ckey)
+                if block is None:
+                    missing.append((c0, c1, ckey))
+                else:
+                    D[r0:r1, c0:c1] = block
+            if not missing:
+                continue
+            # compute all the missing blocks for this row chunk in one go
+            missing_cols = [x for c0, c1, _ in missing for x in cols[c0:c1]]
+            new_D = _compute_single_chain_distances(
+                organism, chain, rows[r0:r1], missing_cols)
+            start = 0
+            for c0, c1, ckey in missing:
+                block = new_D[:, start:start+c1-c0]
+                D[r0:r1, c0:c1] = block
+                if store_blocks:
+                    self._put_block(organism, chain, rkey, ckey, block)
+                start += c1-c0
+            num_computed += new_D.size
+        if num_computed:
+            print(f'conga.tcrdist_cache:: computed {num_computed} of {D.size}',
+                  f'{chain} chain distances')
+        self.save()
+        return D
+
+    def paired_tcrdist_matrix(self, organism, tcrs, tcrs2=None, block_size=4096):
+        ''' Returns the paired tcrdist matrix between tcrs and tcrs2 (default:
+        tcrs2=tcrs), rounded like the C++ code, as a float32 numpy array
+
+        the chain matrices are added into D in row blocks, so the only N x N array
+        is D itself
+        '''
+        D = np.zeros((len(tcrs), len(tcrs if tcrs2 is None else tcrs2)),
+                     dtype=np.float32)
+        if not D.size:
+            return D
+        for ic, chain in enumerate('AB'):
+            keys1 = [(x[ic][0], x[ic][2]) for x in tcrs]
+            rows = sorted(set(keys1))
+            if tcrs2 is None:
+                keys2, cols = keys1, rows
+            else:
+                keys2 = [(x[ic][0], x[ic][2]) for x in tcrs2]
+                cols = sorted(set(keys2))
+            chain_D = self.single_chain_tcrdist_matrix(organism, chain, rows, cols)
+            row_index = {x:i for i,x in enumerate(rows)}
+            col_index = row_index if cols is rows else {x:i for i,x in enumerate(cols)}
+            inds1 = np.array([row_index[x] for x in keys1], dtype=int)
+            inds2 = np.array([col_index[x] for x in keys2], dtype=int)
+            for start in range(0, D.shape[0], block_size):
+                stop = min(D.shape[0], start+block_size)
+                block = chain_D[inds1[start:stop]][:, inds2]
+                if ic == 0:
+                    D[start:stop] = block
+                else: # add in double precision, then round like the C++ code
+                    D[start:stop] = np.floor(D[start:stop] + block.astype(np.float64) + 0.5)
+            del chain_D
+        return D
+
+    ## neighbor lists ##################################################################
+
+    def get_knn_nbrs(self, organism, tcrs, num_nbrs, agroups=None, bgroups=None):
+        ''' Returns knn_indices, knn_distances (see tcrdist_cpp.find_knn_nbrs) or None
+        if there's no cached entry with at least num_nbrs nbrs
+
+        If the cached entry has more nbrs, we take the num_nbrs closest (ties are
+        broken arbitrarily, like the nbr_fracs in calculate_tcrdist_nbrs_cpp)
+        '''
+        key = _tcrs_key('knn', organism, tcrs, agroups, bgroups)
+        entry = self._entries.get(key)
+        if entry is None or entry['num_nbrs'] < num_nbrs:
+            return None
+        arrays = self.get(key)
+        self.save()
+        if arrays is None:
+            return None
+        knn_indices, knn_distances = arrays['indices'], arrays['distances']
+        if knn_indices.shape[1] > num_nbrs:
+            inds = np.argpartition(knn_distances, num_nbrs-1, axis=1)[:,:num_nbrs]
+            knn_indices = np.take_along_axis(knn_indices, inds, axis=1)
+            knn_distances = np.take_along_axis(knn_distances, inds, axis=1)
+        return knn_indices, knn_distances
+
+    def put_knn_nbrs(
+            self,
+            organism,
+            tcrs,
+            knn_indices,
+            knn_distances,
+            agroups=None,
+            bgroups=None,
+    ):
+        key = _tcrs_key('knn', organism, tcrs, agroups, bgroups)
+        num_nbrs = knn_indices.shape[1]
+        entry = self._entries.get(key)
+        if entry is not None and entry['num_nbrs'] >= num_nbrs:
+            return
+        self.put(key, {'indices':np.asarray(knn_indices, dtype=np.int32),
+                       'distances':np.asarray(knn_distances).astype(np.uint16)},
+                 num_nbrs=num_nbrs)
+        self.save()
+
+    def get_threshold_nbrs(self, organism, tcrs, threshold, agroups=None, bgroups=None):
+        ''' Returns offsets, indices, distances (see tcrdist_cpp.find_threshold_nbrs)
+        or None if there's no cached entry with at least this threshold
+        '''
+        key = _tcrs_key('threshold', organism, tcrs, agroups, bgroups)
+        entry = self._entries.get(key)
+        if entry is None or entry['threshold'] < threshold:
+            return None
+        arrays = self.get(key)
+        self.save()
+        if arrays is None:
+            return None
+        offsets, indices, distances = (arrays['offsets'], arrays['indices'],
+                                       arrays['distances'])
+        if entry['threshold'] > threshold:
+            mask = distances <= threshold
+            offsets = np.concatenate([[0], np.cumsum(mask)])[offsets]
+            indices, distances = indices[mask], distances[mask]
+        return offsets, indices, distances
+
+    def put_threshold_nbrs(
+            self,
+            organism,
+            tcrs,
+            threshold,
+            offsets,
+            indices,
+            distances,
+            agroups=None,
+            bgroups=None,
+    ):
+        key = _tcrs_key('threshold', organism, tcrs, agroups, bgroups)
+        entry = self._entries.get(key)
+        if entry is not None and entry['threshold'] >= threshold:
+            return
+        self.put(key, {'offsets':np.asarray(offsets, dtype=np.int64),
+                       'indices':np.asarray(indices, dtype=np.int32),
+                       'distances':np.asarray(distances, dtype=np.uint16)},
+                 threshold=threshold)
+        self.save()
+
+    ## background tcrdist models #######################################################
+
+    def get_background_chains(self, model_key):
+        ''' Returns background_alpha_chains, background_beta_chains (lists of
+        (v, j, cdr3, cdr3_nucseq) tuples) or None
+        '''
+        arrays = self.get(model_key)
+        self.save()
+        if arrays is None:
+            return None
+        return ([tuple(x) for x in arrays['achains'].tolist()],
+                [tuple(x) for x in arrays['bchains'].tolist()])
+
+    def put_background_chains(self, model_key, background_alpha_chains,
+                              background_beta_chains):
+        self.put(model_key, {'achains':np.array(background_alpha_chains, dtype=str),
+                             'bchains':np.array(background_beta_chains, dtype=str)})
+        self.save()
+
+    def get_background_counts(self, counts_key, max_dist):
+        ''' Returns the background counts up to max_dist, or None if there's no entry
+        with at least this max_dist
+        '''
+        entry = self._entries.get(counts_key)
+        if entry is None or entry['max_dist'] < max_dist:
+            return None
+        arrays = self.get(counts_key)
+        self.save()
+        return None if arrays is None else arrays['counts'][:,:max_dist+1]
+
+    def put_background_counts(self, counts_key, counts):
+        max_dist = counts.shape[1]-1
+        entry = self._entries.get(counts_key)
+        if entry is not None and entry['max_dist'] >= max_dist:
+            return
+        self.put(counts_key, {'counts':np.asarray(counts, dtype=np.int64)},
+                 max_dist=max_dist)
+        self.save()
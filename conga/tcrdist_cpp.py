@@ -0,0 +1,449 @@
+''' In-process interface to the C++ TCRdist code in tcrdist_cpp/
+
+This wraps the shared library tcrdist_cpp/bin/libtcrdist.so (compiled along with the
+executables by running 'make' in tcrdist_cpp/) using ctypes, so we can compute
+distance matrices, neighbors, matches, and background distributions without writing
+tsv files to disk, running find_neighbors etc, and parsing their text output.
+
+tcrs are in the usual conga format: ((va, ja, cdr3a, ...), (vb, jb, cdr3b, ...))
+background chains are single-chain tuples: (v, j, cdr3, ...)
+
+TCRdist values are rounded to integers (same as the executables), so distances come
+back as uint16 arrays and neighbor indices as int32 arrays.
+
+The calculations are split across num_threads threads (default: all the cores, see
+_num_threads). With unique_chains=True the target tcrs are factored into their unique
+alpha and beta chains, so each row needs single-chain distances to the distinct chains
+plus two table lookups per paired distance. The threshold searches also take prune=True
+to use a lower-bound index (V-gene distance plus cdr3 length-difference gap penalty)
+that skips pairs which can't be within the threshold. The results don't depend on any
+of these options.
+
+There are also readers for the --binary (.npy) output of the executables, which
+memory-map the results by default.
+
+'''
+import ctypes
+import numpy as np
+import os
+from pathlib import Path
+from sys import exit
+from . import util
+
+_lib = None # the loaded shared library
+_engines = {} # organism --> handle to the C++ TCRdistCalculator pair for that organism
+
+_c_strings = ctypes.POINTER(ctypes.c_char_p)
+_c_int64 = ctypes.c_int64
+_c_ptr = ctypes.c_void_p
+
+
+def _load_library():
+    global _lib
+    if _lib is None:
+        libfile = util.path_to_tcrdist_cpp_lib
+        if not os.path.exists(libfile):
+            print('need to compile c++ library:', libfile)
+            exit(1)
+        lib = ctypes.CDLL(str(libfile))
+
+        paired = [_c_int64, _c_strings, _c_strings, _c_strings, _c_strings]
+
+        lib.tcrdist_engine_new.argtypes = [ctypes.c_char_p]
+        lib.tcrdist_engine_new.restype = _c_ptr
+        lib.tcrdist_engine_delete.argtypes = [_c_ptr]
+        lib.tcrdist_engine_delete.restype = None
+
+        lib.tcrdist_check_chains.argtypes = [
+            _c_ptr, ctypes.c_char, _c_int64, _c_strings, _c_strings]
+        lib.tcrdist_check_chains.restype = _c_int64
+
+        lib.tcrdist_paired_distance_matrix.argtypes = [_c_ptr]+paired+paired+[
+            _c_ptr, _c_int64, _c_int64]
+        lib.tcrdist_paired_distance_matrix.restype = None
+
+        lib.tcrdist_single_chain_distance_matrix.argtypes = [
+            _c_ptr, ctypes.c_char, _c_int64, _c_strings, _c_strings,
+            _c_int64, _c_strings, _c_strings, _c_ptr, _c_int64]
+        lib.tcrdist_single_chain_distance_matrix.restype = None
+
+        lib.tcrdist_knn_nbrs.argtypes = [_c_ptr]+paired+[
+            _c_ptr, _c_ptr, _c_int64, _c_ptr, _c_ptr, _c_int64, _c_int64]
+        lib.tcrdist_knn_nbrs.restype = None
+
+        lib.tcrdist_threshold_nbrs.argtypes = [_c_ptr]+paired+[
+            _c_ptr, _c_ptr, _c_int64, _c_int64, _c_int64, _c_int64]
+        lib.tcrdist_threshold_nbrs.restype = _c_ptr
+
+        lib.tcrdist_paired_matches.argtypes = [_c_ptr]+paired+paired+[
+            _c_int64, _c_int64, _c_int64, _c_int64]
+        lib.tcrdist_paired_matches.restype = _c_ptr
+
+        lib.tcrdist_nbrs_result_size.argtypes = [_c_ptr]
+        lib.tcrdist_nbrs_result_size.restype = _c_int64
+        lib.tcrdist_nbrs_result_copy.argtypes = [_c_ptr, _c_ptr, _c_ptr, _c_ptr]
+        lib.tcrdist_nbrs_result_copy.restype = None
+        lib.tcrdist_nbrs_result_delete.argtypes = [_c_ptr]
+        lib.tcrdist_nbrs_result_delete.restype = None
+
+        lib.tcrdist_background_distributions.argtypes = [_c_ptr]+paired+[
+            _c_int64, _c_strings, _c_strings, _c_int64, _c_strings, _c_strings,
+            _c_int64, _c_ptr, _c_int64]
+        lib.tcrdist_background_distributions.restype = None
+
+        lib.tcrdist_background_histograms.argtypes = [_c_ptr]+paired+[
+            _c_int64, _c_strings, _c_strings, _c_ptr,
+            _c_int64, _c_strings, _c_strings, _c_ptr,
+            _c_int64, _c_ptr, _c_ptr, _c_ptr, _c_int64]
+        lib.tcrdist_background_histograms.restype = None
+
+        _lib = lib
+    return _lib
+
+
+def _get_engine(organism):
+    if organism not in _engines:
+        lib = _load_library()
+        db_filename = Path.joinpath(
+            Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
+        if not os.path.exists(db_filename):
+            print('need to create database file:', db_filename)
+            exit(1)
+        _engines[organism] = lib.tcrdist_engine_new(str(db_filename).encode())
+    return _engines[organism]
+
+
+def _num_threads(num_threads):
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    return max(1, int(num_threads))
+
+
+def _string_array(strs):
+    return (ctypes.c_char_p * len(strs))(*[str(x).encode() for x in strs])
+
+
+def _single_chain_args(engine, chain, vs, cdr3s):
+    ''' Returns (num, c_vs, c_cdr3s) after checking that the chains are OK
+    (the C++ code would exit on bad genes or cdr3s)
+    '''
+    c_vs, c_cdr3s = _string_array(vs), _string_array(cdr3s)
+    ibad = _lib.tcrdist_check_chains(engine, chain.encode(), len(vs), c_vs, c_cdr3s)
+    if ibad >= 0:
+        print(f'conga.tcrdist_cpp:: bad {chain} chain:', vs[ibad], cdr3s[ibad])
+        exit(1)
+    return [len(vs), c_vs, c_cdr3s]
+
+def _paired_tcr_args(engine, tcrs):
+    anum, va, cdr3a = _single_chain_args(
+        engine, 'A', [x[0][0] for x in tcrs], [x[0][2] for x in tcrs])
+    bnum, vb, cdr3b = _single_chain_args(
+        engine, 'B', [x[1][0] for x in tcrs], [x[1][2] for x in tcrs])
+    return [anum, va, cdr3a, vb, cdr3b]
+
+def _groups_arg(groups, num_tcrs):
+    ''' Returns (array, pointer) where the array needs to stay alive during the call
+    '''
+    if groups is None:
+        return None, None
+    groups = np.ascontiguousarray(groups, dtype=np.int64)
+    assert groups.shape == (num_tcrs,)
+    return groups, groups.ctypes.data
+
+def _get_nbrs_result(result, num_rows):
+    ''' Copy out the CSR-style results and free the C++ result object
+    '''
+    num_nbrs = _lib.tcrdist_nbrs_result_size(result)
+    offsets = np.zeros((num_rows+1,), dtype=np.int64)
+    indices = np.zeros((num_nbrs,), dtype=np.int32)
+    distances = np.zeros((num_nbrs,), dtype=np.uint16)
+    _lib.tcrdist_nbrs_result_copy(
+        result, offsets.ctypes.data, indices.ctypes.data, distances.ctypes.data)
+    _lib.tcrdist_nbrs_result_delete(result)
+    return offsets, indices, distances
+
+
+def calc_tcrdist_matrix(
+        tcrs,
+        organism,
+        tcrs2=None,
+        unique_chains=True,
+        num_threads=None,
+):
+    ''' Returns the paired tcrdist matrix between tcrs and tcrs2 (default: tcrs2=tcrs)
+
+    as a uint16 numpy array of shape (len(tcrs), len(tcrs2))
+    '''
+    engine = _get_engine(organism)
+    args1 = _paired_tcr_args(engine, tcrs)
+    args2 = args1 if tcrs2 is None else _paired_tcr_args(engine, tcrs2)
+
+    D = np.zeros((args1[0], args2[0]), dtype=np.uint16)
+    if D.size:
+        _lib.tcrdist_paired_distance_matrix(
+            engine, *args1, *args2, D.ctypes.data, unique_chains,
+            _num_threads(num_threads))
+    return D
+
+
+def calc_single_chain_tcrdist_matrix(
+        chains,
+        organism,
+        chain,
+        chains2=None,
+        num_threads=None,
+):
+    ''' Returns the single-chain tcrdist matrix between chains and chains2 (default:
+    chains2=chains), where chain is 'A' or 'B' and the chains are (v, j, cdr3, ...)
+
+    as a float32 numpy array of shape (len(chains), len(chains2)), NOT rounded
+    '''
+    assert chain in 'AB'
+    engine = _get_engine(organism)
+    args1 = _single_chain_args(
+        engine, chain, [x[0] for x in chains], [x[2] for x in chains])
+    args2 = args1 if chains2 is None else _single_chain_args(
+        engine, chain, [x[0] for x in chains2], [x[2] for x in chains2])
+
+    D = np.zeros((args1[0], args2[0]), dtype=np.float32)
+    if D.size:
+        _lib.tcrdist_single_chain_distance_matrix(
+            engine, chain.encode(), *args1, *args2, D.ctypes.data,
+            _num_threads(num_threads))
+    return D
+
+
+def find_knn_nbrs(
+        tcrs,
+        organism,
+        num_nbrs,
+        agroups=None,
+        bgroups=None,
+        unique_chains=True,
+        num_threads=None,
+):
+    ''' Returns knn_indices, knn_distances
+
+    knn_indices: int32 array of shape (len(tcrs), num_nbrs)
+    knn_distances: uint16 array of shape (len(tcrs), num_nbrs)
+
+    Same as find_neighbors -n: neighbors exclude self and any tcrs in the same agroup
+    or bgroup (if provided); they are NOT sorted by distance, and ties at the
+    num_nbrs-th distance are broken randomly (but reproducibly)
+    '''
+    engine = _get_engine(organism)
+    args = _paired_tcr_args(engine, tcrs)
+    num_tcrs = args[0]
+    agroups, agroups_ptr = _groups_arg(agroups, num_tcrs)
+    bgroups, bgroups_ptr = _groups_arg(bgroups, num_tcrs)
+    assert 0 < num_nbrs < num_tcrs
+
+    knn_indices = np.zeros((num_tcrs, num_nbrs), dtype=np.int32)
+    knn_distances = np.zeros((num_tcrs, num_nbrs), dtype=np.uint16)
+    _lib.tcrdist_knn_nbrs(engine, *args, agroups_ptr, bgroups_ptr, num_nbrs,
+                          knn_indices.ctypes.data, knn_distances.ctypes.data,
+                          unique_chains, _num_threads(num_threads))
+    return knn_indices, knn_distances
+
+
+def find_threshold_nbrs(
+        tcrs,
+        organism,
+        threshold,
+        agroups=None,
+        bgroups=None,
+        unique_chains=True,
+        prune=True,
+        num_threads=None,
+):
+    ''' Returns offsets, indices, distances in CSR format: the nbrs of tcrs[ii] are
+    indices[offsets[ii]:offsets[ii+1]], in increasing order
+
+    offsets: int64 array of shape (len(tcrs)+1,)
+    indices: int32 array, distances: uint16 array
+
+    Same as find_neighbors -t: nbrs are all tcrs within (<=) threshold, excluding
+    self and any tcrs in the same agroup or bgroup (if provided)
+    '''
+    engine = _get_engine(organism)
+    args = _paired_tcr_args(engine, tcrs)
+    num_tcrs = args[0]
+    agroups, agroups_ptr = _groups_arg(agroups, num_tcrs)
+    bgroups, bgroups_ptr = _groups_arg(bgroups, num_tcrs)
+
+    result = _lib.tcrdist_threshold_nbrs(
+        engine, *args, agroups_ptr, bgroups_ptr, int(threshold), unique_chains, prune,
+        _num_threads(num_threads))
+    return _get_nbrs_result(result, num_tcrs)
+
+
+def find_paired_matches(
+        tcrs1,
+        tcrs2,
+        organism,
+        threshold,
+        unique_chains=True,
+        prune=True,
+        num_threads=None,
+):
+    ''' Returns offsets, indices, distances in CSR format (see find_threshold_nbrs)
+    where the matches of tcrs1[ii] are tcrs2[indices[offsets[ii]:offsets[ii+1]]]
+
+    Same as the find_paired_matches executable: matches are pairs with tcrdist <=
+    threshold
+    '''
+    engine = _get_engine(organism)
+    args1 = _paired_tcr_args(engine, tcrs1)
+    args2 = _paired_tcr_args(engine, tcrs2)
+
+    result = _lib.tcrdist_paired_matches(
+        engine, *args1, *args2, int(threshold), unique_chains, prune,
+        _num_threads(num_threads))
+    return _get_nbrs_result(result, args1[0])
+
+
+def _background_weights(weights, chains):
+    if weights is None:
+        return None
+    weights = np.ascontiguousarray(weights, dtype=np.int64)
+    assert weights.shape == (len(chains),) and np.all(weights >= 0)
+    return weights
+
+def calc_background_distributions(
+        tcrs,
+        organism,
+        max_dist,
+        background_alpha_chains,
+        background_beta_chains,
+        num_threads=None,
+        background_alpha_weights=None,
+        background_beta_weights=None,
+        return_single_chain_counts=False,
+        skip_paired_counts=False,
+):
+    ''' Returns counts, an int64 array of shape (len(tcrs), max_dist+1) where
+    counts[ii,d] is the number of (background_alpha, background_beta) pairs at paired
+    tcrdist d from tcrs[ii]
+
+    Same as the calc_distributions executable
+
+    background_alpha_weights/background_beta_weights are optional multiplicities for
+    the background chains, so a background with lots of repeats can be passed as its
+    unique chains (see tcr_clumping.compress_background_chains)
+
+    if return_single_chain_counts is True, returns counts, acounts, bcounts where
+    acounts and bcounts are the single-chain distance histograms, which convolve to
+    counts (see convolve_background_histograms). With skip_paired_counts, counts is
+    None.
+    '''
+    engine = _get_engine(organism)
+    args = _paired_tcr_args(engine, tcrs)
+    achain_args = _single_chain_args(
+        engine, 'A', [x[0] for x in background_alpha_chains],
+        [x[2] for x in background_alpha_chains])
+    bchain_args = _single_chain_args(
+        engine, 'B', [x[0] for x in background_beta_chains],
+        [x[2] for x in background_beta_chains])
+    aweights = _background_weights(background_alpha_weights, background_alpha_chains)
+    bweights = _background_weights(background_beta_weights, background_beta_chains)
+    max_dist = int(max_dist)
+
+    shape = (args[0], max_dist+1)
+    counts = None if skip_paired_counts else np.zeros(shape, dtype=np.int64)
+    acounts, bcounts = None, None
+    if return_single_chain_counts:
+        acounts = np.zeros(shape, dtype=np.int64)
+        bcounts = np.zeros(shape, dtype=np.int64)
+
+    def ptr(a):
+        return None if a is None else a.ctypes.data
+
+    _lib.tcrdist_background_histograms(
+        engine, *args, *achain_args, ptr(aweights), *bchain_args, ptr(bweights),
+        max_dist, ptr(counts), ptr(acounts), ptr(bcounts), _num_threads(num_threads))
+    if return_single_chain_counts:
+        return counts, acounts, bcounts
+    return counts
+
+
+def convolve_background_histograms(acounts, bcounts):
+    ''' Returns the paired counts (int64, same shape as acounts) for the single-chain
+    histograms acounts and bcounts, ie counts[:,d] = sum_a acounts[:,a]*bcounts[:,d-a]
+
+    exact integer arithmetic, looping over the alpha distances that are nonzero
+    somewhere
+    '''
+    acounts = np.asarray(acounts, dtype=np.int64)
+    bcounts = np.asarray(bcounts, dtype=np.int64)
+    assert acounts.shape == bcounts.shape
+    num_dists = acounts.shape[1]
+    counts = np.zeros(acounts.shape, dtype=np.int64)
+    for adist in np.nonzero(acounts.any(axis=0))[0]:
+        counts[:,adist:] += acounts[:,adist:adist+1] * bcounts[:,:num_dists-adist]
+    return counts
+
+
+######################################################################################
+## readers for the --binary output of the executables
+##
+## with mmap=True the arrays are memory-mapped (read-only) rather than loaded. On posix
+## systems it's OK to remove the files afterwards, the mapping stays valid.
+
+def _load_npy(filename, mmap):
+    if not os.path.exists(filename):
+        print('conga.tcrdist_cpp:: missing output file:', filename)
+        exit(1)
+    return np.load(filename, mmap_mode='r' if mmap else None)
+
+def read_knn_nbrs(outprefix, mmap=True):
+    ''' Read the output of find_neighbors -n <num_nbrs> --binary -o <outprefix>
+
+    returns knn_indices (int32), knn_distances (uint16), both of shape
+    (num_tcrs, num_nbrs)
+    '''
+    knn_indices = _load_npy(f'{outprefix}_knn_indices.npy', mmap)
+    knn_distances = _load_npy(f'{outprefix}_knn_distances.npy', mmap)
+    assert knn_indices.shape == knn_distances.shape
+    return knn_indices, knn_distances
+
+def read_threshold_nbrs(outprefix, threshold, mmap=True):
+    ''' Read the output of find_neighbors -t <threshold> --binary -o <outprefix>
+
+    returns offsets (int64), indices (int32), distances (uint16) in CSR format, see
+    find_threshold_nbrs
+    '''
+    tag = f'{outprefix}_nbr{threshold}'
+    offsets = _load_npy(tag+'_offsets.npy', mmap)
+    indices = _load_npy(tag+'_indices.npy', mmap)
+    distances = _load_npy(tag+'_distances.npy', mmap)
+    assert indices.shape == distances.shape == (offsets[-1],)
+    return offsets, indices, distances
+
+def read_tcrdist_matrix(outprefix, mmap=True):
+    ''' Read the output of find_neighbors --only_tcrdists --binary -o <outprefix>
+
+    returns the uint16 distance matrix
+    '''
+    return _load_npy(f'{outprefix}_tcrdists.npy', mmap)
+
+def read_background_histograms(outprefix, mmap=True):
+    ''' Read the output of calc_distributions -s <outprefix>
+
+    returns acounts, bcounts (int64, shape (num_tcrs, max_dist+1)), the single-chain
+    distance histograms versus the background chains (see
+    convolve_background_histograms)
+    '''
+    acounts = _load_npy(f'{outprefix}_acounts.npy', mmap)
+    bcounts = _load_npy(f'{outprefix}_bcounts.npy', mmap)
+    assert acounts.shape == bcounts.shape
+    return acounts, bcounts
+
+def threshold_nbrs_to_lists(offsets, indices, distances):
+    ''' Convert CSR-style threshold nbrs to lists of python lists: all_nbrs,
+    all_distances
+    '''
+    all_nbrs = [indices[start:stop].tolist()
+                for start, stop in zip(offsets[:-1], offsets[1:])]
+    all_distances = [distances[start:stop].astype(int).tolist()
+                     for start, stop in zip(offsets[:-1], offsets[1:])]
+    return all_nbrs, all_distances
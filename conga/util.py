@@ -23,6 +23,9 @@ path_to_tcrdist_cpp_bin = Path.joinpath( path_to_tcrdist_cpp ,'bin')
 path_to_tcrdist_cpp_db = Path.joinpath( path_to_tcrdist_cpp ,'db')
 assert os.path.isdir( path_to_tcrdist_cpp_bin ) and os.path.isdir( path_to_tcrdist_cpp_db )
 
+# shared library for calling the C++ tcrdist code in-process, see conga/tcrdist_cpp.py
+path_to_tcrdist_cpp_lib = Path.joinpath( path_to_tcrdist_cpp_bin, 'libtcrdist.so')
+
 
 def tcrdist_cpp_available():
     if os.name == 'posix':
@@ -30,6 +33,9 @@ def tcrdist_cpp_available():
     else:
         return os.path.exists(Path.joinpath( path_to_tcrdist_cpp_bin ,'find_neighbors.exe'))
 
+def tcrdist_cpp_lib_available():
+    return os.path.exists(path_to_tcrdist_cpp_lib)
+
 # this is the (OPTIONAL) obs key used to store a subject-specific identifier
 # right now this is only used to prevent condensing of clonotypes that span subjects,
 # which is pretty unlikely but could happen with certain populations (e.g., MAIT cells)
@@ -148,3 +154,185 @@ def get_feature_types_varname( adata ):
     print(adata.var_names)
     return None
 
+
+
+def _key_inverse(*key_arrays):
+    ''' returns inverse, num_keys where inverse[i] is the index of the i-th combination
+    of values in key_arrays among the num_keys distinct combinations
+    '''
+    keys = np.stack([np.asarray(x) for x in key_arrays], axis=1)
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    return inverse.ravel(), unique_keys.shape[0]
+
+class TcrGroupIndex():
+    ''' Index of the clones that share an alpha chain (agroup) or a beta chain
+    (bgroup) with each clone, for excluding them from nbrs and from the nbr counts
+
+    The members of each agroup and bgroup are stored as CSR-style lists (offsets into
+    an array of clone indices sorted by group), so finding the clones excluded for a
+    clone touches only its group members, not all N clones. Note that each clone is
+    excluded for itself.
+
+    agroups, bgroups are the integer arrays from preprocess.setup_tcr_groups
+    '''
+    def __init__(self, agroups, bgroups):
+        self.agroups = np.asarray(agroups)
+        self.bgroups = np.asarray(bgroups)
+        assert self.agroups.shape == self.bgroups.shape
+        self.N = self.agroups.shape[0]
+
+        self.a_offsets, self.a_members = self._make_csr(self.agroups)
+        self.b_offsets, self.b_members = self._make_csr(self.bgroups)
+        self.a_sizes = np.diff(self.a_offsets)
+        self.b_sizes = np.diff(self.b_offsets)
+
+        # clones sharing both chains are in both lists, so subtract them once
+        self.ab_inverse, self.num_ab = _key_inverse(self.agroups, self.bgroups)
+        ab_sizes = np.bincount(self.ab_inverse, minlength=self.num_ab)
+
+        # number of clones excluded for each clone (including itself)
+        self.num_excluded = (self.a_sizes[self.agroups] + self.b_sizes[self.bgroups] -
+                             ab_sizes[self.ab_inverse])
+
+    @staticmethod
+    def _make_csr(groups):
+        num_groups = groups.max()+1 if groups.shape[0] else 0
+        members = np.argsort(groups, kind='stable')
+        offsets = np.zeros((num_groups+1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(groups, minlength=num_groups))
+        return offsets, members
+
+    def num_allowed(self):
+        ''' number of possible nbrs for each clone (not in its agroup or bgroup)
+        '''
+        return self.N - self.num_excluded
+
+    def excluded(self, ii):
+        ''' sorted array of the clones in the agroup or bgroup of clone ii
+        '''
+        a, b = self.agroups[ii], self.bgroups[ii]
+        return np.union1d(self.a_members[self.a_offsets[a]:self.a_offsets[a+1]],
+                          self.b_members[self.b_offsets[b]:self.b_offsets[b+1]])
+
+    @staticmethod
+    def _pairs(rows, groups, offsets, members):
+        starts = offsets[groups[rows]]
+        sizes = offsets[groups[rows]+1] - starts
+        row_pos = np.repeat(np.arange(len(rows)), sizes)
+        inds = np.arange(sizes.sum()) + np.repeat(starts - (np.cumsum(sizes)-sizes), sizes)
+        return row_pos, members[inds]
+
+    def excluded_pairs(self, rows):
+        ''' returns row_pos, cols such that clone cols[i] is excluded for clone
+        rows[row_pos[i]] (pairs sharing both chains appear twice)
+        '''
+        rows = np.asarray(rows)
+        a_pos, a_cols = self._pairs(rows, self.agroups, self.a_offsets, self.a_members)
+        b_pos, b_cols = self._pairs(rows, self.bgroups, self.b_offsets, self.b_members)
+        return np.concatenate([a_pos, b_pos]), np.concatenate([a_cols, b_cols])
+
+    def set_excluded(self, D, rows, value=1e3):
+        ''' D is the len(rows) x N block of distances from rows to all the clones; set
+        the distances to the excluded clones to value (in place)
+        '''
+        row_pos, cols = self.excluded_pairs(rows)
+        D[row_pos, cols] = value
+        return D
+
+    def num_excluded_in_mask(self, mask):
+        ''' for each clone, the number of clones in mask that are excluded for it
+        '''
+        mask = np.asarray(mask, dtype=bool)
+        a_counts = np.bincount(self.agroups[mask], minlength=len(self.a_sizes))
+        b_counts = np.bincount(self.bgroups[mask], minlength=len(self.b_sizes))
+        ab_counts = np.bincount(self.ab_inverse[mask], minlength=self.num_ab)
+        return (a_counts[self.agroups] + b_counts[self.bgroups] -
+                ab_counts[self.ab_inverse])
+
+    def num_excluded_with_same_label(self, labels):
+        ''' for each clone, the number of clones with the same label (eg GEX cluster)
+        that are excluded for it
+        '''
+        labels = np.unique(labels, return_inverse=True)[1].ravel()
+        counts = []
+        for groups in [[self.agroups], [self.bgroups], [self.agroups, self.bgroups]]:
+            inverse, num_keys = _key_inverse(*groups, labels)
+            counts.append(np.bincount(inverse, minlength=num_keys)[inverse])
+        return counts[0] + counts[1] - counts[2]
+
+
+def connected_components(num_nodes, rows, cols):
+    ''' Single-linkage clustering: returns labels, where labels[i] is the connected
+    component of node i in the undirected graph with edges rows[k]--cols[k]
+
+    components are numbered 0,1,2,... in order of their smallest node
+    '''
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components as csgraph_components
+    rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+    adjacency = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                           shape=(num_nodes, num_nodes))
+    _, labels = csgraph_components(adjacency, directed=False)
+    # renumber in order of the smallest node
+    _, first_nodes = np.unique(labels, return_index=True)
+    relabel = np.empty((len(first_nodes),), dtype=int)
+    relabel[np.argsort(first_nodes)] = np.arange(len(first_nodes))
+    return relabel[labels]
+
+
+def create_shared_array(shape, dtype, values=None):
+    ''' returns shm, array where array is a numpy array backed by a new
+    multiprocessing SharedMemory block, for passing big arrays to worker processes
+    (see attach_shared_array). The caller should shm.close() and shm.unlink() when done
+    '''
+    from multiprocessing import shared_memory
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if values is not None:
+        array[...] = values
+    return shm, array
+
+def attach_shared_array(name, shape, dtype):
+    ''' returns shm, array for a SharedMemory block made by create_shared_array
+    (the caller should shm.close() but not unlink)
+    '''
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+class Float32DistanceKernel():
+    ''' Euclidean distances from blocks of rows of X to all of X, computed as
+    sqrt(|x|^2 + |y|^2 - 2 x.y) with a single float32 matrix multiply per block
+
+    The squared norms are precomputed, and the results go into one preallocated
+    (max_batch_size, N) float32 buffer that is reused for every block, so the
+    returned array is only valid until the next call. X is centered first, which
+    keeps the norms small; the float32 cancellation error in |x|^2 + |y|^2 - 2 x.y
+    is then ~1e-7 times the squared norms, so only the very smallest distances are
+    noticeably off. Plenty for ranking nbrs (>99.99% identical nbr sets on 50-PC
+    data, see scripts/benchmark_nbr_distances.py).
+    '''
+    def __init__(self, X, max_batch_size):
+        X = np.asarray(X, dtype=np.float64)
+        X = X - X.mean(axis=0)
+        self.X = np.ascontiguousarray(X, dtype=np.float32)
+        self.sq_norms = np.sum(X*X, axis=1).astype(np.float32)
+        self.N = X.shape[0]
+        self.buffer = np.empty((min(self.N, max_batch_size), self.N), dtype=np.float32)
+
+    def distances(self, start, stop, squared=False):
+        ''' returns the (stop-start, N) block of distances from rows [start,stop)
+        '''
+        assert stop-start <= self.buffer.shape[0]
+        D = self.buffer[:stop-start]
+        np.matmul(self.X[start:stop], self.X.T, out=D)
+        D *= -2
+        D += self.sq_norms[start:stop,np.newaxis]
+        D += self.sq_norms[np.newaxis,:]
+        np.maximum(D, 0, out=D)
+        if not squared:
+            np.sqrt(D, out=D)
+        return D
@@ -0,0 +1,78 @@
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="""Benchmark the distance kernels used in the GEX/TCR nbr calculations
+(conga.preprocess.calc_nbrs distance_kernel='cdist' versus 'float32') on a random
+PCA-like embedding. Reports the time per batch for the distances alone and for
+distances plus the nbr argpartition, and how well the float32 nbrs agree with the
+float64 ones.""")
+
+parser.add_argument('--num_clones', type=int, default=50000)
+parser.add_argument('--num_pcs', type=int, default=50)
+parser.add_argument('--nbr_frac', type=float, default=0.01)
+parser.add_argument('--target_N_for_batching', type=int, default=8192)
+parser.add_argument('--num_batches', type=int, default=5,
+                    help='number of batches to time (the first one is a warm-up)')
+parser.add_argument('--random_seed', type=int, default=1)
+args = parser.parse_args()
+
+import sys
+import os
+import time
+conga_dir = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+sys.path.append(conga_dir) # in order to import conga package
+import numpy as np
+from scipy.spatial.distance import cdist
+import conga
+
+N = args.num_clones
+rng = np.random.RandomState(args.random_seed)
+# PCA-like: decreasing variance along the components, plus some cluster structure
+centers = rng.randn(20, args.num_pcs) * np.linspace(10, 1, args.num_pcs)
+X = (centers[rng.randint(20, size=N)] +
+     rng.randn(N, args.num_pcs) * np.linspace(3, 0.3, args.num_pcs))
+
+batch_size = max(10, int(args.target_N_for_batching**2/N))
+num_batches = min(args.num_batches, (N-1)//batch_size + 1)
+num_nbrs = max(1, int(args.nbr_frac*N))
+print(f'N= {N} num_pcs= {args.num_pcs} batch_size= {batch_size}',
+      f'num_nbrs= {num_nbrs} num_batches= {num_batches}')
+
+kernel = conga.util.Float32DistanceKernel(X, batch_size)
+get_rows = {
+    'cdist': lambda start, stop: cdist(X[start:stop], X),
+    'float32': kernel.distances,
+}
+
+times = {}
+nbrs = {}
+for name, get_distance_rows in get_rows.items():
+    dist_time, total_time = 0., 0.
+    nbrs[name] = []
+    for bb in range(num_batches):
+        start, stop = bb*batch_size, min(N, (bb+1)*batch_size)
+        t0 = time.perf_counter()
+        D = get_distance_rows(start, stop)
+        t1 = time.perf_counter()
+        D[np.arange(stop-start), np.arange(start, stop)] = 1e3 # exclude self
+        inds = np.argpartition(D, num_nbrs-1)[:,:num_nbrs]
+        t2 = time.perf_counter()
+        nbrs[name].append(inds)
+        if bb: # skip the warm-up batch
+            dist_time += t1-t0
+            total_time += t2-t0
+    times[name] = (dist_time/max(1, num_batches-1), total_time/max(1, num_batches-1))
+    print(f'{name:8s} distances: {times[name][0]:8.4f} sec/batch',
+          f'distances+argpartition: {times[name][1]:8.4f} sec/batch')
+
+print('speedup distances: {:.2f}x distances+argpartition: {:.2f}x'.format(
+    times['cdist'][0]/times['float32'][0], times['cdist'][1]/times['float32'][1]))
+
+# accuracy on the first few rows
+stop = min(N, batch_size, 100)
+D = cdist(X[:stop], X)
+err = np.abs(D - kernel.distances(0, stop))
+print(f'max abs distance error: {err.max():.2e} (median distance {np.median(D):.2f})')
+overlap = np.mean([len(set(a) & set(b))/num_nbrs
+                   for a, b in zip(np.vstack(nbrs['cdist']), np.vstack(nbrs['float32']))])
+print(f'nbr overlap float32 versus cdist: {overlap:.6f}')
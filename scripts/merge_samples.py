@@ -16,7 +16,27 @@ parser.add_argument('--tcrdist_threshold_for_condensing', type=float, default=50
 parser.add_argument('--no_tcrdists', action='store_true', help='Don\'t compute tcrdists or kernel PCs; instead generate a random matrix of kernel PCs. This might be useful for preprocessing very big GEX datasets to isolate subsets of interest')
 parser.add_argument('--no_kpcs', action='store_true')
 parser.add_argument('--force_tcrdist_cpp', action='store_true')
+parser.add_argument('--kpca_num_landmarks', type=int,
+                    help='Approximate the TCRdist kernel PCA using distances to this'
+                    ' many landmark clonotypes, rather than the full NxN distance'
+                    ' matrix. Useful for very big datasets (>50k clonotypes)')
+parser.add_argument('--kpca_landmark_selection', choices=['kmeans++', 'random'],
+                    default='kmeans++')
+parser.add_argument('--kpca_lean', action='store_true',
+                    help='Exact TCRdist kernel PCA with a float32 in-place gram matrix'
+                    ' and a partial eigensolver: peak memory about 4*N^2 bytes')
+parser.add_argument('--save_kpca_model_file',
+                    help='Save the TCRdist kernel PCA model to this .npz file so new'
+                    ' samples can be projected onto it later with --kpca_model_file')
+parser.add_argument('--kpca_model_file',
+                    help='Project the clonotypes onto this saved TCRdist kernel PCA'
+                    ' model rather than running kernel PCA again. Existing'
+                    ' clonotypes keep their kernel PCs')
 parser.add_argument('--batch_keys', type=str, nargs='*')
+parser.add_argument('--tcrdist_cache_dir', help='Directory for a persistent tcrdist cache'
+                    ' that is reused across runs (see conga/tcrdist_cache.py). Can also'
+                    ' be set with the CONGA_TCRDIST_CACHE_DIR environment variable')
+parser.add_argument('--tcrdist_cache_max_gb', type=float, default=10.0)
 
 
 args = parser.parse_args()
@@ -32,6 +52,9 @@ import conga.preprocess
 import pandas as pd
 import scanpy as sc
 
+if args.tcrdist_cache_dir:
+    conga.tcrdist_cache.set_cache_dir(args.tcrdist_cache_dir, args.tcrdist_cache_max_gb)
+
 
 df = pd.read_csv(args.samples, sep='\t')
 
@@ -96,6 +119,8 @@ else:
     print('writing', new_clones_df.shape[0], 'clonotypes to merged clones_file', args.output_clones_file)
     new_clones_df.to_csv(args.output_clones_file, sep='\t', index=False)
     new_bcmap_df.to_csv(args.output_clones_file+'.barcode_mapping.tsv', sep='\t', index=False)
+    conga.preprocess.write_barcode_mapping_sidecar(
+        args.output_clones_file+'.barcode_mapping.tsv')
     input_distfile=None
 
 print('writing anndata object of shape:', new_adata.shape, 'to file:', args.output_gex_data)
@@ -117,12 +142,18 @@ if args.no_tcrdists:
         out.write('pc_comps: {} {}\n'\
                   .format( clone_ids[ii], ' '.join( '{:.6f}'.format(x) for x in kpcs[ii,:])))
     out.close()
+    conga.preprocess.write_tcrdist_kernel_pcs_sidecar(outfile)
 elif args.no_kpcs:
     pass
+elif args.kpca_model_file: # project onto an existing model, no NxN matrix
+    conga.preprocess.make_tcrdist_kernel_pcs_file_from_model(
+        args.output_clones_file, args.kpca_model_file)
 else: # the usual route
     conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file(
         args.output_clones_file, args.organism, input_distfile=input_distfile,
-        output_distfile=args.output_distfile )
+        output_distfile=args.output_distfile, num_landmarks=args.kpca_num_landmarks,
+        landmark_selection=args.kpca_landmark_selection,
+        model_file=args.save_kpca_model_file, lean=args.kpca_lean )
 
 if args.output_distfile is None and input_distfile is not None:
     os.remove(input_distfile)
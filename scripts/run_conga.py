@@ -39,6 +39,44 @@ parser.add_argument('--checkpoint', action='store_true',
                     ' preprocessing')
 parser.add_argument('--rerun_kpca', action='store_true')
 parser.add_argument('--no_kpca', action='store_true')
+parser.add_argument('--nbr_backend', choices=['exact', 'ivf'], default='exact',
+                    help='Use \'ivf\' for approximate GEX/TCR neighbors from a k-means'
+                    ' cell index (see conga/approx_nbrs.py), faster for big'
+                    ' datasets. The speedup depends on nbr_frac: each clone'
+                    ' searches at least --approx_nbrs_candidate_factor times its'
+                    ' nbrs, so at nbr_frac 0.1 with the default factor of 4 every'
+                    ' query still scans >= 40%% of the dataset. Clustered'
+                    ' embeddings gain the most; on diffuse ones the nbrs are spread'
+                    ' over many cells and little is saved, see'
+                    ' --approx_nbrs_min_recall')
+parser.add_argument('--approx_nbrs_candidate_factor', type=float, default=4.0,
+                    help='With --nbr_backend ivf, search at least this many times'
+                    ' the number of nbrs for each clone; higher means better'
+                    ' recall and slower')
+parser.add_argument('--approx_nbrs_min_recall', type=float, default=0.9,
+                    help='With --nbr_backend ivf, fall back to the exact nbrs (with'
+                    ' a warning) if the recall estimated on a sample of clones is'
+                    ' below this. Diffuse embeddings can need most of the dataset'
+                    ' to reach it; 0 keeps the approximate nbrs regardless')
+parser.add_argument('--multires_nbrs', action='store_true',
+                    help='Compute one sorted nbr list per clone for the largest'
+                    ' nbr_frac and slice the other nbr_fracs (and nndists) from it')
+parser.add_argument('--nbr_n_jobs', type=int, default=1,
+                    help='Number of processes for the batched GEX/TCR nbr'
+                    ' calculation on big datasets, also with --multires_nbrs'
+                    ' (-1 for all the cores). Not used with --nbr_backend ivf')
+parser.add_argument('--save_nbrs_sidecar', action='store_true',
+                    help='Save the GEX/TCR nbr arrays as .npy files in the'
+                    ' directory <outfile_prefix>_nbrs, referenced from the'
+                    ' _final.h5ad file, rather than not at all. See'
+                    ' --reuse_saved_nbrs')
+parser.add_argument('--reuse_saved_nbrs', action='store_true',
+                    help='With --restart, reuse (memory-mapped) nbrs saved by'
+                    ' --save_nbrs_sidecar instead of recomputing them, if they'
+                    ' cover all the --nbr_fracs')
+parser.add_argument('--nbr_distance_kernel', choices=['cdist', 'float32'],
+                    default='cdist', help='Use \'float32\' for a faster GEX/TCR'
+                    ' distance calculation with a float32 matrix multiply')
 parser.add_argument('--use_exact_tcrdist_nbrs', action='store_true',
                     help='The default is to use the nbrs defined by'
                     ' euclidean distances in the tcrdist kernel pc space.'
@@ -53,6 +91,15 @@ parser.add_argument('--kpca_gaussian_kernel_sdev', default=100.0, type=float,
                     help='only used if rerun_kpca and kpca_kernel=\'gaussian\'')
 parser.add_argument('--kpca_default_kernel_Dmax', type=float,
                     help='only used if rerun_kpca and kpca_kernel==None')
+parser.add_argument('--kpca_num_landmarks', type=int,
+                    help='Approximate the TCRdist kernel PCA using distances to this'
+                    ' many landmark clonotypes, rather than the full NxN distance'
+                    ' matrix. Useful for very big datasets (>50k clonotypes)')
+parser.add_argument('--kpca_landmark_selection', choices=['kmeans++', 'random'],
+                    default='kmeans++')
+parser.add_argument('--kpca_lean', action='store_true',
+                    help='Exact TCRdist kernel PCA with a float32 in-place gram matrix'
+                    ' and a partial eigensolver: peak memory about 4*N^2 bytes')
 parser.add_argument('--exclude_gex_clusters', type=int, nargs='*')
 parser.add_argument('--exclude_mait_and_inkt_cells', action='store_true')
 parser.add_argument('--subset_to_CD4', action='store_true')
@@ -141,12 +188,20 @@ parser.add_argument('--shuffle_gex_nbrs', action='store_true')
 parser.add_argument('--exclude_vgene_strings', type=str, nargs='*')
 parser.add_argument('--suffix_for_non_gene_features', type=str)
 parser.add_argument('--max_genes_per_cell', type=int)
+parser.add_argument('--backed_gex_data', action='store_true',
+                    help='Low-memory loading for "h5ad" --gex_data: open the file'
+                    ' in backed mode and load only the cells with TCRs and at'
+                    ' least 200 genes (the default min_genes QC filter)')
 parser.add_argument('--qc_plots', action='store_true')
 parser.add_argument('--max_clones_for_clustermaps', type=int, default=30000,
                     help='Currently the clustermapping code computes the full'
                     ' pairwise matrix of distances for hierarchical clustering.'
                     ' This can get slow and memory intensive, so limit the'
                     ' dataset size for these plots.')
+parser.add_argument('--tcrdist_cache_dir', help='Directory for a persistent tcrdist cache'
+                    ' that is reused across runs (see conga/tcrdist_cache.py). Can also'
+                    ' be set with the CONGA_TCRDIST_CACHE_DIR environment variable')
+parser.add_argument('--tcrdist_cache_max_gb', type=float, default=10.0)
 
 
 args = parser.parse_args()
@@ -174,6 +229,9 @@ start_time = time.time()
 
 ALL_STATS = OrderedDict() # for writing to the summary html file
 
+if args.tcrdist_cache_dir:
+    conga.tcrdist_cache.set_cache_dir(args.tcrdist_cache_dir, args.tcrdist_cache_max_gb)
+
 
 #############################################################################
 ###
@@ -218,6 +276,9 @@ if args.find_pmhc_nbrhood_overlaps or args.calc_clone_pmhc_pvals:
 if args.batch_keys:
     assert args.gex_data_type == 'h5ad' # need the info already in the obs dict
 
+if args.reuse_saved_nbrs:
+    assert args.restart
+
 if args.restart: # these are incompatible with restarting
      assert not (args.calc_clone_pmhc_pvals or
                  args.bad_barcodes_file or
@@ -271,6 +332,9 @@ if args.restart is None: ################################## load GEX/TCR data
             outfile=args.kpca_file,
             gaussian_kernel_sdev = args.kpca_gaussian_kernel_sdev,
             force_Dmax = args.kpca_default_kernel_Dmax,
+            num_landmarks = args.kpca_num_landmarks,
+            landmark_selection = args.kpca_landmark_selection,
+            lean = args.kpca_lean,
         )
 
     adata = conga.preprocess.read_dataset(
@@ -282,6 +346,9 @@ if args.restart is None: ################################## load GEX/TCR data
         gex_only = False,
         suffix_for_non_gene_features = args.suffix_for_non_gene_features,
         save_stats = ALL_STATS,
+        backed = args.backed_gex_data,
+        # same as the min_genes default in filter_and_scale below
+        prefilter_min_genes = 200 if args.backed_gex_data else None,
     )
 
     if args.rerun_kpca and args.clones_file is None:
@@ -297,6 +364,9 @@ if args.restart is None: ################################## load GEX/TCR data
             force_Dmax=args.kpca_default_kernel_Dmax,
             tcrs=tcrs,
             return_pcs = True,
+            num_landmarks = args.kpca_num_landmarks,
+            landmark_selection = args.kpca_landmark_selection,
+            lean = args.kpca_lean,
         )
         adata.obsm['X_pca_tcr'] = kpcs
 
@@ -583,14 +653,54 @@ nbr_frac_for_nndists = min( x for x in args.nbr_fracs
                             if x*num_clones>=10 or x==max(args.nbr_fracs) )
 outlog.write(f'nbr_frac_for_nndists: {nbr_frac_for_nndists}\n')
 obsm_tag_tcr = None if args.use_exact_tcrdist_nbrs else 'X_pca_tcr'
-all_nbrs, nndists_gex, nndists_tcr = conga.preprocess.calc_nbrs(
-    adata,
-    args.nbr_fracs,
-    also_calc_nndists = True,
-    nbr_frac_for_nndists = nbr_frac_for_nndists,
-    obsm_tag_tcr = obsm_tag_tcr,
+# saved nbrs are only reused if they were computed with the same settings
+nbr_settings = dict(
+    nbr_backend = args.nbr_backend,
+    approx_nbrs_candidate_factor = args.approx_nbrs_candidate_factor,
+    approx_nbrs_min_recall = args.approx_nbrs_min_recall,
     use_exact_tcrdist_nbrs = args.use_exact_tcrdist_nbrs,
+    nbr_distance_kernel = args.nbr_distance_kernel,
+    multires_nbrs = args.multires_nbrs,
 )
+saved_nbrs = None
+if args.reuse_saved_nbrs:
+    if not conga.preprocess.saved_nbrs_info_matches(adata, nbr_settings):
+        print('unable to reuse saved nbrs: computed for different clones or nbr',
+              'settings (or not saved), recomputing')
+    else:
+        saved_nbrs = conga.preprocess.retrieve_nbr_info_from_adata(
+            adata, missing_ok=True)
+        if (any(x not in saved_nbrs or saved_nbrs[x][0].shape[0] != num_clones
+                for x in args.nbr_fracs) or
+            'nndists_gex' not in adata.obs_keys()):
+            print('unable to reuse saved nbrs, recomputing:', sorted(saved_nbrs.keys()))
+            saved_nbrs = None
+
+if saved_nbrs is not None:
+    print('reusing saved nbrs for nbr_fracs:', args.nbr_fracs)
+    all_nbrs = dict((x, saved_nbrs[x]) for x in args.nbr_fracs)
+    nndists_gex = np.array(adata.obs['nndists_gex'])
+    nndists_tcr = np.array(adata.obs['nndists_tcr'])
+else:
+    all_nbrs, nndists_gex, nndists_tcr = conga.preprocess.calc_nbrs(
+        adata,
+        args.nbr_fracs,
+        also_calc_nndists = True,
+        nbr_frac_for_nndists = nbr_frac_for_nndists,
+        obsm_tag_tcr = obsm_tag_tcr,
+        use_exact_tcrdist_nbrs = args.use_exact_tcrdist_nbrs,
+        nbr_backend = args.nbr_backend,
+        approx_candidate_factor = args.approx_nbrs_candidate_factor,
+        approx_min_recall = args.approx_nbrs_min_recall,
+        multires = args.multires_nbrs,
+        n_jobs = args.nbr_n_jobs,
+        distance_kernel = args.nbr_distance_kernel,
+    )
+
+    if args.save_nbrs_sidecar: # referenced from adata.uns, so from _final.h5ad
+        conga.preprocess.save_nbr_info_to_adata(
+            adata, all_nbrs, sidecar_dir=args.outfile_prefix+'_nbrs',
+            nbr_settings=nbr_settings)
 
 
 #
@@ -1165,12 +1275,13 @@ if args.make_tcrdist_trees: ###################################################
         cscores = [x for x,y in zip(scores, cmask) if y]
 
         print('computing tcrdist distances:', clust, csize)
-        if csize>1000 and conga.util.tcrdist_cpp_available():
+        if csize>1000 and (conga.util.tcrdist_cpp_available() or
+                           conga.util.tcrdist_cpp_lib_available()):
             cdists = conga.preprocess.calc_tcrdist_matrix_cpp(
                 ctcrs, adata.uns['organism'])
         else:
-            cdists = np.array([ tcrdist(x,y) for x in ctcrs for y in ctcrs])\
-                       .reshape(csize,csize)
+            cdists = conga.preprocess.calc_tcrdist_matrix_python(
+                ctcrs, adata.uns['organism'], tcrdist)
 
         cmds = conga.tcrdist.make_tcr_trees.make_tcr_tree_svg_commands(
             ctcrs, organism, [x_offset,0], [width,height], cdists,
@@ -1202,13 +1313,14 @@ if args.make_tcrdist_trees: ###################################################
             ctcrs   = [x for x,y in zip(  tcrs, cmask) if y]
             cscores = [x for x,y in zip(scores, cmask) if y]
 
-            if csize>1000 and conga.util.tcrdist_cpp_available():
+            if csize>1000 and (conga.util.tcrdist_cpp_available() or
+                               conga.util.tcrdist_cpp_lib_available()):
                 cdists = conga.preprocess.calc_tcrdist_matrix_cpp(
                     ctcrs, adata.uns['organism'])
             else:
                 print('computing tcrdist distances:', clust, csize)
-                cdists = np.array([tcrdist(x,y) for x in ctcrs for y in ctcrs])\
-                           .reshape(csize,csize)
+                cdists = conga.preprocess.calc_tcrdist_matrix_python(
+                    ctcrs, adata.uns['organism'], tcrdist)
 
             cmds = conga.tcrdist.make_tcr_trees.make_tcr_tree_svg_commands(
                 ctcrs, organism, [0,0], [width,height], cdists,
@@ -17,9 +17,29 @@ parser.add_argument('--kpca_kernel')
 parser.add_argument('--kpca_gaussian_kernel_sdev', default=100.0, type=float,
                     help='only used if kpca_kernel==\'gaussian\'')
 parser.add_argument('--kpca_outfile')
+parser.add_argument('--kpca_num_landmarks', type=int,
+                    help='Approximate the TCRdist kernel PCA using distances to this'
+                    ' many landmark clonotypes, rather than the full NxN distance'
+                    ' matrix. Useful for very big datasets (>50k clonotypes)')
+parser.add_argument('--kpca_landmark_selection', choices=['kmeans++', 'random'],
+                    default='kmeans++')
+parser.add_argument('--kpca_lean', action='store_true',
+                    help='Exact TCRdist kernel PCA with a float32 in-place gram matrix'
+                    ' and a partial eigensolver: peak memory about 4*N^2 bytes')
+parser.add_argument('--save_kpca_model_file',
+                    help='Save the TCRdist kernel PCA model to this .npz file so new'
+                    ' samples can be projected onto it later with --kpca_model_file')
+parser.add_argument('--kpca_model_file',
+                    help='Project the clonotypes onto this saved TCRdist kernel PCA'
+                    ' model rather than running kernel PCA again. Existing'
+                    ' clonotypes keep their kernel PCs')
 parser.add_argument('--condense_clonotypes_by_tcrdist', action='store_true')
 parser.add_argument('--tcrdist_threshold_for_condensing', type=float, default=50.)
 parser.add_argument('--verbose', action='store_true')
+parser.add_argument('--tcrdist_cache_dir', help='Directory for a persistent tcrdist cache'
+                    ' that is reused across runs (see conga/tcrdist_cache.py). Can also'
+                    ' be set with the CONGA_TCRDIST_CACHE_DIR environment variable')
+parser.add_argument('--tcrdist_cache_max_gb', type=float, default=10.0)
 
 args = parser.parse_args()
 
@@ -37,10 +57,14 @@ assert args.kpca_kernel in [None, 'gaussian'] #None means classic default
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) ) # so we can import conga
 import conga
 from conga.preprocess import (make_tcrdist_kernel_pcs_file_from_clones_file,
+                              make_tcrdist_kernel_pcs_file_from_model,
                               condense_clones_file_and_barcode_mapping_file_by_tcrdist)
 
 from conga.tcrdist.make_10x_clones_file import make_10x_clones_file
 
+if args.tcrdist_cache_dir:
+    conga.tcrdist_cache.set_cache_dir(args.tcrdist_cache_dir, args.tcrdist_cache_max_gb)
+
 
 input_distfile = None
 
@@ -69,7 +93,10 @@ if args.input_clones_file is None:
         condense_clones_file_and_barcode_mapping_file_by_tcrdist(
             oldfile, output_clones_file, args.tcrdist_threshold_for_condensing, args.organism,
             output_distfile=input_distfile)
-
+    else:
+        # binary version of the barcode mapping for conga.preprocess.read_dataset
+        conga.preprocess.write_barcode_mapping_sidecar(
+            output_clones_file+'.barcode_mapping.tsv')
 
 else:
     output_clones_file = args.input_clones_file
@@ -80,6 +107,12 @@ assert exists(output_clones_file)
 
 if args.no_tcrdists:
     print(f'Skipping TCRdist calculations')
+elif args.kpca_model_file:
+    make_tcrdist_kernel_pcs_file_from_model(
+        output_clones_file,
+        args.kpca_model_file,
+        outfile=args.kpca_outfile,
+    )
 else:
     if args.save_tcrdist_matrices:
         output_distfile = output_clones_file[:-4]+'_AB.dist'
@@ -94,6 +127,10 @@ else:
         gaussian_kernel_sdev=args.kpca_gaussian_kernel_sdev,
         input_distfile=input_distfile,
         output_distfile=output_distfile,
+        num_landmarks=args.kpca_num_landmarks,
+        landmark_selection=args.kpca_landmark_selection,
+        model_file=args.save_kpca_model_file,
+        lean=args.kpca_lean,
     )
 
 print(f'If this all worked you should be able to pass {output_clones_file} as the --clones_file argument to run_conga.py')
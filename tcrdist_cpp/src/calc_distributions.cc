@@ -1,6 +1,7 @@
 #include "types.hh"
 #include "tcrdist.hh"
 #include "io.hh"
+#include "nbrs.hh"
 #include <random>
 
 
@@ -21,7 +22,7 @@ int main(int argc, char** argv)
 			"", "string",cmd);
 
  		TCLAP::ValueArg<std::string> outfile_arg("o","outfile",
-			"Filename to use for writing the counts distribution",true,
+			"Filename to use for writing the counts distribution",false,
 			"", "string",cmd);
 
  		TCLAP::ValueArg<string> tcrs_file_arg("f","tcrs_file","TSV (tab separated values) "
@@ -30,11 +31,27 @@ int main(int argc, char** argv)
 			"unk", "string", cmd);
 
  		TCLAP::ValueArg<string> achains_file_arg("a", "achains_file",
-			"TSV file with the background TCR alpha chains", true, "", "string", cmd);
+			"TSV file with the background TCR alpha chains. An optional 'count' column gives the "
+			"multiplicity of each chain, so a background with many duplicates can be compressed to "
+			"the unique chains", true, "", "string", cmd);
 
  		TCLAP::ValueArg<string> bchains_file_arg("b", "bchains_file",
-			"TSV file with the background TCR beta chains", true, "", "string", cmd);
+			"TSV file with the background TCR beta chains (optional 'count' column, as for -a)", true, "",
+			"string", cmd);
 
+ 		TCLAP::ValueArg<string> single_chain_outprefix_arg("s","single_chain_outprefix",
+			"Also write the single-chain distance histograms versus the background chains, to "
+			"<prefix>_acounts.npy and <prefix>_bcounts.npy (int64, shape num_tcrs x max_dist+1). The "
+			"paired counts are their convolution. -o can be left out if these are all that's needed",
+			false, "", "string", cmd);
+
+
+		TCLAP::SwitchArg binary_arg("","binary", "Write the counts as a numpy .npy file (int64, shape "
+			"num_tcrs x max_dist+1) instead of text", cmd, false);
+
+		TCLAP::ValueArg<Size> num_threads_arg("j","threads", "Number of worker threads. The rows are "
+			"split across the threads; the output is the same for any number of threads", false,
+			1, "integer", cmd);
 
 		cmd.parse( argc, argv );
 
@@ -44,6 +61,14 @@ int main(int argc, char** argv)
 		string const achains_file( achains_file_arg.getValue() );
 		string const bchains_file( bchains_file_arg.getValue() );
 		string const outfile( outfile_arg.getValue());
+		string const single_chain_outprefix( single_chain_outprefix_arg.getValue() );
+		bool const binary( binary_arg.getValue() );
+		Size const num_threads( max( Size(1), num_threads_arg.getValue() ) );
+		bool const paired_out( !outfile.empty() ), single_chain_out( !single_chain_outprefix.empty() );
+		if ( !paired_out && !single_chain_out ) {
+			cerr << "need at least one of -o/--outfile and -s/--single_chain_outprefix" << endl;
+			exit(1);
+		}
 
 		TCRdistCalculator const atcrdist('A', db_filename), btcrdist('B', db_filename);
 
@@ -51,50 +76,78 @@ int main(int argc, char** argv)
 		read_paired_tcrs_from_tsv_file(tcrs_file, atcrdist, btcrdist, tcrs);
 
 		vector< DistanceTCR_g > achains, bchains;
+		vector< int64_t > aweights, bweights; // empty unless there's a 'count' column
 
-		read_single_chain_tcrs_from_tsv_file(achains_file, 'A', atcrdist, achains);
-		read_single_chain_tcrs_from_tsv_file(bchains_file, 'B', btcrdist, bchains);
+		read_single_chain_tcrs_from_tsv_file(achains_file, 'A', atcrdist, achains, aweights);
+		read_single_chain_tcrs_from_tsv_file(bchains_file, 'B', btcrdist, bchains, bweights);
 
 		Size const num_tcrs(tcrs.size());
 
-		Sizes acounts(max_dist+1), bcounts(max_dist+1);
-		ofstream out(outfile);
+		ofstream out;
+		NpyWriter * npy_out( 0 );
+		if ( paired_out ) {
+			if ( binary ) npy_out = new NpyWriter( outfile, "<i8", max_dist+1 );
+			else out.open( outfile );
+		}
+		NpyWriter * aout( 0 ), * bout( 0 );
+		if ( single_chain_out ) {
+			aout = new NpyWriter( single_chain_outprefix+"_acounts.npy", "<i8", max_dist+1 );
+			bout = new NpyWriter( single_chain_outprefix+"_bcounts.npy", "<i8", max_dist+1 );
+		}
+
+		if ( paired_out ) cout << "making " << outfile << endl;
+		if ( single_chain_out ) cout << "making " << single_chain_outprefix << "_[ab]counts.npy" << endl;
 
-		cout << "making " << outfile << endl;
+		Size const block_size(100*num_threads); // each block is split across the threads
+		vector< int64_t > counts( block_size * (max_dist+1) ), acounts, bcounts;
+		if ( single_chain_out ) {
+			acounts.resize( counts.size() );
+			bcounts.resize( counts.size() );
+		}
 
-		for ( Size ii=0; ii< num_tcrs; ++ii ) {
-			if ( ii && ii%100==0 ) cerr << '.';
-			if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
+		for ( Size start=0; start< num_tcrs; start += block_size ) {
+			Size const stop( min( num_tcrs, start+block_size ) );
+			if ( start ) cerr << '.';
+			if ( start && start%5000<block_size ) cerr << ' ' << start << endl;
 
-			//DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
+			calc_background_distributions_for_rows( start, stop, atcrdist, btcrdist, tcrs, achains, bchains,
+				aweights, bweights, max_dist, paired_out ? &counts[0] : 0,
+				single_chain_out ? &acounts[0] : 0, single_chain_out ? &bcounts[0] : 0, num_threads );
 
-			for ( Size r=0; r<2; ++r){
-				Sizes & counts( r==0 ? acounts : bcounts);
-				fill( counts.begin(), counts.end(), 0);
-				DistanceTCR_g const &fg_tcr( r==0 ? tcrs[ii].first : tcrs[ii].second);
-				vector<DistanceTCR_g> const & bg_tcrs( r==0 ? achains : bchains );
-				TCRdistCalculator const & tcrdist( r==0 ? atcrdist : btcrdist );
-				Size dist(0);
-				for ( DistanceTCR_g const & bg_tcr : bg_tcrs ) {
-					dist = Size( 0.5 + tcrdist(fg_tcr, bg_tcr));
-					if ( dist <= max_dist ) ++counts[dist];
-				}
+			if ( single_chain_out ) {
+				aout->write( &acounts[0], (stop-start)*(max_dist+1) );
+				bout->write( &bcounts[0], (stop-start)*(max_dist+1) );
 			}
-
-			// compute probability distribution for paired distances using convolution
-			for ( Size d=0; d<= max_dist; ++d ) {
-				Size count(0);
-				for ( Size adist=0; adist<= d; ++adist ) {
-					count += acounts[adist] * bcounts[d-adist];
+			if ( !paired_out ) continue;
+			if ( binary ) {
+				npy_out->write( &counts[0], (stop-start)*(max_dist+1) );
+				continue;
+			}
+			for ( Size ii=start; ii< stop; ++ii ) {
+				int64_t const * row( &counts[ (ii-start)*(max_dist+1) ] );
+				for ( Size d=0; d<= max_dist; ++d ) {
+					if (d) out << ' ';
+					out << row[d];
 				}
-				if (d) out << ' ';
-				out << count;
+				out << '\n';
 			}
-			out << '\n';
 		}
 
 		cerr << endl;
-		out.close();
+		if ( paired_out ) {
+			if ( binary ) {
+				npy_out->close();
+				delete npy_out;
+			} else {
+				out.close();
+			}
+		}
+		if ( single_chain_out ) {
+			aout->close();
+			bout->close();
+			delete aout;
+			delete bout;
+		}
 
 	} catch (TCLAP::ArgException &e)  // catch any exceptions
 		{ std::cerr << "error: " << e.error() << " for arg " << e.argId() << std::endl; }
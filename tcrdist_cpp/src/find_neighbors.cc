@@ -1,6 +1,7 @@
 #include "types.hh"
 #include "tcrdist.hh"
 #include "io.hh"
+#include "nbrs.hh"
 #include <random>
 
 
@@ -44,6 +45,23 @@ int main(int argc, char** argv)
 			"(ie, one integer per line) ith the bgroups information so we can exclude same-group neighbors", false,
 			"", "string", cmd);
 
+		TCLAP::SwitchArg binary_arg("","binary", "Write the results as numpy .npy files (int32 indices, "
+			"uint16 distances) instead of text. In --threshold mode the variable-length neighbor lists are "
+			"concatenated and a CSR-style <prefix>_nbrN_offsets.npy (int64, num_tcrs+1) file is also written: "
+			"the nbrs of tcr i are indices[offsets[i]:offsets[i+1]]", cmd, false);
+
+		TCLAP::ValueArg<Size> num_threads_arg("j","threads", "Number of worker threads. The rows are "
+			"split across the threads; the output is the same for any number of threads", false,
+			1, "integer", cmd);
+
+		TCLAP::SwitchArg unique_chains_arg("u","unique_chains", "Compute single-chain distances to the "
+			"distinct alpha and beta chains and combine them by table lookup. Faster when there are many fewer "
+			"unique chains than tcrs; same results", cmd, false);
+
+		TCLAP::SwitchArg brute_force_arg("","brute_force", "In --threshold mode, score every pair instead of "
+			"using the lower-bound index to skip pairs that can't be within the threshold (same results)", cmd,
+			false);
+
 		cmd.parse( argc, argv );
 
 		string const db_filename( db_filename_arg.getValue() );
@@ -54,6 +72,11 @@ int main(int argc, char** argv)
 		string const agroups_file( agroups_file_arg.getValue() );
 		string const bgroups_file( bgroups_file_arg.getValue() );
 		string const outfile_prefix( outfile_prefix_arg.getValue());
+		bool const binary( binary_arg.getValue() );
+		string const suffix( binary ? ".npy" : ".txt" );
+		Size const num_threads( max( Size(1), num_threads_arg.getValue() ) );
+		bool const unique_chains( unique_chains_arg.getValue() );
+		bool const brute_force( brute_force_arg.getValue() );
 
 		runtime_assert( only_tcrdists || ( num_nbrs>0 && threshold_int==-1) || (num_nbrs==0 && threshold_int >=0 ) );
 
@@ -66,170 +89,201 @@ int main(int argc, char** argv)
 
 		Sizes agroups( agroups_file.size() ? read_groups_from_file(agroups_file) : Sizes() );
 		Sizes bgroups( bgroups_file.size() ? read_groups_from_file(bgroups_file) : Sizes() );
-		if ( agroups.empty() ) {
-			for ( Size i=0; i<num_tcrs; ++i ) agroups.push_back(i);
-		}
-		if ( bgroups.empty() ) {
-			for ( Size i=0; i<num_tcrs; ++i ) bgroups.push_back(i);
+		setup_default_groups( num_tcrs, agroups );
+		setup_default_groups( num_tcrs, bgroups );
+
+		UniqueChains unique_tcrs;
+		if ( unique_chains ) {
+			setup_unique_chains( tcrs, unique_tcrs );
+			cout << "Found " << unique_tcrs.achains.size() << " unique alpha chains and " <<
+				unique_tcrs.bchains.size() << " unique beta chains" << endl;
 		}
+		UniqueChains const * unique_tcrs_ptr( unique_chains ? &unique_tcrs : 0 );
 
-		runtime_assert( agroups.size() == num_tcrs );
-		runtime_assert( bgroups.size() == num_tcrs );
 		// two different modes of operations
 
-		Size const BIG_DIST(10000);
+		// we process the tcrs in blocks of rows, each block is split across the threads
+		Size const block_size(100*num_threads);
 
 		if ( only_tcrdists ) {
-			ofstream out(outfile_prefix+"_tcrdists.txt");
-			cout << "making " << outfile_prefix+"_tcrdists.txt" << endl;
-			for ( Size ii=0; ii< num_tcrs; ++ii ) {
-				if ( ii && ii%100==0 ) cerr << '.';
-				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
-
-				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
-				bool first(true);
-				for ( PairedTCR const & other_tcr : tcrs ) {
-					// NOTE we round down to an integer here!
-					if ( first ) first=false;
-					else out << ' ';
-					out << Size( 0.5 + atcrdist(atcr, other_tcr.first) + btcrdist(btcr, other_tcr.second) );
+			string const outfile( outfile_prefix+"_tcrdists"+suffix );
+			cout << "making " << outfile << endl;
+			ofstream out;
+			NpyWriter * npy_out( 0 );
+			if ( binary ) npy_out = new NpyWriter( outfile, "<u2", num_tcrs );
+			else out.open( outfile );
+
+			vector< uint16_t > dists( block_size * num_tcrs );
+			for ( Size start=0; start< num_tcrs; start += block_size ) {
+				Size const stop( min( num_tcrs, start+block_size ) );
+				if ( start ) cerr << '.';
+				if ( start && start%5000<block_size ) cerr << ' ' << start << endl;
+
+				compute_paired_tcrdists_for_rows( start, stop, atcrdist, btcrdist, tcrs, tcrs, unique_tcrs_ptr,
+					&dists[0], num_threads );
+				if ( binary ) {
+					npy_out->write( &dists[0], (stop-start)*num_tcrs );
+					continue;
+				}
+				for ( Size ii=start; ii< stop; ++ii ) {
+					uint16_t const * row( &dists[ (ii-start)*num_tcrs ] );
+					for ( Size jj=0; jj< num_tcrs; ++jj ) {
+						if ( jj ) out << ' ';
+						out << row[jj];
+					}
+					out << '\n';
 				}
-				out << '\n';
 			}
 			cerr << endl;
-			out.close();
+			if ( binary ) {
+				npy_out->close();
+				delete npy_out;
+			} else {
+				out.close();
+			}
 
 		} else if ( num_nbrs > 0 ) {
 			// open the outfiles
-			ofstream out_indices(outfile_prefix+"_knn_indices.txt");
-			ofstream out_distances(outfile_prefix+"_knn_distances.txt");
-
-			cout << "making " << outfile_prefix+"_knn_indices.txt" << " and " <<
-				outfile_prefix+"_knn_distances.txt" << endl;
-
-			Sizes dists(num_tcrs), sortdists(num_tcrs); // must be a better way to do this...
-			Sizes knn_indices, knn_distances;
-			knn_indices.reserve(num_nbrs);
-			knn_distances.reserve(num_nbrs);
-
-			minstd_rand0 rng(1); // seed
-			Sizes shuffled_indices;
-			for ( Size i=0; i<num_tcrs; ++i ) shuffled_indices.push_back(i);
-
-			for ( Size ii=0; ii< num_tcrs; ++ii ) {
-				if ( ii && ii%100==0 ) cerr << '.';
-				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
-
-				// for ties, shuffle so we don't get biases based on file order
-				shuffle(shuffled_indices.begin(), shuffled_indices.end(), rng);
-				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
-				{
-					Size i(0);
-					for ( PairedTCR const & other_tcr : tcrs ) {
-						// NOTE we round down to an integer here!
-						dists[i] = Size( 0.5 + atcrdist(atcr, other_tcr.first) + btcrdist(btcr, other_tcr.second) );
-						++i;
-					}
-				}
-				Size const a(agroups[ii]), b(bgroups[ii]);
-				for ( Size jj=0; jj< num_tcrs; ++jj ) {
-					if ( agroups[jj] == a || bgroups[jj] == b ) dists[jj] = BIG_DIST;
-				}
-				runtime_assert( dists[ii] == BIG_DIST );
-				copy(dists.begin(), dists.end(), sortdists.begin());
-				nth_element(sortdists.begin(), sortdists.begin()+num_nbrs-1, sortdists.end());
-				Size const threshold(sortdists[num_nbrs-1]);
-				Size num_at_threshold(0);
-				for ( Size i=0; i<num_nbrs; ++i ) {
-					// runtime_assert( sortdists[i] <= threshold ); // for debugging
-					if ( sortdists[i] == threshold ) ++num_at_threshold;
-				}
-				// for ( Size i=num_nbrs; i< num_tcrs; ++i ) { // just for debugging
-				// 	runtime_assert( sortdists[i] >= threshold );
-				// }
-				// if ( ii%500==0 ) {
-				// 	cout << "threshold: " << threshold << " num_at_threshold: " <<
-				// 		num_at_threshold << " ii: " << ii << endl;
-				// }
-				knn_distances.clear();
-				knn_indices.clear();
-				for ( Size i : shuffled_indices ) {
-					if ( dists[i] < threshold ) {
-						knn_indices.push_back(i);
-						knn_distances.push_back(dists[i]);
-					} else if ( dists[i] == threshold && num_at_threshold>0 ) {
-						knn_indices.push_back(i);
-						knn_distances.push_back(dists[i]);
-						--num_at_threshold;
-					}
-				}
-				runtime_assert(knn_indices.size() == num_nbrs);
-				runtime_assert(knn_distances.size() == num_nbrs);
+			string const indices_file( outfile_prefix+"_knn_indices"+suffix );
+			string const distances_file( outfile_prefix+"_knn_distances"+suffix );
+			cout << "making " << indices_file << " and " << distances_file << endl;
+
+			ofstream out_indices, out_distances;
+			NpyWriter * npy_indices( 0 ), * npy_distances( 0 );
+			if ( binary ) {
+				npy_indices = new NpyWriter( indices_file, "<i4", num_nbrs );
+				npy_distances = new NpyWriter( distances_file, "<u2", num_nbrs );
+			} else {
+				out_indices.open( indices_file );
+				out_distances.open( distances_file );
+			}
+
+			vector< int32_t > knn_indices( block_size * num_nbrs );
+			vector< uint16_t > knn_distances( block_size * num_nbrs );
+
+			for ( Size start=0; start< num_tcrs; start += block_size ) {
+				Size const stop( min( num_tcrs, start+block_size ) );
+				if ( start ) cerr << '.';
+				if ( start && start%5000<block_size ) cerr << ' ' << start << endl;
+
+				find_knn_nbrs_for_rows( start, stop, atcrdist, btcrdist, tcrs, unique_tcrs_ptr, agroups, bgroups,
+					num_nbrs, &knn_indices[0], &knn_distances[0], num_threads );
+
 				// save to files:
-				for ( Size j=0; j<num_nbrs; ++j ) {
-					if (j) {
-						out_indices << ' ';
-						out_distances << ' ';
+				if ( binary ) {
+					npy_indices->write( &knn_indices[0], (stop-start)*num_nbrs );
+					npy_distances->write( &knn_distances[0], (stop-start)*num_nbrs );
+					continue;
+				}
+				for ( Size ii=start; ii< stop; ++ii ) {
+					Size const offset( (ii-start)*num_nbrs );
+					for ( Size j=0; j<num_nbrs; ++j ) {
+						if (j) {
+							out_indices << ' ';
+							out_distances << ' ';
+						}
+						out_indices << knn_indices[offset+j];
+						out_distances << knn_distances[offset+j];
 					}
-					out_indices << knn_indices[j];
-					out_distances << knn_distances[j];
+					out_indices << '\n';
+					out_distances << '\n';
 				}
-				out_indices << '\n';
-				out_distances << '\n';
 			}
 			cerr << endl;
 			// close the output files
-			out_indices.close();
-			out_distances.close();
+			if ( binary ) {
+				npy_indices->close();
+				npy_distances->close();
+				delete npy_indices;
+				delete npy_distances;
+			} else {
+				out_indices.close();
+				out_distances.close();
+			}
 
 		} else { // using threshold definition of nbr-ness
 			// open the outfiles
-			ofstream out_indices(outfile_prefix+"_nbr"+to_string(threshold_int)+"_indices.txt");
-			ofstream out_distances(outfile_prefix+"_nbr"+to_string(threshold_int)+"_distances.txt");
-
-			cout << "making " << outfile_prefix+"_nbr"+to_string(threshold_int)+"_indices.txt" << " and " <<
-				outfile_prefix+"_nbr"+to_string(threshold_int)+"_distances.txt" << endl;
+			string const tag( outfile_prefix+"_nbr"+to_string(threshold_int) );
+			string const indices_file( tag+"_indices"+suffix ), distances_file( tag+"_distances"+suffix );
+			cout << "making " << indices_file << " and " << distances_file << endl;
+
+			ofstream out_indices, out_distances;
+			NpyWriter * npy_indices( 0 ), * npy_distances( 0 ), * npy_offsets( 0 );
+			if ( binary ) {
+				npy_indices = new NpyWriter( indices_file, "<i4", 0 );
+				npy_distances = new NpyWriter( distances_file, "<u2", 0 );
+				npy_offsets = new NpyWriter( tag+"_offsets"+suffix, "<i8", 0 );
+				int64_t const zero(0);
+				npy_offsets->write( &zero, 1 );
+			} else {
+				out_indices.open( indices_file );
+				out_distances.open( distances_file );
+			}
 
 			runtime_assert( threshold_int >= 0 );
 			Size const threshold(threshold_int);
 
-			Sizes knn_indices, knn_distances;
-			knn_indices.reserve(num_tcrs);
-			knn_distances.reserve(num_tcrs);
-
-			for ( Size ii=0; ii< num_tcrs; ++ii ) {
-				if ( ii && ii%100==0 ) cerr << '.';
-				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
-				knn_indices.clear();
-				knn_distances.clear();
-
-				// for ties, shuffle so we don't get biases based on file order
-				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
-				Size const a(agroups[ii]), b(bgroups[ii]);
-				for ( Size jj=0; jj< num_tcrs; ++jj ) {
-					Size const dist( 0.5 + atcrdist(atcr, tcrs[jj].first) + btcrdist(btcr, tcrs[jj].second) );
-					if ( dist <= threshold && agroups[jj] != a && bgroups[jj] != b ) {
-						knn_indices.push_back(jj);
-						knn_distances.push_back(dist);
+			ThresholdIndex threshold_index;
+			if ( !brute_force ) setup_threshold_index( tcrs, threshold_index );
+			ThresholdIndex const * threshold_index_ptr( brute_force ? 0 : &threshold_index );
+
+			vector< int64_t > offsets;
+			vector< int32_t > nbr_indices;
+			vector< uint16_t > nbr_distances;
+			int64_t num_written(0);
+
+			for ( Size start=0; start< num_tcrs; start += block_size ) {
+				Size const stop( min( num_tcrs, start+block_size ) );
+				if ( start ) cerr << '.';
+				if ( start && start%5000<block_size ) cerr << ' ' << start << endl;
+				offsets.assign( 1, 0 );
+				nbr_indices.clear();
+				nbr_distances.clear();
+
+				find_threshold_nbrs_for_rows( start, stop, atcrdist, btcrdist, tcrs, tcrs, unique_tcrs_ptr,
+					threshold_index_ptr, agroups, bgroups, threshold, offsets, nbr_indices, nbr_distances, num_threads );
+
+				if ( binary ) {
+					// shift the block offsets to global offsets
+					for ( Size i=1; i< offsets.size(); ++i ) {
+						int64_t const global_offset( num_written + offsets[i] );
+						npy_offsets->write( &global_offset, 1 );
+					}
+					num_written += nbr_indices.size();
+					if ( nbr_indices.size() ) {
+						npy_indices->write( &nbr_indices[0], nbr_indices.size() );
+						npy_distances->write( &nbr_distances[0], nbr_distances.size() );
 					}
+					continue;
 				}
 
 				// save to file: note that these lines may be empty!!!
-				for ( Size j=0; j<knn_indices.size(); ++j ) {
-					if (j) {
-						out_indices << ' ';
-						out_distances << ' ';
+				for ( Size ii=start; ii< stop; ++ii ) {
+					for ( int64_t j=offsets[ii-start]; j<offsets[ii-start+1]; ++j ) {
+						if ( j>offsets[ii-start] ) {
+							out_indices << ' ';
+							out_distances << ' ';
+						}
+						out_indices << nbr_indices[j];
+						out_distances << nbr_distances[j];
 					}
-					out_indices << knn_indices[j];
-					out_distances << knn_distances[j];
+					out_indices << '\n';
+					out_distances << '\n';
 				}
-				out_indices << '\n';
-				out_distances << '\n';
 			}
 			cerr << endl;
 			// close the output files
-			out_indices.close();
-			out_distances.close();
+			if ( binary ) {
+				npy_indices->close();
+				npy_distances->close();
+				npy_offsets->close();
+				delete npy_indices;
+				delete npy_distances;
+				delete npy_offsets;
+			} else {
+				out_indices.close();
+				out_distances.close();
+			}
 		}
 
 	} catch (TCLAP::ArgException &e)  // catch any exceptions
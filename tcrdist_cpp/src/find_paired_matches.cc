@@ -1,6 +1,7 @@
 #include "types.hh"
 #include "tcrdist.hh"
 #include "io.hh"
+#include "nbrs.hh"
 #include <random>
 
 
@@ -35,13 +36,23 @@ int main(int argc, char** argv)
 			"specified threshold", true,
 			"unk", "string", cmd);
 
+		// (no -j short flag here since it's taken by --tcrs_file2)
+		TCLAP::ValueArg<Size> num_threads_arg("","threads", "Number of worker threads. The rows are "
+			"split across the threads; the output is the same for any number of threads", false,
+			1, "integer", cmd);
+
+		TCLAP::SwitchArg brute_force_arg("","brute_force", "Score every pair instead of using the "
+			"lower-bound index to skip pairs that can't be within the threshold (same results)", cmd, false);
+
 		cmd.parse( argc, argv );
 
 		string const db_filename( db_filename_arg.getValue() );
-		Real const threshold(tcrdist_threshold_arg.getValue()+0.5 );
+		Size const threshold(tcrdist_threshold_arg.getValue());
 		string const tcrs_file1( tcrs_file1_arg.getValue() );
 		string const tcrs_file2( tcrs_file2_arg.getValue() );
 		string const outfile( outfile_arg.getValue() );
+		Size const num_threads( max( Size(1), num_threads_arg.getValue() ) );
+		bool const brute_force( brute_force_arg.getValue() );
 
 		TCRdistCalculator const atcrdist('A', db_filename), btcrdist('B', db_filename);
 
@@ -49,23 +60,39 @@ int main(int argc, char** argv)
 		read_paired_tcrs_from_tsv_file(tcrs_file1, atcrdist, btcrdist, tcrs1);
 		read_paired_tcrs_from_tsv_file(tcrs_file2, atcrdist, btcrdist, tcrs2);
 
+		ThresholdIndex threshold_index;
+		if ( !brute_force ) setup_threshold_index( tcrs2, threshold_index );
+		ThresholdIndex const * threshold_index_ptr( brute_force ? 0 : &threshold_index );
+
 		Size total_matches(0);
-		Real dist(0);
 
 		ofstream out(outfile.c_str());
 		out << "tcrdist\tindex1\tindex2\tcdr3b1\tcdr3b2\ttotal1\ttotal2\n";
 
-		for ( Size ii=0; ii< tcrs1.size(); ++ii ) {
-			if (ii && ii%1000==0) cerr << '.';
-			if (ii && ii%50000==0) cerr << endl;
-			DistanceTCR_g const &atcr1( tcrs1[ii].first ), &btcr1( tcrs1[ii].second);
-			for ( Size jj=0; jj< tcrs2.size(); ++jj ) {
-				dist = atcrdist(atcr1, tcrs2[jj].first) + btcrdist(btcr1, tcrs2[jj].second);
-				//match_score += exp( neginvar*dist*dist );
-				if ( dist <= threshold ) {
-					DistanceTCR_g &btcr2( tcrs2[jj].second);
-					out << dist << '\t' << ii << '\t' << jj << '\t' << btcr1.cdr3 << '\t' << btcr2.cdr3 << '\t' <<
-						tcrs1.size() << '\t' << tcrs2.size() << '\n';
+		Size const block_size(1000*num_threads); // each block is split across the threads
+		Sizes const no_groups;
+		vector< int64_t > offsets;
+		vector< int32_t > match_indices;
+		vector< uint16_t > match_distances;
+
+		for ( Size start=0; start< tcrs1.size(); start += block_size ) {
+			Size const stop( min( tcrs1.size(), start+block_size ) );
+			if (start) cerr << '.';
+			if (start && start%50000<block_size) cerr << endl;
+			offsets.assign( 1, 0 );
+			match_indices.clear();
+			match_distances.clear();
+
+			find_threshold_nbrs_for_rows( start, stop, atcrdist, btcrdist, tcrs1, tcrs2, 0, threshold_index_ptr,
+				no_groups, no_groups, threshold, offsets, match_indices, match_distances, num_threads );
+
+			for ( Size ii=start; ii< stop; ++ii ) {
+				DistanceTCR_g const &btcr1( tcrs1[ii].second);
+				for ( int64_t j=offsets[ii-start]; j<offsets[ii-start+1]; ++j ) {
+					Size const jj( match_indices[j] );
+					DistanceTCR_g const &btcr2( tcrs2[jj].second);
+					out << match_distances[j] << '\t' << ii << '\t' << jj << '\t' << btcr1.cdr3 << '\t' <<
+						btcr2.cdr3 << '\t' << tcrs1.size() << '\t' << tcrs2.size() << '\n';
 					++total_matches;
 				}
 			}
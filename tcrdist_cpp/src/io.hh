@@ -93,7 +93,8 @@ read_single_chain_tcrs_from_tsv_file(
 	string const filename,
 	char const chain, // either 'A' or 'B'
 	TCRdistCalculator const & tcrdist,
-	vector< DistanceTCR_g > & tcrs
+	vector< DistanceTCR_g > & tcrs,
+	vector< int64_t > & weights // filled from the optional 'count' column, else left empty
 )
 {
 	runtime_assert( chain == 'A' || chain == 'B');
@@ -111,6 +112,9 @@ read_single_chain_tcrs_from_tsv_file(
 	string const cdr3_tag(chain == 'A' ? "cdr3 cdr3a" : "cdr3 cdr3b" );
 	Size const v_index(get_tsv_index(line, split_to_vector(vtags)));
 	Size const cdr3_index(get_tsv_index(line, split_to_vector(cdr3_tag)));
+	bool const has_counts( has_element(string("count"), header) );
+	Size const count_index( has_counts ? vector_index(string("count"), header) : 0 );
+	weights.clear();
 
 	while ( getline( data, line ) ) {
 		strings const l(split_to_vector(line, "\t"));
@@ -129,11 +133,31 @@ read_single_chain_tcrs_from_tsv_file(
 		}
 
 		tcrs.push_back(tcrdist.create_distance_tcr_g(v, cdr3));
+		if ( has_counts ) {
+			int64_t const count( stol( l[count_index] ) );
+			if ( count < 0 ) {
+				cerr << "bad count: " << line << endl;
+				exit(1);
+			}
+			weights.push_back( count );
+		}
 	}
 
 	cout << "Read " << tcrs.size() << " single chain tcrs from file " << filename << endl;
 }
 
+void
+read_single_chain_tcrs_from_tsv_file(
+	string const filename,
+	char const chain, // either 'A' or 'B'
+	TCRdistCalculator const & tcrdist,
+	vector< DistanceTCR_g > & tcrs
+)
+{
+	vector< int64_t > weights;
+	read_single_chain_tcrs_from_tsv_file( filename, chain, tcrdist, tcrs, weights );
+}
+
 
 Sizes
 read_groups_from_file( string const & filename )
@@ -159,4 +183,78 @@ read_groups_from_file( string const & filename )
 
 
 
+//////////////////////////////////// BINARY OUTPUT
+// Minimal writer for numpy .npy files (format version 1.0) so that python can
+// np.load (or memory-map) our results instead of parsing text.
+//
+// The number of rows doesn't need to be known in advance: the header is written
+// with a fixed, padded size and then rewritten with the final shape in close()
+//
+// num_cols==0 means a 1D array
+//
+class NpyWriter {
+public:
+	NpyWriter(
+		string const & filename,
+		string const & descr, // numpy dtype, eg "<i4", "<u2", "<i8"
+		Size const num_cols
+	):
+		out_( filename.c_str(), ios::binary ),
+		descr_( descr ),
+		num_cols_( num_cols ),
+		num_written_( 0 )
+	{
+		if ( !out_.good() ) {
+			cerr << "unable to open " << filename << endl;
+			exit(1);
+		}
+		write_header();
+	}
+
+	template< typename T >
+	void
+	write( T const * data, Size const n )
+	{
+		out_.write( reinterpret_cast< char const * >( data ), n*sizeof(T) );
+		num_written_ += n;
+	}
+
+	void
+	close()
+	{
+		out_.seekp(0);
+		write_header();
+		out_.close();
+	}
+
+private:
+
+	void
+	write_header()
+	{
+		Size const header_len( 118 ); // 10 + 118 = 128, a multiple of 64 as numpy prefers
+		ostringstream dict;
+		dict << "{'descr': '" << descr_ << "', 'fortran_order': False, 'shape': (";
+		if ( num_cols_ ) {
+			runtime_assert( num_written_ % num_cols_ == 0 );
+			dict << num_written_/num_cols_ << ", " << num_cols_ << "), }";
+		} else {
+			dict << num_written_ << ",), }";
+		}
+		string header( dict.str() );
+		runtime_assert( header.size() < header_len );
+		header += string( header_len - 1 - header.size(), ' ' ) + "\n";
+
+		unsigned char const len_bytes[2] = { header_len & 0xff, header_len >> 8 };
+		out_.write( "\x93NUMPY\x01\x00", 8 );
+		out_.write( reinterpret_cast< char const * >( len_bytes ), 2 );
+		out_.write( header.c_str(), header.size() );
+	}
+
+	ofstream out_;
+	string descr_;
+	Size num_cols_;
+	Size num_written_;
+};
+
 #endif
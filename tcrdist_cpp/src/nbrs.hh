@@ -0,0 +1,570 @@
+// Distance-matrix, neighbor, and background-distribution routines that are
+// shared by the executables (find_neighbors, calc_distributions, ...) and by
+// the in-process library (tcrdist_lib.cc)
+//
+// everything works on a range of query rows [row_start, row_stop) so that the
+// callers can process big datasets in blocks and stream/copy out the results.
+// Each block of rows can be split across num_threads worker threads; the results
+// are identical (and in the same order) for any number of threads
+//
+// The target tcrs can optionally be factored into their unique alpha and beta chains
+// (see UniqueChains), in which case each query row computes single-chain distances to
+// the distinct chains and the paired distances are two table lookups. Results are
+// identical either way. Threshold searches can also use a ThresholdIndex, which skips
+// target tcrs whose distance provably exceeds the threshold (same results again)
+//
+
+#ifndef INCLUDED_nbrs_HH
+#define INCLUDED_nbrs_HH
+
+#include "types.hh"
+#include "tcrdist.hh"
+#include "misc.hh"
+#include <cstdint>
+#include <random>
+#include <thread>
+#include <map>
+
+// distance assigned to same-group clones so they never become neighbors
+Size const BIG_DIST(10000);
+
+inline
+Size
+paired_tcrdist(
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	PairedTCR const & t1,
+	PairedTCR const & t2
+)
+{
+	// NOTE we round to an integer here!
+	return Size( 0.5 + atcrdist(t1.first, t2.first) + btcrdist(t1.second, t2.second) );
+}
+
+// fill in the default groups (every tcr in its own group) if none were provided
+void
+setup_default_groups(
+	Size const num_tcrs,
+	Sizes & groups
+)
+{
+	if ( groups.empty() ) {
+		for ( Size i=0; i<num_tcrs; ++i ) groups.push_back(i);
+	}
+	runtime_assert( groups.size() == num_tcrs );
+}
+
+
+// split rows [row_start, row_stop) into num_threads contiguous chunks and call
+// f( chunk_start, chunk_stop, chunk_index ) for each one, in its own thread
+template< typename F >
+void
+run_rows_in_threads(
+	Size const row_start,
+	Size const row_stop,
+	Size const num_threads_in,
+	F const & f
+)
+{
+	Size const num_rows( row_stop - row_start );
+	Size const num_threads( max( Size(1), min( num_threads_in, num_rows ) ) );
+	if ( num_threads == 1 ) {
+		f( row_start, row_stop, 0 );
+		return;
+	}
+	Size const chunk_size( ( num_rows + num_threads - 1 ) / num_threads );
+	vector< thread > threads;
+	for ( Size t=0; t< num_threads; ++t ) {
+		Size const start( row_start + t*chunk_size ), stop( min( row_stop, start+chunk_size ) );
+		if ( start >= stop ) break;
+		threads.push_back( thread( [&f,start,stop,t](){ f( start, stop, t ); } ) );
+	}
+	for ( thread & th : threads ) th.join();
+}
+
+// the rng used to break ties in the knn neighbor lists of row ii. It depends only on
+// the row (not on which other rows were processed before it), so the results are
+// reproducible regardless of blocking/threading
+inline
+void
+seed_row_rng(
+	Size const ii,
+	minstd_rand0 & rng
+)
+{
+	seed_seq seq{ Size(1), ii }; // 1 = overall seed
+	rng.seed( seq );
+}
+
+
+// unique-chain factorization of a list of paired tcrs. The paired distance is
+// atcrdist + btcrdist, so we only need distances to the distinct alpha and beta
+// chains, of which there can be many fewer than paired tcrs
+struct UniqueChains {
+	vector< DistanceTCR_g > achains, bchains; // the distinct chains (v_num + cdr3)
+	Sizes amap, bmap; // tcr index --> index in achains/bchains
+};
+
+void
+setup_unique_chains(
+	vector< PairedTCR > const & tcrs,
+	UniqueChains & unique_chains
+)
+{
+	for ( Size r=0; r<2; ++r ) {
+		vector< DistanceTCR_g > & chains( r==0 ? unique_chains.achains : unique_chains.bchains );
+		Sizes & chain_map( r==0 ? unique_chains.amap : unique_chains.bmap );
+		chains.clear();
+		chain_map.clear();
+		map< pair< Size, string >, Size > chain2index;
+		for ( PairedTCR const & tcr : tcrs ) {
+			DistanceTCR_g const & chain( r==0 ? tcr.first : tcr.second );
+			pair< Size, string > const key( chain.v_num, chain.cdr3 );
+			map< pair< Size, string >, Size >::const_iterator it( chain2index.find( key ) );
+			if ( it == chain2index.end() ) {
+				it = chain2index.insert( make_pair( key, chains.size() ) ).first;
+				chains.push_back( chain );
+			}
+			chain_map.push_back( it->second );
+		}
+	}
+}
+
+// paired distances from tcr to all the target tcrs, written into dists. If
+// unique_targets is non-null (the factorization of target_tcrs), the single-chain
+// distances are computed once per distinct chain into the scratch arrays adists and
+// bdists and then looked up
+void
+compute_paired_tcrdists_to_targets(
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	PairedTCR const & tcr,
+	vector< PairedTCR > const & target_tcrs,
+	UniqueChains const * unique_targets,
+	Reals & adists,
+	Reals & bdists,
+	Sizes & dists
+)
+{
+	Size const num_targets( target_tcrs.size() );
+	dists.resize( num_targets );
+	if ( !unique_targets ) {
+		for ( Size jj=0; jj< num_targets; ++jj ) {
+			dists[jj] = paired_tcrdist( atcrdist, btcrdist, tcr, target_tcrs[jj] );
+		}
+		return;
+	}
+	UniqueChains const & targets( *unique_targets );
+	runtime_assert( targets.amap.size() == num_targets && targets.bmap.size() == num_targets );
+	adists.resize( targets.achains.size() );
+	bdists.resize( targets.bchains.size() );
+	for ( Size a=0; a< adists.size(); ++a ) adists[a] = atcrdist( tcr.first, targets.achains[a] );
+	for ( Size b=0; b< bdists.size(); ++b ) bdists[b] = btcrdist( tcr.second, targets.bchains[b] );
+	for ( Size jj=0; jj< num_targets; ++jj ) {
+		// NOTE we round to an integer here! (same as paired_tcrdist)
+		dists[jj] = Size( 0.5 + adists[ targets.amap[jj] ] + bdists[ targets.bmap[jj] ] );
+	}
+}
+
+
+// rows [row_start, row_stop) of the query_tcrs x target_tcrs distance matrix,
+// written row-major into dists (which has room for (row_stop-row_start)*target_tcrs.size())
+void
+compute_paired_tcrdists_for_rows(
+	Size const row_start,
+	Size const row_stop,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	vector< PairedTCR > const & query_tcrs,
+	vector< PairedTCR > const & target_tcrs,
+	UniqueChains const * unique_targets, // may be NULL
+	uint16_t * dists,
+	Size const num_threads = 1
+)
+{
+	Size const num_targets( target_tcrs.size() );
+	run_rows_in_threads( row_start, row_stop, num_threads, [&]( Size start, Size stop, Size ) {
+			Reals adists, bdists;
+			Sizes row_dists;
+			for ( Size ii=start; ii< stop; ++ii ) {
+				compute_paired_tcrdists_to_targets( atcrdist, btcrdist, query_tcrs[ii], target_tcrs, unique_targets,
+					adists, bdists, row_dists );
+				copy( row_dists.begin(), row_dists.end(), dists + (ii-row_start)*num_targets );
+			}
+		} );
+}
+
+
+// rows [row_start, row_stop) of the query_chains x target_chains single-chain distance
+// matrix (not rounded), written into dists
+void
+compute_single_chain_tcrdists_for_rows(
+	Size const row_start,
+	Size const row_stop,
+	TCRdistCalculator const & tcrdist,
+	vector< DistanceTCR_g > const & query_chains,
+	vector< DistanceTCR_g > const & target_chains,
+	float * dists,
+	Size const num_threads = 1
+)
+{
+	Size const num_targets( target_chains.size() );
+	run_rows_in_threads( row_start, row_stop, num_threads, [&]( Size start, Size stop, Size ) {
+			for ( Size ii=start; ii< stop; ++ii ) {
+				float * row( dists + (ii-row_start)*num_targets );
+				for ( Size jj=0; jj< num_targets; ++jj ) {
+					row[jj] = tcrdist( query_chains[ii], target_chains[jj] );
+				}
+			}
+		} );
+}
+
+
+// the num_nbrs nearest neighbors of the tcrs in rows [row_start, row_stop),
+// excluding same-agroup and same-bgroup tcrs. Ties at the num_nbrs-th distance are
+// broken by shuffling the candidates with the per-row rng (see seed_row_rng)
+//
+// knn_indices and knn_distances have room for (row_stop-row_start)*num_nbrs
+void
+find_knn_nbrs_for_rows(
+	Size const row_start,
+	Size const row_stop,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	vector< PairedTCR > const & tcrs,
+	UniqueChains const * unique_tcrs, // may be NULL
+	Sizes const & agroups,
+	Sizes const & bgroups,
+	Size const num_nbrs,
+	int32_t * knn_indices,
+	uint16_t * knn_distances,
+	Size const num_threads = 1
+)
+{
+	Size const num_tcrs(tcrs.size());
+	runtime_assert( num_nbrs>0 && num_nbrs <= num_tcrs );
+
+	run_rows_in_threads( row_start, row_stop, num_threads, [&]( Size start, Size stop, Size ) {
+			Sizes dists(num_tcrs), sortdists(num_tcrs), shuffled_indices(num_tcrs);
+			Reals adists, bdists;
+			minstd_rand0 rng;
+			for ( Size ii=start; ii< stop; ++ii ) {
+				// for ties, shuffle so we don't get biases based on file order
+				for ( Size i=0; i<num_tcrs; ++i ) shuffled_indices[i] = i;
+				seed_row_rng( ii, rng );
+				shuffle(shuffled_indices.begin(), shuffled_indices.end(), rng);
+				compute_paired_tcrdists_to_targets( atcrdist, btcrdist, tcrs[ii], tcrs, unique_tcrs, adists, bdists,
+					dists );
+				Size const a(agroups[ii]), b(bgroups[ii]);
+				for ( Size jj=0; jj< num_tcrs; ++jj ) {
+					if ( agroups[jj] == a || bgroups[jj] == b ) dists[jj] = BIG_DIST;
+				}
+				runtime_assert( dists[ii] == BIG_DIST );
+				copy(dists.begin(), dists.end(), sortdists.begin());
+				nth_element(sortdists.begin(), sortdists.begin()+num_nbrs-1, sortdists.end());
+				Size const threshold(sortdists[num_nbrs-1]);
+				Size num_at_threshold(0);
+				for ( Size i=0; i<num_nbrs; ++i ) {
+					if ( sortdists[i] == threshold ) ++num_at_threshold;
+				}
+				int32_t * row_indices( knn_indices + (ii-row_start)*num_nbrs );
+				uint16_t * row_distances( knn_distances + (ii-row_start)*num_nbrs );
+				Size num_found(0);
+				for ( Size i : shuffled_indices ) {
+					if ( dists[i] < threshold || ( dists[i] == threshold && num_at_threshold>0 ) ) {
+						if ( dists[i] == threshold ) --num_at_threshold;
+						row_indices[num_found] = i;
+						row_distances[num_found] = dists[i];
+						++num_found;
+					}
+				}
+				runtime_assert( num_found == num_nbrs );
+			}
+		} );
+}
+
+
+// index for threshold queries: the target tcrs are bucketed by their alpha (V gene,
+// cdr3 length) and beta (V gene, cdr3 length) keys. The distance between two chains is
+// at least TCRdistCalculator::lower_bound_distance of their keys, so whole buckets can
+// be skipped when the alpha plus beta lower bounds already exceed the threshold
+struct ThresholdIndex {
+	SizePairs akeys, bkeys; // (v_num, cdr3 length)
+	// cells[a] = the (bkey index, target indices) buckets for the targets with akey a
+	vector< vector< pair< Size, Sizes > > > cells;
+};
+
+void
+setup_threshold_index(
+	vector< PairedTCR > const & tcrs,
+	ThresholdIndex & index
+)
+{
+	map< SizePair, Size > akey2index, bkey2index;
+	vector< map< Size, Sizes > > cells;
+	index.akeys.clear();
+	index.bkeys.clear();
+	for ( Size jj=0; jj< tcrs.size(); ++jj ) {
+		SizePair const akey( tcrs[jj].first.v_num, tcrs[jj].first.cdr3.size() );
+		SizePair const bkey( tcrs[jj].second.v_num, tcrs[jj].second.cdr3.size() );
+		if ( !akey2index.count( akey ) ) {
+			akey2index[ akey ] = index.akeys.size();
+			index.akeys.push_back( akey );
+			cells.push_back( map< Size, Sizes >() );
+		}
+		if ( !bkey2index.count( bkey ) ) {
+			bkey2index[ bkey ] = index.bkeys.size();
+			index.bkeys.push_back( bkey );
+		}
+		cells[ akey2index[ akey ] ][ bkey2index[ bkey ] ].push_back( jj );
+	}
+	index.cells.clear();
+	for ( map< Size, Sizes > const & acells : cells ) {
+		index.cells.push_back( vector< pair< Size, Sizes > >( acells.begin(), acells.end() ) );
+	}
+}
+
+// all the target tcrs within threshold of tcr, as (target index, distance) pairs in
+// increasing order of target index, using the index to skip hopeless buckets. The
+// scratch arrays alower/blower hold tcr's lower bounds versus the index keys
+void
+find_threshold_hits_with_index(
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	PairedTCR const & tcr,
+	vector< PairedTCR > const & target_tcrs,
+	ThresholdIndex const & index,
+	Size const threshold,
+	Reals & alower,
+	Reals & blower,
+	SizePairs & hits
+)
+{
+	// paired dist is Size( 0.5 + adist + bdist ) so this bound means dist > threshold
+	Real const max_bound( threshold + 0.5 );
+	Size const av( tcr.first.v_num ), alen( tcr.first.cdr3.size() );
+	Size const bv( tcr.second.v_num ), blen( tcr.second.cdr3.size() );
+
+	alower.resize( index.akeys.size() );
+	blower.resize( index.bkeys.size() );
+	for ( Size a=0; a< alower.size(); ++a ) {
+		alower[a] = atcrdist.lower_bound_distance( av, alen, index.akeys[a].first, index.akeys[a].second );
+	}
+	for ( Size b=0; b< blower.size(); ++b ) {
+		blower[b] = btcrdist.lower_bound_distance( bv, blen, index.bkeys[b].first, index.bkeys[b].second );
+	}
+
+	hits.clear();
+	for ( Size a=0; a< alower.size(); ++a ) {
+		if ( alower[a] >= max_bound ) continue;
+		for ( pair< Size, Sizes > const & cell : index.cells[a] ) {
+			Real const bbound( blower[ cell.first ] );
+			if ( alower[a] + bbound >= max_bound ) continue;
+			for ( Size jj : cell.second ) {
+				// partial sum: skip the beta calculation if the alpha distance is already too big
+				Real const adist( atcrdist( tcr.first, target_tcrs[jj].first ) );
+				if ( adist + bbound >= max_bound ) continue;
+				Size const dist( 0.5 + adist + btcrdist( tcr.second, target_tcrs[jj].second ) );
+				if ( dist <= threshold ) hits.push_back( make_pair( jj, dist ) );
+			}
+		}
+	}
+	sort( hits.begin(), hits.end() );
+}
+
+
+// all target tcrs within threshold of the query tcrs in rows [row_start, row_stop)
+//
+// results are appended CSR-style: offsets gets one new entry per row (the end of that
+// row's block in indices/distances), so start with offsets = {0}
+//
+// if agroups/bgroups are non-empty then query_tcrs and target_tcrs should be the same
+// set, and same-agroup or same-bgroup tcrs are excluded
+//
+// if threshold_index (built from target_tcrs) is non-NULL it's used to prune the
+// search and unique_targets is ignored
+void
+find_threshold_nbrs_for_rows(
+	Size const row_start,
+	Size const row_stop,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	vector< PairedTCR > const & query_tcrs,
+	vector< PairedTCR > const & target_tcrs,
+	UniqueChains const * unique_targets, // may be NULL
+	ThresholdIndex const * threshold_index, // may be NULL
+	Sizes const & agroups,
+	Sizes const & bgroups,
+	Size const threshold,
+	vector< int64_t > & offsets,
+	vector< int32_t > & indices,
+	vector< uint16_t > & distances,
+	Size const num_threads = 1
+)
+{
+	bool const exclude_groups( !agroups.empty() );
+	Size const num_targets( target_tcrs.size() );
+	if ( exclude_groups ) {
+		runtime_assert( agroups.size() == num_targets && bgroups.size() == num_targets );
+	}
+
+	// per-thread buffers, appended in order at the end
+	Size const max_chunks( max( Size(1), num_threads ) );
+	vector< vector< int64_t > > chunk_sizes( max_chunks );
+	vector< vector< int32_t > > chunk_indices( max_chunks );
+	vector< vector< uint16_t > > chunk_distances( max_chunks );
+
+	run_rows_in_threads( row_start, row_stop, num_threads, [&]( Size start, Size stop, Size chunk ) {
+			vector< int64_t > & row_sizes( chunk_sizes[chunk] );
+			vector< int32_t > & nbr_indices( chunk_indices[chunk] );
+			vector< uint16_t > & nbr_distances( chunk_distances[chunk] );
+			Reals adists, bdists;
+			Sizes dists;
+			SizePairs hits;
+			for ( Size ii=start; ii< stop; ++ii ) {
+				Size const old_size( nbr_indices.size() );
+				if ( threshold_index ) {
+					find_threshold_hits_with_index( atcrdist, btcrdist, query_tcrs[ii], target_tcrs, *threshold_index,
+						threshold, adists, bdists, hits );
+					for ( SizePair const & hit : hits ) {
+						Size const jj( hit.first );
+						if ( !exclude_groups || ( agroups[jj] != agroups[ii] && bgroups[jj] != bgroups[ii] ) ) {
+							nbr_indices.push_back(jj);
+							nbr_distances.push_back(hit.second);
+						}
+					}
+				} else {
+					compute_paired_tcrdists_to_targets( atcrdist, btcrdist, query_tcrs[ii], target_tcrs,
+						unique_targets, adists, bdists, dists );
+					for ( Size jj=0; jj< num_targets; ++jj ) {
+						Size const dist( dists[jj] );
+						if ( dist <= threshold &&
+							( !exclude_groups || ( agroups[jj] != agroups[ii] && bgroups[jj] != bgroups[ii] ) ) ) {
+							nbr_indices.push_back(jj);
+							nbr_distances.push_back(dist);
+						}
+					}
+				}
+				row_sizes.push_back( nbr_indices.size() - old_size );
+			}
+		} );
+
+	for ( Size chunk=0; chunk< max_chunks; ++chunk ) {
+		for ( int64_t row_size : chunk_sizes[chunk] ) offsets.push_back( offsets.back() + row_size );
+		indices.insert( indices.end(), chunk_indices[chunk].begin(), chunk_indices[chunk].end() );
+		distances.insert( distances.end(), chunk_distances[chunk].begin(), chunk_distances[chunk].end() );
+	}
+}
+
+
+// convolve the single-chain histograms acounts and bcounts (each max_dist+1 long) to get
+// the paired-distance counts. Only the nonzero alpha bins contribute (the histograms are
+// sparse at small distances), and the inner loop is over contiguous memory so it vectorizes.
+// The counts are exact integers, so no FFT here.
+inline
+void
+convolve_background_histograms(
+	int64_t const * acounts,
+	int64_t const * bcounts,
+	Size const max_dist,
+	int64_t * row
+)
+{
+	fill( row, row + max_dist+1, 0 );
+	for ( Size adist=0; adist<= max_dist; ++adist ) {
+		int64_t const acount( acounts[adist] );
+		if ( !acount ) continue;
+		int64_t * const out( row + adist );
+		Size const n( max_dist+1-adist );
+		for ( Size bdist=0; bdist< n; ++bdist ) {
+			out[bdist] += acount * bcounts[bdist];
+		}
+	}
+}
+
+// counts of background paired distances for the tcrs in rows [row_start, row_stop):
+// the single-chain distance histograms versus the background alpha and beta chains
+// are convolved to get the paired distribution
+//
+// aweights/bweights are the multiplicities of the background chains (if the background
+// has been compressed to unique chains); empty means each chain counts once
+//
+// counts has room for (row_stop-row_start)*(max_dist+1), as do achain_counts and
+// bchain_counts, which get the single-chain histograms if they're not 0. If counts is 0
+// the convolution is skipped.
+void
+calc_background_distributions_for_rows(
+	Size const row_start,
+	Size const row_stop,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	vector< PairedTCR > const & tcrs,
+	vector< DistanceTCR_g > const & achains,
+	vector< DistanceTCR_g > const & bchains,
+	vector< int64_t > const & aweights,
+	vector< int64_t > const & bweights,
+	Size const max_dist,
+	int64_t * counts,
+	int64_t * achain_counts = 0,
+	int64_t * bchain_counts = 0,
+	Size const num_threads = 1
+)
+{
+	runtime_assert( aweights.empty() || aweights.size() == achains.size() );
+	runtime_assert( bweights.empty() || bweights.size() == bchains.size() );
+
+	run_rows_in_threads( row_start, row_stop, num_threads, [&]( Size start, Size stop, Size ) {
+			vector< int64_t > acounts(max_dist+1), bcounts(max_dist+1);
+
+			for ( Size ii=start; ii< stop; ++ii ) {
+				for ( Size r=0; r<2; ++r){
+					vector< int64_t > & chain_counts( r==0 ? acounts : bcounts);
+					fill( chain_counts.begin(), chain_counts.end(), 0);
+					DistanceTCR_g const &fg_tcr( r==0 ? tcrs[ii].first : tcrs[ii].second);
+					vector<DistanceTCR_g> const & bg_tcrs( r==0 ? achains : bchains );
+					vector< int64_t > const & weights( r==0 ? aweights : bweights );
+					TCRdistCalculator const & tcrdist( r==0 ? atcrdist : btcrdist );
+					if ( weights.empty() ) {
+						for ( DistanceTCR_g const & bg_tcr : bg_tcrs ) {
+							Size const dist( 0.5 + tcrdist(fg_tcr, bg_tcr));
+							if ( dist <= max_dist ) ++chain_counts[dist];
+						}
+					} else {
+						for ( Size jj=0; jj< bg_tcrs.size(); ++jj ) {
+							Size const dist( 0.5 + tcrdist(fg_tcr, bg_tcrs[jj]));
+							if ( dist <= max_dist ) chain_counts[dist] += weights[jj];
+						}
+					}
+				}
+
+				Size const offset( (ii-row_start)*(max_dist+1) );
+				if ( achain_counts ) copy( acounts.begin(), acounts.end(), achain_counts + offset );
+				if ( bchain_counts ) copy( bcounts.begin(), bcounts.end(), bchain_counts + offset );
+
+				// compute probability distribution for paired distances using convolution
+				if ( counts ) convolve_background_histograms( &acounts[0], &bcounts[0], max_dist, counts + offset );
+			}
+		} );
+}
+
+// unweighted background chains, paired counts only
+void
+calc_background_distributions_for_rows(
+	Size const row_start,
+	Size const row_stop,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	vector< PairedTCR > const & tcrs,
+	vector< DistanceTCR_g > const & achains,
+	vector< DistanceTCR_g > const & bchains,
+	Size const max_dist,
+	int64_t * counts,
+	Size const num_threads = 1
+)
+{
+	vector< int64_t > const no_weights;
+	calc_background_distributions_for_rows( row_start, row_stop, atcrdist, btcrdist, tcrs, achains, bchains,
+		no_weights, no_weights, max_dist, counts, 0, 0, num_threads );
+}
+
+#endif
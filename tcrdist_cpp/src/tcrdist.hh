@@ -95,6 +95,16 @@ public:
 	bool
 	check_tcr_string_ok( string const & tcr ) const;
 
+	// lower bound on the distance between two chains with V genes v_num1/v_num2 and cdr3
+	// lengths len1/len2, for pruning: the cdr3 mismatch score is a sum over at most
+	// min(len1,len2) aligned positions, each at least min_aa_distance_ (normally 0)
+	Real
+	lower_bound_distance( Size const v_num1, Size const len1, Size const v_num2, Size const len2 ) const {
+		Size const lenshort( min( len1, len2 ) ), lendiff( max( len1, len2 ) - lenshort );
+		return V_dist_matrix_[ v_num1 ][ v_num2 ] + lendiff * gap_penalty_cdr3_region_ +
+			weight_cdr3_region_ * min( Real(0), min_aa_distance_ ) * lenshort;
+	}
+
 private:
 	// char const ab_;
 	vector< string > v_genes_;
@@ -109,6 +119,8 @@ private:
 
 	vector< vector< Real > > AA_dist_matrix_;
 
+	Real min_aa_distance_; // for lower_bound_distance
+
 	// the V region weights and distances are rolled into the v distances
 	Real weight_cdr3_region_;
 	Real gap_penalty_cdr3_region_;
@@ -168,6 +180,13 @@ TCRdistCalculator::TCRdistCalculator(
 		runtime_assert( !l.fail() );
 	}
 
+	min_aa_distance_ = big_dist;
+	for ( char const a : amino_acids_ ) {
+		for ( char const b : amino_acids_ ) {
+			min_aa_distance_ = min( min_aa_distance_, AA_dist_matrix_[a-'A'][b-'A'] );
+		}
+	}
+
 	string const abstring( 1,ab);
 	string const numtag( "num_V" + abstring + "_genes" ), disttag( "V"+abstring+"dist" );
 	getline(data,line);
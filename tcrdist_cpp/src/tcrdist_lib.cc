@@ -0,0 +1,393 @@
+// Shared library with a plain C interface to the TCRdist routines, so that python
+// can call them in-process (through ctypes, see conga/tcrdist_cpp.py) instead of
+// writing tsv files, running the executables, and parsing their text output
+//
+// tcrs are passed as parallel arrays of C strings (v genes and cdr3s); outputs are
+// written into caller-allocated buffers (numpy arrays on the python side). The
+// variable-length results (threshold nbrs and matches) are returned as an opaque
+// CSR-style result object that the caller sizes, copies out, and frees.
+//
+// the computations take a num_threads argument, and the paired-tcr ones a unique_chains
+// flag (factor the target tcrs into unique alpha and beta chains, see nbrs.hh); the
+// results don't depend on either. The threshold searches take a prune flag (use a
+// ThresholdIndex to skip pairs that can't be within the threshold, same results)
+//
+// NOTE: errors inside the TCRdistCalculator (eg unrecognized V genes) call exit(),
+// so the python wrapper checks the tcrs with tcrdist_check_chains first
+//
+
+#include "types.hh"
+#include "tcrdist.hh"
+#include "nbrs.hh"
+#include <cstdint>
+
+struct TCRdistEngine {
+	TCRdistEngine( string const & db_filename ):
+		atcrdist( 'A', db_filename ),
+		btcrdist( 'B', db_filename )
+	{}
+
+	TCRdistCalculator const atcrdist;
+	TCRdistCalculator const btcrdist;
+};
+
+struct TCRdistNbrsResult {
+	vector< int64_t > offsets;
+	vector< int32_t > indices;
+	vector< uint16_t > distances;
+};
+
+vector< PairedTCR >
+make_paired_tcrs(
+	TCRdistEngine const & engine,
+	int64_t const num_tcrs,
+	char const ** va,
+	char const ** cdr3a,
+	char const ** vb,
+	char const ** cdr3b
+)
+{
+	vector< PairedTCR > tcrs;
+	tcrs.reserve( num_tcrs );
+	for ( int64_t i=0; i< num_tcrs; ++i ) {
+		tcrs.push_back( make_pair( engine.atcrdist.create_distance_tcr_g( va[i], cdr3a[i] ),
+				engine.btcrdist.create_distance_tcr_g( vb[i], cdr3b[i] ) ) );
+	}
+	return tcrs;
+}
+
+vector< DistanceTCR_g >
+make_single_chain_tcrs(
+	TCRdistCalculator const & tcrdist,
+	int64_t const num_tcrs,
+	char const ** v,
+	char const ** cdr3
+)
+{
+	vector< DistanceTCR_g > tcrs;
+	tcrs.reserve( num_tcrs );
+	for ( int64_t i=0; i< num_tcrs; ++i ) {
+		tcrs.push_back( tcrdist.create_distance_tcr_g( v[i], cdr3[i] ) );
+	}
+	return tcrs;
+}
+
+Sizes
+make_groups(
+	int64_t const num_tcrs,
+	int64_t const * groups // may be NULL
+)
+{
+	Sizes g;
+	if ( groups ) g.assign( groups, groups+num_tcrs );
+	setup_default_groups( num_tcrs, g );
+	return g;
+}
+
+// the unique-chain factorization of tcrs (stored in unique), or NULL if not requested
+UniqueChains const *
+make_unique_chains(
+	vector< PairedTCR > const & tcrs,
+	int64_t const unique_chains,
+	UniqueChains & unique
+)
+{
+	if ( !unique_chains ) return 0;
+	setup_unique_chains( tcrs, unique );
+	return &unique;
+}
+
+// the threshold index for tcrs (stored in index), or NULL if not requested
+ThresholdIndex const *
+make_threshold_index(
+	vector< PairedTCR > const & tcrs,
+	int64_t const prune,
+	ThresholdIndex & index
+)
+{
+	if ( !prune ) return 0;
+	setup_threshold_index( tcrs, index );
+	return &index;
+}
+
+extern "C" {
+
+void *
+tcrdist_engine_new( char const * db_filename )
+{
+	return new TCRdistEngine( db_filename );
+}
+
+void
+tcrdist_engine_delete( void * engine )
+{
+	delete static_cast< TCRdistEngine * >( engine );
+}
+
+// returns the index of the first bad chain, or -1 if they are all OK
+int64_t
+tcrdist_check_chains(
+	void * engine_in,
+	char const chain, // 'A' or 'B'
+	int64_t const num_tcrs,
+	char const ** v,
+	char const ** cdr3
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	TCRdistCalculator const & tcrdist( chain == 'A' ? engine.atcrdist : engine.btcrdist );
+	for ( int64_t i=0; i< num_tcrs; ++i ) {
+		if ( !tcrdist.check_v_gene_ok( v[i] ) || !tcrdist.check_cdr3_ok( cdr3[i] ) ) return i;
+	}
+	return -1;
+}
+
+// dists has room for num_tcrs1*num_tcrs2
+void
+tcrdist_paired_distance_matrix(
+	void * engine_in,
+	int64_t const num_tcrs1,
+	char const ** va1,
+	char const ** cdr3a1,
+	char const ** vb1,
+	char const ** cdr3b1,
+	int64_t const num_tcrs2,
+	char const ** va2,
+	char const ** cdr3a2,
+	char const ** vb2,
+	char const ** cdr3b2,
+	uint16_t * dists,
+	int64_t const unique_chains,
+	int64_t const num_threads
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	vector< PairedTCR > const tcrs1( make_paired_tcrs( engine, num_tcrs1, va1, cdr3a1, vb1, cdr3b1 ) );
+	vector< PairedTCR > const tcrs2( make_paired_tcrs( engine, num_tcrs2, va2, cdr3a2, vb2, cdr3b2 ) );
+
+	UniqueChains unique;
+
+	compute_paired_tcrdists_for_rows( 0, tcrs1.size(), engine.atcrdist, engine.btcrdist, tcrs1, tcrs2,
+		make_unique_chains( tcrs2, unique_chains, unique ), dists, num_threads );
+}
+
+// single-chain distances (chain is 'A' or 'B'); dists has room for num_chains1*num_chains2
+void
+tcrdist_single_chain_distance_matrix(
+	void * engine_in,
+	char const chain,
+	int64_t const num_chains1,
+	char const ** v1,
+	char const ** cdr31,
+	int64_t const num_chains2,
+	char const ** v2,
+	char const ** cdr32,
+	float * dists,
+	int64_t const num_threads
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	TCRdistCalculator const & tcrdist( chain == 'A' ? engine.atcrdist : engine.btcrdist );
+	vector< DistanceTCR_g > const chains1( make_single_chain_tcrs( tcrdist, num_chains1, v1, cdr31 ) );
+	vector< DistanceTCR_g > const chains2( make_single_chain_tcrs( tcrdist, num_chains2, v2, cdr32 ) );
+
+	compute_single_chain_tcrdists_for_rows( 0, chains1.size(), tcrdist, chains1, chains2, dists, num_threads );
+}
+
+// agroups and bgroups may be NULL; knn_indices and knn_distances have room for num_tcrs*num_nbrs
+void
+tcrdist_knn_nbrs(
+	void * engine_in,
+	int64_t const num_tcrs,
+	char const ** va,
+	char const ** cdr3a,
+	char const ** vb,
+	char const ** cdr3b,
+	int64_t const * agroups_in,
+	int64_t const * bgroups_in,
+	int64_t const num_nbrs,
+	int32_t * knn_indices,
+	uint16_t * knn_distances,
+	int64_t const unique_chains,
+	int64_t const num_threads
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	vector< PairedTCR > const tcrs( make_paired_tcrs( engine, num_tcrs, va, cdr3a, vb, cdr3b ) );
+	Sizes const agroups( make_groups( num_tcrs, agroups_in ) ), bgroups( make_groups( num_tcrs, bgroups_in ) );
+
+	UniqueChains unique;
+
+	find_knn_nbrs_for_rows( 0, tcrs.size(), engine.atcrdist, engine.btcrdist, tcrs,
+		make_unique_chains( tcrs, unique_chains, unique ), agroups, bgroups, num_nbrs, knn_indices, knn_distances,
+		num_threads );
+}
+
+// agroups and bgroups may be NULL; returns a TCRdistNbrsResult that must be freed
+void *
+tcrdist_threshold_nbrs(
+	void * engine_in,
+	int64_t const num_tcrs,
+	char const ** va,
+	char const ** cdr3a,
+	char const ** vb,
+	char const ** cdr3b,
+	int64_t const * agroups_in,
+	int64_t const * bgroups_in,
+	int64_t const threshold,
+	int64_t const unique_chains,
+	int64_t const prune,
+	int64_t const num_threads
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	vector< PairedTCR > const tcrs( make_paired_tcrs( engine, num_tcrs, va, cdr3a, vb, cdr3b ) );
+	Sizes const agroups( make_groups( num_tcrs, agroups_in ) ), bgroups( make_groups( num_tcrs, bgroups_in ) );
+
+	TCRdistNbrsResult * result( new TCRdistNbrsResult );
+	result->offsets.push_back(0);
+	UniqueChains unique;
+	ThresholdIndex index;
+	find_threshold_nbrs_for_rows( 0, tcrs.size(), engine.atcrdist, engine.btcrdist, tcrs, tcrs,
+		make_unique_chains( tcrs, unique_chains && !prune, unique ), make_threshold_index( tcrs, prune, index ),
+		agroups, bgroups, threshold, result->offsets, result->indices, result->distances, num_threads );
+	return result;
+}
+
+// all pairs (i,j) with tcrdist(tcrs1[i], tcrs2[j]) <= threshold; returns a
+// TCRdistNbrsResult (offsets are over tcrs1) that must be freed
+void *
+tcrdist_paired_matches(
+	void * engine_in,
+	int64_t const num_tcrs1,
+	char const ** va1,
+	char const ** cdr3a1,
+	char const ** vb1,
+	char const ** cdr3b1,
+	int64_t const num_tcrs2,
+	char const ** va2,
+	char const ** cdr3a2,
+	char const ** vb2,
+	char const ** cdr3b2,
+	int64_t const threshold,
+	int64_t const unique_chains,
+	int64_t const prune,
+	int64_t const num_threads
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	vector< PairedTCR > const tcrs1( make_paired_tcrs( engine, num_tcrs1, va1, cdr3a1, vb1, cdr3b1 ) );
+	vector< PairedTCR > const tcrs2( make_paired_tcrs( engine, num_tcrs2, va2, cdr3a2, vb2, cdr3b2 ) );
+	Sizes const no_groups;
+
+	TCRdistNbrsResult * result( new TCRdistNbrsResult );
+	result->offsets.push_back(0);
+	UniqueChains unique;
+	ThresholdIndex index;
+	find_threshold_nbrs_for_rows( 0, tcrs1.size(), engine.atcrdist, engine.btcrdist, tcrs1, tcrs2,
+		make_unique_chains( tcrs2, unique_chains && !prune, unique ), make_threshold_index( tcrs2, prune, index ),
+		no_groups, no_groups, threshold, result->offsets, result->indices, result->distances, num_threads );
+	return result;
+}
+
+int64_t
+tcrdist_nbrs_result_size( void * result )
+{
+	return static_cast< TCRdistNbrsResult * >( result )->indices.size();
+}
+
+// offsets has room for num_rows+1, indices and distances for tcrdist_nbrs_result_size
+void
+tcrdist_nbrs_result_copy(
+	void * result_in,
+	int64_t * offsets,
+	int32_t * indices,
+	uint16_t * distances
+)
+{
+	TCRdistNbrsResult const & result( *static_cast< TCRdistNbrsResult * >( result_in ) );
+	copy( result.offsets.begin(), result.offsets.end(), offsets );
+	copy( result.indices.begin(), result.indices.end(), indices );
+	copy( result.distances.begin(), result.distances.end(), distances );
+}
+
+void
+tcrdist_nbrs_result_delete( void * result )
+{
+	delete static_cast< TCRdistNbrsResult * >( result );
+}
+
+// counts has room for num_tcrs*(max_dist+1)
+void
+tcrdist_background_distributions(
+	void * engine_in,
+	int64_t const num_tcrs,
+	char const ** va,
+	char const ** cdr3a,
+	char const ** vb,
+	char const ** cdr3b,
+	int64_t const num_achains,
+	char const ** bg_va,
+	char const ** bg_cdr3a,
+	int64_t const num_bchains,
+	char const ** bg_vb,
+	char const ** bg_cdr3b,
+	int64_t const max_dist,
+	int64_t * counts,
+	int64_t const num_threads
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	vector< PairedTCR > const tcrs( make_paired_tcrs( engine, num_tcrs, va, cdr3a, vb, cdr3b ) );
+	vector< DistanceTCR_g > const achains( make_single_chain_tcrs( engine.atcrdist, num_achains, bg_va,
+			bg_cdr3a ) );
+	vector< DistanceTCR_g > const bchains( make_single_chain_tcrs( engine.btcrdist, num_bchains, bg_vb,
+			bg_cdr3b ) );
+
+	calc_background_distributions_for_rows( 0, tcrs.size(), engine.atcrdist, engine.btcrdist, tcrs, achains,
+		bchains, max_dist, counts, num_threads );
+}
+
+// like tcrdist_background_distributions, but the background chains can have
+// multiplicities (aweights, bweights: 0 means each chain counts once), and the
+// single-chain histograms can be returned too. counts, acounts, bcounts each have
+// room for num_tcrs*(max_dist+1), or are 0 if not wanted
+void
+tcrdist_background_histograms(
+	void * engine_in,
+	int64_t const num_tcrs,
+	char const ** va,
+	char const ** cdr3a,
+	char const ** vb,
+	char const ** cdr3b,
+	int64_t const num_achains,
+	char const ** bg_va,
+	char const ** bg_cdr3a,
+	int64_t const * aweights,
+	int64_t const num_bchains,
+	char const ** bg_vb,
+	char const ** bg_cdr3b,
+	int64_t const * bweights,
+	int64_t const max_dist,
+	int64_t * counts,
+	int64_t * acounts,
+	int64_t * bcounts,
+	int64_t const num_threads
+)
+{
+	TCRdistEngine const & engine( *static_cast< TCRdistEngine * >( engine_in ) );
+	vector< PairedTCR > const tcrs( make_paired_tcrs( engine, num_tcrs, va, cdr3a, vb, cdr3b ) );
+	vector< DistanceTCR_g > const achains( make_single_chain_tcrs( engine.atcrdist, num_achains, bg_va,
+			bg_cdr3a ) );
+	vector< DistanceTCR_g > const bchains( make_single_chain_tcrs( engine.btcrdist, num_bchains, bg_vb,
+			bg_cdr3b ) );
+	vector< int64_t > const avec( aweights ? vector< int64_t >( aweights, aweights+num_achains ) :
+		vector< int64_t >() );
+	vector< int64_t > const bvec( bweights ? vector< int64_t >( bweights, bweights+num_bchains ) :
+		vector< int64_t >() );
+
+	calc_background_distributions_for_rows( 0, tcrs.size(), engine.atcrdist, engine.btcrdist, tcrs, achains,
+		bchains, avec, bvec, max_dist, counts, acounts, bcounts, num_threads );
+}
+
+} // extern "C"